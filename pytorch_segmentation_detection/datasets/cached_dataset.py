@@ -0,0 +1,357 @@
+import os
+import copy
+import uuid
+import tempfile
+import multiprocessing
+
+import numpy as np
+from PIL import Image
+import torch.utils.data as data
+
+
+# Modes of PIL images that can be restored from the cached arrays.
+# Palette of 'P' images is not cached -- only the indexes are.
+pil_image_modes = ['L', 'P', 'RGB', 'RGBA', 'I', 'F', 'I;16']
+
+maximum_number_of_fields = 4
+maximum_number_of_dimensions = 4
+
+alignment_in_bytes = 64
+
+
+def get_default_cache_folder():
+    
+    # /dev/shm is backed by memory on linux, so the arena is never written to disk
+    if os.path.isdir('/dev/shm'):
+        
+        return '/dev/shm'
+    
+    return tempfile.gettempdir()
+
+
+class SharedMemoryCachedDataset(data.Dataset):
+    """Wraps a dataset and caches its decoded samples as arrays in a memory-mapped arena.
+    
+    The arena and the metadata of the cached samples are shared between the process
+    the wrapper was created in and the DataLoader workers, so a sample that was decoded
+    by any of the workers is reused by all of them in the following epochs. The size
+    of the arena is fixed -- least recently used samples are evicted when the new
+    ones don't fit.
+    
+    Joint transform is disabled in a shallow copy of the wrapped dataset, so that
+    the cached samples are not augmented, and is applied by the wrapper to each
+    returned sample instead. The dataset passed to the wrapper is not modified.
+    
+    Example
+    -------
+    dataset = SharedMemoryCachedDataset(Cityscapes(root, joint_transform=transform),
+                                        cache_size_in_bytes=8 * 1024 ** 3)
+    
+    loader = torch.utils.data.DataLoader(dataset, batch_size=8, num_workers=8)
+    """
+    
+    def __init__(self,
+                 dataset,
+                 cache_size_in_bytes,
+                 cache_folder=None,
+                 numpy_output=False):
+        """
+        Parameters
+        ----------
+        dataset : torch.utils.data.Dataset
+            Dataset with a joint_transform attribute, returning tuples of PIL images
+            or numpy arrays when its joint_transform is None
+        
+        cache_size_in_bytes : int
+            Size of the arena. Samples that are bigger than the arena are not cached.
+        
+        cache_folder : string or None
+            Folder where the arena file is created, /dev/shm if None and if it exists
+        
+        numpy_output : bool
+            Return samples as numpy arrays instead of restoring PIL images
+        """
+        
+        self.joint_transform = getattr(dataset, 'joint_transform', None)
+        
+        # Shallow copy with the joint transform disabled -- the dataset
+        # passed by the caller keeps its augmentation
+        self.dataset = copy.copy(dataset)
+        self.dataset.joint_transform = None
+        
+        self.numpy_output = numpy_output
+        
+        self.cache_size_in_bytes = int(cache_size_in_bytes)
+        
+        if cache_folder is None:
+            
+            cache_folder = get_default_cache_folder()
+        
+        self.cache_path = os.path.join(cache_folder, 'cached_dataset_{}.bin'.format(uuid.uuid4().hex))
+        
+        # Arena is created before the workers are started -- mapping
+        # is inherited by the forked workers
+        self.data = np.memmap(self.cache_path, dtype=np.uint8, mode='w+', shape=(max(self.cache_size_in_bytes, 1),))
+        
+        self.owner_process_id = os.getpid()
+        
+        number_of_samples = len(dataset)
+        
+        # Shared metadata of the cached samples: name, dtype, shape and initial value.
+        # Fields of a sample are described by their offset relative to the sample offset,
+        # dtype character, PIL image mode index (-1 for numpy arrays), number of dimensions and shape
+        shared_arrays_specifications = [
+            # Offset of the sample in the arena, -1 if the sample is not cached
+            ('samples_offsets', np.int64, (number_of_samples,), -1),
+            ('samples_sizes_in_bytes', np.int64, (number_of_samples,), 0),
+            # Value of the access counter at the last access of the sample
+            ('samples_last_access', np.int64, (number_of_samples,), 0),
+            ('samples_number_of_fields', np.int8, (number_of_samples,), 0),
+            ('fields_offsets', np.int64, (number_of_samples, maximum_number_of_fields), 0),
+            ('fields_dtypes', np.int8, (number_of_samples, maximum_number_of_fields), 0),
+            ('fields_modes', np.int8, (number_of_samples, maximum_number_of_fields), 0),
+            ('fields_number_of_dimensions', np.int8, (number_of_samples, maximum_number_of_fields), 0),
+            ('fields_shapes', np.int64, (number_of_samples, maximum_number_of_fields, maximum_number_of_dimensions), 0),
+            ('access_counter', np.int64, (1,), 0)]
+        
+        self.shared_buffers = {}
+        
+        for name, dtype, shape, initial_value in shared_arrays_specifications:
+            
+            ctype = np.ctypeslib.as_ctypes_type(np.dtype(dtype))
+            
+            self.shared_buffers[name] = (multiprocessing.RawArray(ctype, max(int(np.prod(shape)), 1)), np.dtype(dtype).str, shape)
+        
+        self.create_shared_arrays_views()
+        
+        for name, dtype, shape, initial_value in shared_arrays_specifications:
+            
+            getattr(self, name)[...] = initial_value
+        
+        self.lock = multiprocessing.Lock()
+    
+    def create_shared_arrays_views(self):
+        
+        for name, (shared_buffer, dtype, shape) in self.shared_buffers.items():
+            
+            number_of_elements = int(np.prod(shape))
+            
+            setattr(self, name, np.frombuffer(shared_buffer, dtype=dtype, count=number_of_elements).reshape(shape))
+    
+    def __getstate__(self):
+        
+        state = self.__dict__.copy()
+        
+        # Arena and the views of the shared buffers are recreated in the process
+        # the wrapper is unpickled in (workers started with 'spawn')
+        state['data'] = None
+        
+        for name in self.shared_buffers:
+            
+            del state[name]
+        
+        return state
+    
+    def __setstate__(self, state):
+        
+        self.__dict__.update(state)
+        
+        self.create_shared_arrays_views()
+        
+        self.data = np.memmap(self.cache_path, dtype=np.uint8, mode='r+')
+    
+    def close(self):
+        """Removes the arena file. Has to be called after all the workers are finished."""
+        
+        if os.getpid() == self.owner_process_id and os.path.exists(self.cache_path):
+            
+            os.remove(self.cache_path)
+    
+    def __del__(self):
+        
+        try:
+            
+            self.close()
+        except Exception:
+            
+            pass
+    
+    def __len__(self):
+        
+        return len(self.dataset)
+    
+    def get_number_of_cached_samples(self):
+        
+        return int((self.samples_offsets >= 0).sum())
+    
+    def get_next_access_count(self):
+        
+        self.access_counter[0] += 1
+        
+        return self.access_counter[0]
+    
+    def read_sample_from_cache(self, index):
+        """Returns the list of the fields of the sample or None if it's not cached. Has to be called under the lock."""
+        
+        sample_offset = self.samples_offsets[index]
+        
+        if sample_offset < 0:
+            
+            return None
+        
+        self.samples_last_access[index] = self.get_next_access_count()
+        
+        fields = []
+        
+        for field_number in range(self.samples_number_of_fields[index]):
+            
+            dtype = np.dtype(chr(self.fields_dtypes[index, field_number]))
+            number_of_dimensions = self.fields_number_of_dimensions[index, field_number]
+            shape = tuple(self.fields_shapes[index, field_number, :number_of_dimensions])
+            
+            field_offset = sample_offset + self.fields_offsets[index, field_number]
+            number_of_bytes = int(np.prod(shape, dtype=np.int64)) * dtype.itemsize
+            
+            # Copy -- the memory can be reused for other samples after the lock is released
+            field = self.data[field_offset:field_offset + number_of_bytes].view(dtype).reshape(shape).copy()
+            
+            mode_index = self.fields_modes[index, field_number]
+            
+            if mode_index >= 0 and not self.numpy_output:
+                
+                field = Image.frombytes(pil_image_modes[mode_index], (shape[1], shape[0]), field.tobytes())
+            
+            fields.append(field)
+        
+        return fields
+    
+    def allocate(self, size_in_bytes):
+        """Finds the first gap in the arena that fits size_in_bytes, evicting the least recently
+        used samples until it is found. Has to be called under the lock."""
+        
+        samples_offsets = self.samples_offsets
+        samples_sizes_in_bytes = self.samples_sizes_in_bytes
+        samples_last_access = self.samples_last_access
+        
+        while True:
+            
+            cached_samples_indexes = np.flatnonzero(samples_offsets >= 0)
+            
+            cached_samples_indexes = cached_samples_indexes[np.argsort(samples_offsets[cached_samples_indexes])]
+            
+            # Occupied extents sorted by offset, gaps are between the end of each
+            # extent and the beginning of the next one
+            extents_begins = np.append(samples_offsets[cached_samples_indexes], self.cache_size_in_bytes)
+            extents_ends = np.insert(samples_offsets[cached_samples_indexes] + samples_sizes_in_bytes[cached_samples_indexes], 0, 0)
+            
+            gaps_begins = extents_ends + (-extents_ends) % alignment_in_bytes
+            
+            fitting_gaps = np.flatnonzero(extents_begins - gaps_begins >= size_in_bytes)
+            
+            if fitting_gaps.size > 0:
+                
+                return int(gaps_begins[fitting_gaps[0]])
+            
+            if cached_samples_indexes.size == 0:
+                
+                return None
+            
+            least_recently_used_index = cached_samples_indexes[samples_last_access[cached_samples_indexes].argmin()]
+            
+            samples_offsets[least_recently_used_index] = -1
+    
+    def write_sample_to_cache(self, index, fields):
+        """Has to be called under the lock"""
+        
+        if self.samples_offsets[index] >= 0 or len(fields) > maximum_number_of_fields:
+            
+            return
+        
+        arrays = []
+        modes = []
+        
+        for field in fields:
+            
+            if isinstance(field, Image.Image):
+                
+                if field.mode not in pil_image_modes:
+                    
+                    return
+                
+                modes.append(pil_image_modes.index(field.mode))
+            else:
+                
+                modes.append(-1)
+            
+            array = np.ascontiguousarray(field)
+            
+            if array.dtype.hasobject or array.ndim > maximum_number_of_dimensions:
+                
+                return
+            
+            arrays.append(array)
+        
+        fields_offsets = []
+        
+        size_in_bytes = 0
+        
+        for array in arrays:
+            
+            size_in_bytes += (-size_in_bytes) % alignment_in_bytes
+            
+            fields_offsets.append(size_in_bytes)
+            
+            size_in_bytes += array.nbytes
+        
+        # Sample would never fit -- the cached ones are not evicted for nothing
+        if size_in_bytes > self.cache_size_in_bytes:
+            
+            return
+        
+        sample_offset = self.allocate(size_in_bytes)
+        
+        if sample_offset is None:
+            
+            return
+        
+        for field_number, (array, field_offset, mode_index) in enumerate(zip(arrays, fields_offsets, modes)):
+            
+            self.data[sample_offset + field_offset:sample_offset + field_offset + array.nbytes] = array.reshape(-1).view(np.uint8)
+            
+            self.fields_offsets[index, field_number] = field_offset
+            self.fields_dtypes[index, field_number] = ord(array.dtype.char)
+            self.fields_modes[index, field_number] = mode_index
+            self.fields_number_of_dimensions[index, field_number] = array.ndim
+            self.fields_shapes[index, field_number, :array.ndim] = array.shape
+        
+        self.samples_number_of_fields[index] = len(arrays)
+        self.samples_sizes_in_bytes[index] = size_in_bytes
+        self.samples_last_access[index] = self.get_next_access_count()
+        
+        # Sample becomes visible to the other processes only after it's fully written
+        self.samples_offsets[index] = sample_offset
+    
+    def __getitem__(self, index):
+        
+        with self.lock:
+            
+            fields = self.read_sample_from_cache(index)
+        
+        if fields is None:
+            
+            # Decoding happens outside of the lock
+            fields = list(self.dataset[index])
+            
+            with self.lock:
+                
+                self.write_sample_to_cache(index, fields)
+            
+            if self.numpy_output:
+                
+                fields = [np.asarray(field) for field in fields]
+        
+        if self.joint_transform is not None:
+            
+            fields = self.joint_transform(fields)
+        
+        return tuple(fields)
@@ -1,6 +1,7 @@
 
 import os
 import os.path
+import multiprocessing
 import numpy as np
 from PIL import Image
 import torch.utils.data as data
@@ -8,6 +9,80 @@ import torch.utils.data as data
 from ..utils.cityscapes import labels as cityscapes_labels
 
 
+label_ids_annotations_suffix = 'gtFine_labelIds'
+
+# Same name as the one used by the official cityscapesScripts
+train_ids_annotations_suffix = 'gtFine_labelTrainIds'
+
+
+def convert_label_ids_to_train_ids(annotation, train_ids_lookup_table):
+    """Remaps the label ids PIL image into train ids with a uint8 lookup table"""
+    
+    # Lookup table is applied by PIL directly to 8-bit images
+    if annotation.mode == 'L':
+        
+        return annotation.point(train_ids_lookup_table.tolist())
+    
+    return Image.fromarray(train_ids_lookup_table[np.asarray(annotation)])
+
+
+def convert_label_ids_file_to_train_ids_file(label_ids_filename):
+    
+    train_ids_filename = label_ids_filename.replace(label_ids_annotations_suffix, train_ids_annotations_suffix)
+    
+    annotation = Image.open(label_ids_filename)
+    
+    convert_label_ids_to_train_ids(annotation, Cityscapes.train_ids_lookup_table).save(train_ids_filename)
+    
+    return train_ids_filename
+
+
+def prepare_train_ids_label_files(dataset_root, overwrite=False, number_of_processes=None):
+    """Writes *_gtFine_labelTrainIds.png file next to each of the *_gtFine_labelIds.png
+    files of all the splits, so that Cityscapes(..., use_precomputed_train_ids=True)
+    reads train labels directly.
+    
+    Returns
+    -------
+    train_ids_filenames : list of strings
+        Filenames of the files that were written
+    """
+    
+    annotations_folder_path = os.path.join(dataset_root, Cityscapes.annotations_subfolder)
+    
+    label_ids_filenames = []
+    
+    for dirpath, dirnames, filenames in os.walk(annotations_folder_path):
+        
+        for filename in filenames:
+            
+            if not filename.endswith(label_ids_annotations_suffix + '.png'):
+                
+                continue
+            
+            label_ids_filename = os.path.join(dirpath, filename)
+            
+            train_ids_filename = label_ids_filename.replace(label_ids_annotations_suffix, train_ids_annotations_suffix)
+            
+            if overwrite or not os.path.exists(train_ids_filename):
+                
+                label_ids_filenames.append(label_ids_filename)
+    
+    if number_of_processes == 1 or len(label_ids_filenames) < 2:
+        
+        return list(map(convert_label_ids_file_to_train_ids_file, label_ids_filenames))
+    
+    pool = multiprocessing.Pool(processes=number_of_processes)
+    
+    try:
+        
+        return pool.map(convert_label_ids_file_to_train_ids_file, label_ids_filenames, chunksize=16)
+    finally:
+        
+        pool.close()
+        pool.join()
+
+
 class Cityscapes(data.Dataset):
     
     # Images name subfolder in the root folder of the dataset
@@ -25,6 +100,11 @@ class Cityscapes(data.Dataset):
     # See utils.cityscapes for more details
     ordered_train_labels = np.asarray( list(map(lambda x: x.trainId, cityscapes_labels)) )
     
+    # Same mapping as a uint8 lookup table for all of the possible pixel values:
+    # ignored labels (-1) become 255 as after ordered_train_labels[...].astype(np.uint8)
+    train_ids_lookup_table = np.full(256, 255, dtype=np.uint8)
+    train_ids_lookup_table[:len(ordered_train_labels)] = ordered_train_labels.astype(np.uint8)
+    
     number_of_classes = 19
 
     
@@ -32,7 +112,8 @@ class Cityscapes(data.Dataset):
                  dataset_root,
                  dataset_type=0,
                  train=True,
-                 joint_transform=None):
+                 joint_transform=None,
+                 use_precomputed_train_ids=False):
         
         # dataset_root should point to a folder
         # with gtFine and leftImg8bit folders containing
@@ -43,8 +124,15 @@ class Cityscapes(data.Dataset):
         # 1 - val
         # 2 - test
         
+        # use_precomputed_train_ids:
+        # read annotations that were already converted into train labels
+        # with prepare_train_ids_label_files() instead of remapping them on each call
+        
         self.dataset_root = dataset_root
         self.joint_transform = joint_transform
+        self.use_precomputed_train_ids = use_precomputed_train_ids
+        
+        annotations_suffix = train_ids_annotations_suffix if use_precomputed_train_ids else label_ids_annotations_suffix
 
         dataset_type_name = self.dataset_types[dataset_type]
 
@@ -61,7 +149,7 @@ class Cityscapes(data.Dataset):
                 image_filename = os.path.join(dirpath, filename)
 
                 annotation_filename = os.path.join( dirpath.replace(images_folder_path, annotations_folder_path),
-                                                    filename.replace('leftImg8bit', 'gtFine_labelIds') )
+                                                    filename.replace('leftImg8bit', annotations_suffix) )
 
                 self.images_filenames.append( image_filename )
                 self.annotations_filenames.append( annotation_filename )
@@ -83,12 +171,9 @@ class Cityscapes(data.Dataset):
         # TODO: maybe can be done in a better way
         _target = Image.open(annotation_path)
         
-        _target_np = np.asarray(_target)
-        
-        # https://stackoverflow.com/questions/8188726/how-do-i-do-this-array-lookup-replace-with-numpy
-        _target_np = self.ordered_train_labels[_target_np].astype(np.uint8)
-        
-        _target = Image.fromarray(_target_np)
+        if not self.use_precomputed_train_ids:
+            
+            _target = convert_label_ids_to_train_ids(_target, self.train_ids_lookup_table)
 
         if self.joint_transform is not None:
 
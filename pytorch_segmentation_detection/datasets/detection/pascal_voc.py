@@ -9,13 +9,41 @@ from ...utils.detection import (compute_bboxes_ious,
                                 convert_bbox_topleft_xywh_tensor_to_center_xywh,
                                 convert_bbox_center_xywh_tensor_to_xyxy,
                                 convert_bbox_center_xywh_tensor_to_topleft_xywh,
+                                convert_bbox_format_,
                                 display_bboxes_center_xywh,
                                 compute_network_output_feature_map_size,
                                 AnchorBoxesManager,
                                 pad_to_size_with_bounding_boxes,
+                                pad_ground_truth_boxes,
                                random_crop_with_bounding_boxes)
 
 
+def collate_detection_ground_truth(batch):
+    """Collate function for PascalVOCDetection created with ```encode_targets=False```.
+    
+    Stacks images and pads groundtruth boxes and labels of the batch to the same size,
+    so that the targets can be computed afterwards for the whole batch with
+    AnchorBoxesManager.encode_batch() -- for example, on the GPU.
+    
+    Returns
+    -------
+    images : torch.FloatTensor of size (B, C, H, W)
+    
+    ground_truth_boxes_center_xywh : torch.FloatTensor of size (B, Nmax, 4)
+    
+    ground_truth_labels : torch.LongTensor of size (B, Nmax)
+    
+    ground_truth_mask : torch.BoolTensor of size (B, Nmax)
+    """
+    
+    images, ground_truth_boxes_center_xywh_list, ground_truth_labels_list = zip(*batch)
+    
+    ground_truth_boxes_center_xywh, ground_truth_labels, ground_truth_mask = pad_ground_truth_boxes(ground_truth_boxes_center_xywh_list,
+                                                                                                   ground_truth_labels_list)
+    
+    return torch.stack(images), ground_truth_boxes_center_xywh, ground_truth_labels, ground_truth_mask
+
+
 class PascalVOCDetection(data.Dataset):
     """
     PascalVOCDetection class serves as a wrapper for PASCAL VOC detection
@@ -34,7 +62,9 @@ class PascalVOCDetection(data.Dataset):
     def __init__(self, images_folder_path,
                  annotation_json,
                  image_transform,
-                 input_image_size=(600, 600)
+                 input_image_size=(600, 600),
+                 encode_targets=True,
+                 joint_transform=None
                 ):
         """Constructor function for the PascalVOCDetection class.
         
@@ -57,6 +87,18 @@ class PascalVOCDetection(data.Dataset):
         input_image_size : tuple of ints
             Size of the all images that are being delivered -- we padd all of them to the
             same size (see above).
+            
+        encode_targets : bool
+            If True, parametrized target values for each anchor box are computed for each sample.
+            Otherwise, groundtruth boxes and labels are returned as they are -- use
+            collate_detection_ground_truth() and AnchorBoxesManager.encode_batch() to
+            compute the targets for the whole batch at once.
+            
+        joint_transform : callable or None
+            Box-aware augmentation (for example, transforms.ComposeJoint of
+            RandomHorizontalFlipJointWithBoxes, RandomScaleJointWithBoxes and so on)
+            that is run on [pil_img, ground_truth_boxes_center_xywh] before the image
+            is cropped to input_image_size.
 
         """
         
@@ -66,6 +108,10 @@ class PascalVOCDetection(data.Dataset):
         
         self.image_transform = image_transform
         
+        self.encode_targets = encode_targets
+        
+        self.joint_transform = joint_transform
+        
         self.anchor_box_manager = AnchorBoxesManager(input_image_size=input_image_size)
         
         self.pascal_cocolike_db = CocoDetection(annFile=annotation_json,
@@ -82,12 +128,16 @@ class PascalVOCDetection(data.Dataset):
         bboxes_locations_topleft_xywh = list(map(lambda cocolike_dict: cocolike_dict['bbox'], cocolike_detection_annotations))
         bboxes_classes = list(map(lambda cocolike_dict: cocolike_dict['category_id'], cocolike_detection_annotations))
         
-        # Getting the xywh coordinates and converting them to xyxy
-        bboxes_locations_topleft_xywh = torch.FloatTensor( bboxes_locations_topleft_xywh )
-        ground_truth_boxes_center_xywh = convert_bbox_topleft_xywh_tensor_to_center_xywh( bboxes_locations_topleft_xywh )
+        # Getting the xywh coordinates and converting them to center_xywh in-place
+        bboxes_locations_topleft_xywh = torch.FloatTensor( bboxes_locations_topleft_xywh ).view(-1, 4)
+        ground_truth_boxes_center_xywh = convert_bbox_format_( bboxes_locations_topleft_xywh, 'topleft_xywh', 'center_xywh' )
         
         ground_truth_labels = torch.LongTensor( bboxes_classes )
         
+        if self.joint_transform is not None:
+            
+            pil_img, ground_truth_boxes_center_xywh = self.joint_transform([pil_img, ground_truth_boxes_center_xywh])
+        
         #pil_img_padded, ground_truth_boxes_center_xywh_padded = pad_to_size_with_bounding_boxes(input_img=pil_img,
         #                                                                                        size=self.input_size,
         #                                                                                        bboxes_center_xywh=ground_truth_boxes_center_xywh)
@@ -96,11 +146,14 @@ class PascalVOCDetection(data.Dataset):
                                                                                                 crop_size=self.input_size,
                                                                                                 bboxes_center_xywh=ground_truth_boxes_center_xywh)
                                                                                                 
+        img_tensor_transformed = self.image_transform(pil_img_padded)
+        
+        if not self.encode_targets:
+            
+            return img_tensor_transformed, ground_truth_boxes_center_xywh_padded, ground_truth_labels
         
         target_deltas, target_classes = self.anchor_box_manager.encode(ground_truth_boxes_center_xywh=ground_truth_boxes_center_xywh_padded,
                                                                        ground_truth_labels=ground_truth_labels)
         
-        img_tensor_transformed = self.image_transform(pil_img_padded)
-        
         #return pil_img_padded, ground_truth_boxes_center_xywh_padded
         return img_tensor_transformed, target_deltas, target_classes
@@ -1,6 +1,9 @@
 import os
 import sys
+import json
 import glob
+import multiprocessing
+from functools import reduce
 
 import torch
 import torch.utils.data as data
@@ -10,10 +13,9 @@ import numpy as np
 # Reading video files
 import imageio
 
-import skimage.io as io
 from PIL import Image
 
-from ..utils.endovis_instrument import clean_up_annotation, merge_left_and_right_annotations
+from ..utils.endovis_instrument import clean_up_annotations_batch, merge_left_and_right_annotations
 
 
 class Endovis_Instrument_2015(data.Dataset):
@@ -38,7 +40,8 @@ class Endovis_Instrument_2015(data.Dataset):
                  prepare_dataset=False,
                  dataset_type=0,
                  split_mode=2,
-                 validation_datasets_numbers=[2]):
+                 validation_datasets_numbers=[2],
+                 number_of_processes=None):
         
         # Dataset types:
         # 0 -- binary
@@ -54,8 +57,8 @@ class Endovis_Instrument_2015(data.Dataset):
         
         if prepare_dataset:
             
-            self._prepare_dataset(train=True)
-            self._prepare_dataset(train=False)
+            self._prepare_dataset(train=True, number_of_processes=number_of_processes)
+            self._prepare_dataset(train=False, number_of_processes=number_of_processes)
             
         if train:
             
@@ -118,13 +121,18 @@ class Endovis_Instrument_2015(data.Dataset):
         return _img, _target
         
         
-    def _prepare_dataset(self, train=True):
+    def _prepare_dataset(self, train=True, number_of_processes=None, cleanup_batch_size=32):
         """
         Creates a new folder with the name Processed in the root of the dataset
         where all the images and annotations are stored as plain jpg and png images.
+        
+        Each of the datasets (videos) is extracted by a separate process. Numbers of
+        frames are read beforehand, so that each process knows the global number of its
+        first frame. Datasets that were fully extracted are recorded in a manifest file,
+        so an interrupted preparation resumes from the first unfinished dataset.
         """
         
-        datasets_numbers = set(list(range(1, 5)))
+        datasets_numbers = set(range(1, 5))
 
         if train:
             
@@ -136,8 +144,8 @@ class Endovis_Instrument_2015(data.Dataset):
             annotation_folder_to_save = os.path.join(self.root, self.relative_annotation_save_path_validation )
             images_folder_to_save = os.path.join(self.root, self.relative_image_save_path_validation)
             datasets_numbers = self.validation_datasets_numbers
-            
-
+        
+        datasets_numbers = sorted(datasets_numbers)
 
         annotation_save_template = os.path.join( annotation_folder_to_save, "{0:08d}.png" )
         images_save_template = os.path.join( images_folder_to_save, "{0:08d}.jpg" )
@@ -149,77 +157,222 @@ class Endovis_Instrument_2015(data.Dataset):
         if not os.path.exists(images_folder_to_save):
             os.makedirs(images_folder_to_save)
 
-        # Creating template to go through the datasets folders
-        dataset_folder_template = "Training/Dataset{}"
-        dataset_template = os.path.join(self.root, dataset_folder_template)
-
+        # Manifest is kept next to the images and annotations folders
+        manifest_filename = os.path.join(os.path.dirname(images_folder_to_save), prepare_dataset_manifest_filename)
+        
+        manifest = read_prepare_dataset_manifest(manifest_filename)
+        
+        # Global number of the first frame of each dataset
+        datasets_image_number_offsets = {}
+        
         image_number_offset = 0
-
-        # We have overall 4 datasets
+        
         for current_dataset_number in datasets_numbers:
+            
+            datasets_image_number_offsets[current_dataset_number] = image_number_offset
+            
+            image_number_offset += get_endovis_instrument_2015_dataset_length(self.root, current_dataset_number)
+        
+        # Completed datasets are valid only if they were saved with the same offsets
+        completed_datasets = {dataset_number: image_number_offset
+                              for dataset_number, image_number_offset in manifest['completed_datasets'].items()
+                              if datasets_image_number_offsets.get(int(dataset_number)) == image_number_offset}
+        
+        manifest = {'completed_datasets': completed_datasets}
+        
+        tasks = [(self.root,
+                  current_dataset_number,
+                  datasets_image_number_offsets[current_dataset_number],
+                  images_save_template,
+                  annotation_save_template,
+                  cleanup_batch_size)
+                 for current_dataset_number in datasets_numbers
+                 if str(current_dataset_number) not in completed_datasets]
+        
+        if not tasks:
+            
+            return
+        
+        if number_of_processes is None:
+            
+            number_of_processes = min(len(tasks), multiprocessing.cpu_count())
+        
+        def mark_dataset_as_completed(current_dataset_number):
+            
+            manifest['completed_datasets'][str(current_dataset_number)] = datasets_image_number_offsets[current_dataset_number]
+            
+            write_prepare_dataset_manifest(manifest_filename, manifest)
+        
+        if number_of_processes == 1:
+            
+            for task in tasks:
+                
+                mark_dataset_as_completed(_prepare_endovis_instrument_2015_dataset_task(task))
+            
+            return
+        
+        pool = multiprocessing.Pool(processes=number_of_processes)
+        
+        try:
+            
+            for current_dataset_number in pool.imap_unordered(_prepare_endovis_instrument_2015_dataset_task, tasks):
+                
+                mark_dataset_as_completed(current_dataset_number)
+        finally:
+            
+            pool.close()
+            pool.join()
 
-            current_dataset_path = dataset_template.format(current_dataset_number)
-
-            if current_dataset_number == 1:
-
-                # First dataset has two vides with separate annotations for each tool
-                left_annotation_video_filename = os.path.join(current_dataset_path, 'Left_Instrument_Segmentation.avi')
-                right_annotation_video_filename = os.path.join(current_dataset_path, 'Right_Instrument_Segmentation.avi')
-            else:
-
-                # Other datasets have just one video with annotation
-                annotation_video_filename = os.path.join(current_dataset_path, 'Segmentation.avi')
-
-
-            # Each dataset has just one video and it has the same name
-            images_video_filename = os.path.join(current_dataset_path, 'Video.avi')
-
-            # Creating readers for each of our videos
-            images_reader = imageio.get_reader(images_video_filename,  'ffmpeg')
 
-            # Once again -- first dataset is an exception
-            if current_dataset_number == 1:
+prepare_dataset_manifest_filename = 'prepare_dataset_manifest.json'
 
-                left_annotations_reader = imageio.get_reader(left_annotation_video_filename, 'ffmpeg')
-                right_annotations_reader = imageio.get_reader(right_annotation_video_filename, 'ffmpeg')
-            else:
 
-                annotations_reader = imageio.get_reader(annotation_video_filename, 'ffmpeg')
+def read_prepare_dataset_manifest(manifest_filename):
+    
+    if not os.path.isfile(manifest_filename):
+        
+        return {'completed_datasets': {}}
+    
+    with open(manifest_filename, 'r') as manifest_file:
+        
+        return json.load(manifest_file)
 
-            current_dataset_number_of_images = images_reader.get_length()
 
+def write_prepare_dataset_manifest(manifest_filename, manifest):
+    
+    # Manifest is replaced atomically -- interruption can't leave it half-written
+    temporary_manifest_filename = manifest_filename + '.tmp'
+    
+    with open(temporary_manifest_filename, 'w') as manifest_file:
+        
+        json.dump(manifest, manifest_file)
+    
+    os.rename(temporary_manifest_filename, manifest_filename)
 
-            for current_image_number in range(current_dataset_number_of_images):
 
-                # We need to merge two separate annotation files in the first dataset
-                if current_dataset_number == 1:
-                    current_annotatio_left = left_annotations_reader.get_data(current_image_number)
-                    processed_current_annotation_left = clean_up_annotation(current_annotatio_left)
+def get_endovis_instrument_2015_video_filenames(root, dataset_number):
+    """Returns the filename of the images video and the list of filenames of annotation videos"""
+    
+    # Creating template to go through the datasets folders
+    dataset_path = os.path.join(root, "Training/Dataset{}".format(dataset_number))
+    
+    # Each dataset has just one video and it has the same name
+    images_video_filename = os.path.join(dataset_path, 'Video.avi')
+    
+    if dataset_number == 1:
 
-                    current_annotation_right = right_annotations_reader.get_data(current_image_number)
-                    processed_current_annotation_right = clean_up_annotation(current_annotation_right)
+        # First dataset has two vides with separate annotations for each tool
+        annotation_video_filenames = [os.path.join(dataset_path, 'Left_Instrument_Segmentation.avi'),
+                                      os.path.join(dataset_path, 'Right_Instrument_Segmentation.avi')]
+    else:
 
-                    processed_current_annotation_final = merge_left_and_right_annotations(processed_current_annotation_left,
-                                                                                          processed_current_annotation_right)
-                else:
+        # Other datasets have just one video with annotation
+        annotation_video_filenames = [os.path.join(dataset_path, 'Segmentation.avi')]
+    
+    return images_video_filename, annotation_video_filenames
 
-                    current_annotation = annotations_reader.get_data(current_image_number)
-                    processed_current_annotation_final = clean_up_annotation(current_annotation)
 
-                current_image = images_reader.get_data(current_image_number)
+def get_video_number_of_frames(video_reader):
+    
+    number_of_frames = video_reader.get_length()
+    
+    # Newer versions of imageio don't read the number of frames from the header
+    if number_of_frames == float('inf'):
+        
+        number_of_frames = video_reader.count_frames()
+    
+    return int(number_of_frames)
 
-                # add offset so that we respect the global count and not of the current dataset
-                current_annotation_name_to_save = annotation_save_template.format(current_image_number + image_number_offset)
-                current_image_name_to_save = images_save_template.format(current_image_number + image_number_offset)
 
+def get_endovis_instrument_2015_dataset_length(root, dataset_number):
+    
+    images_video_filename, _ = get_endovis_instrument_2015_video_filenames(root, dataset_number)
+    
+    images_reader = imageio.get_reader(images_video_filename, 'ffmpeg')
+    
+    try:
+        
+        return get_video_number_of_frames(images_reader)
+    finally:
+        
+        images_reader.close()
 
-                # add the offset from previous dataset image files -- so that we get all images saved
-                io.imsave(current_annotation_name_to_save, processed_current_annotation_final)
-                io.imsave(current_image_name_to_save, current_image)
 
-            # Update the global count of images
-            image_number_offset += current_dataset_number_of_images
+def prepare_endovis_instrument_2015_dataset(root,
+                                            dataset_number,
+                                            image_number_offset,
+                                            images_save_template,
+                                            annotation_save_template,
+                                            cleanup_batch_size=32):
+    """Extracts frames of one dataset and saves them starting from the image_number_offset.
+    
+    Videos are decoded sequentially frame after frame (random access with get_data()
+    seeks in the video on every call) and annotations are cleaned up in batches.
+    """
+    
+    images_video_filename, annotation_video_filenames = get_endovis_instrument_2015_video_filenames(root, dataset_number)
+    
+    images_reader = imageio.get_reader(images_video_filename, 'ffmpeg')
+    annotations_readers = [imageio.get_reader(filename, 'ffmpeg') for filename in annotation_video_filenames]
+    
+    def save_batch(first_image_number, images_batch, annotations_batches):
         
+        # Annotations of each tool in the first dataset are cleaned up separately and merged
+        processed_annotations_batches = [clean_up_annotations_batch(np.stack(annotations_batch))
+                                         for annotations_batch in annotations_batches]
+        
+        processed_annotations_batch = reduce(merge_left_and_right_annotations, processed_annotations_batches)
+        
+        for batch_index, (current_image, processed_annotation) in enumerate(zip(images_batch, processed_annotations_batch)):
+            
+            # add offset so that we respect the global count and not of the current dataset
+            current_image_number = image_number_offset + first_image_number + batch_index
+            
+            Image.fromarray(processed_annotation.astype(np.uint8)).save(annotation_save_template.format(current_image_number))
+            Image.fromarray(current_image).save(images_save_template.format(current_image_number))
+    
+    try:
+        
+        number_of_frames = get_video_number_of_frames(images_reader)
+        
+        images_batch = []
+        annotations_batches = [[] for _ in annotations_readers]
+        
+        first_image_number = 0
+        
+        frames = zip(range(number_of_frames), images_reader, *annotations_readers)
+        
+        for frame in frames:
+            
+            images_batch.append(frame[1])
+            
+            for annotations_batch, annotation in zip(annotations_batches, frame[2:]):
+                
+                annotations_batch.append(annotation)
+            
+            if len(images_batch) == cleanup_batch_size:
+                
+                save_batch(first_image_number, images_batch, annotations_batches)
+                
+                first_image_number += len(images_batch)
+                
+                images_batch = []
+                annotations_batches = [[] for _ in annotations_readers]
+        
+        if images_batch:
+            
+            save_batch(first_image_number, images_batch, annotations_batches)
+    finally:
+        
+        images_reader.close()
+        
+        for annotations_reader in annotations_readers:
+            
+            annotations_reader.close()
     
+    return dataset_number
+
+
+def _prepare_endovis_instrument_2015_dataset_task(task):
     
-        
\ No newline at end of file
+    return prepare_endovis_instrument_2015_dataset(*task)
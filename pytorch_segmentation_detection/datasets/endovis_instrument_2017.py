@@ -8,7 +8,10 @@ import copy
 from PIL import Image
 
 
-from ..utils.endovis_instrument import merge_left_and_right_annotations_v2
+from ..utils.endovis_instrument import (merge_left_and_right_annotations_v2,
+                                        merge_endovis_instrument_2017_instruments_annotations,
+                                        convert_endovis_instrument_2017_instruments_annotations)
+from ..utils.packed_store import PackedArrayStore, PackedArrayStoreWriter
 
 from functools import reduce
 
@@ -40,6 +43,48 @@ def get_sorted_by_name_image_names(folder_path, image_ext="png"):
     return sorted_file_names
 
 
+def read_endovis_instrument_2017_instruments_annotations(annotations_dict, parts_class_labels):
+    """Reads all of the annotation files of a frame and merges the left/right parts
+    annotations of each of the instruments.
+    
+    Parameters
+    ----------
+    annotations_dict : dict
+        Instrument name -> list of filenames of its annotations
+    
+    Returns
+    -------
+    instrument_names : list of strings
+    instruments_annotations : numpy array of shape (number of instruments, H, W)
+    """
+    
+    instrument_names = list(annotations_dict)
+    
+    annotations = []
+    groups_starts = []
+    
+    for instrument_name in instrument_names:
+        
+        groups_starts.append(len(annotations))
+        
+        for annotation_filename in annotations_dict[instrument_name]:
+            
+            annotation = io.imread(annotation_filename)
+            
+            # In case some annotation files has three repeated dims
+            if annotation.ndim == 3:
+                
+                annotation = annotation[:, :, 0]
+            
+            annotations.append(annotation)
+    
+    instruments_annotations = merge_endovis_instrument_2017_instruments_annotations(np.stack(annotations),
+                                                                                    groups_starts,
+                                                                                    parts_class_labels)
+    
+    return instrument_names, instruments_annotations
+
+
 class Endovis_Instrument_2017(data.Dataset):
     
     number_of_datasets = 8
@@ -345,6 +390,27 @@ class Endovis_Instrument_2017(data.Dataset):
 
         return annotations_numpy_dict
     
+    def read_and_merge_annotations(self, annotations_dict):
+        """Computes the final annotation for the dataset type in one pass -- same as
+        the sequence of read_annotations_and_merge_left_right_pairs(),
+        merge_parts_annotations_into_separate_type_annotations(),
+        merge_types_numpy_annotations_dict_into_single_annotation(),
+        change_parts_annotation() and merge_parts_annotation_numpy_into_binary_tool_annotation().
+        """
+        
+        instrument_names, instruments_annotations = read_endovis_instrument_2017_instruments_annotations(annotations_dict,
+                                                                                                       self.parts_class_labels)
+        
+        instruments_types_labels = [self.instrument_type_to_label_mapping[instrument_name] for instrument_name in instrument_names]
+        
+        return convert_endovis_instrument_2017_instruments_annotations(instruments_annotations,
+                                                                       self.dataset_type,
+                                                                       self.parts_class_labels,
+                                                                       instruments_types_labels,
+                                                                       self.instrument_types_class_labels,
+                                                                       self.parts_class_to_label_mapping,
+                                                                       self.new_parts_class_to_label_mapping)
+    
     def __len__(self):
         
         return len(self.img_annotations_filenames_tuples)
@@ -357,31 +423,7 @@ class Endovis_Instrument_2017(data.Dataset):
         annotations_filenames_dict = current_tuple[1]
         image_filename = current_tuple[0]
 
-        # Merge left and right instrument parts here
-        # This is common for any type of dataset
-        annotations_numpy_dict = self.read_annotations_and_merge_left_right_pairs(annotations_filenames_dict)
-
-        if self.dataset_type == 2:
-
-            annotations_numpy_dict = self.merge_parts_annotations_into_separate_type_annotations(annotations_numpy_dict)
-            final_annotation_numpy = self.merge_types_numpy_annotations_dict_into_single_annotation(annotations_numpy_dict,
-                                                                                                   labels=self.instrument_types_class_labels)
-        else:
-
-            # Merge different instrument's types here -- erasing type information and merging parts annotations
-            # Common for binary and parts, if type -- we should omit this operation
-            final_annotation_numpy = self.merge_types_numpy_annotations_dict_into_single_annotation(annotations_numpy_dict,
-                                                                                                   labels=self.parts_class_labels)
-            
-            # Check if we need to change the mapping as specified by user
-            if self.dataset_type == 1:
-                
-                final_annotation_numpy = self.change_parts_annotation(final_annotation_numpy)
-                
-            # Now you need to binarize the parts annotation numpy
-            if self.dataset_type == 0:
-
-                final_annotation_numpy = self.merge_parts_annotation_numpy_into_binary_tool_annotation(final_annotation_numpy)
+        final_annotation_numpy = self.read_and_merge_annotations(annotations_filenames_dict)
         
         _img = Image.open(image_filename).convert('RGB')
         
@@ -562,29 +604,7 @@ class Endovis_Instrument_2017_fast(data.Dataset):
         
         for image_filename, annotations_filenames_dict in self.img_annotations_filenames_tuples:
             
-            annotations_numpy_dict = self.read_annotations_and_merge_left_right_pairs(annotations_filenames_dict)
-            
-            if self.dataset_type == 2:
-
-                annotations_numpy_dict = self.merge_parts_annotations_into_separate_type_annotations(annotations_numpy_dict)
-                final_annotation_numpy = self.merge_types_numpy_annotations_dict_into_single_annotation(annotations_numpy_dict,
-                                                                                                       labels=self.instrument_types_class_labels)
-            else:
-
-                # Merge different instrument's types here -- erasing type information and merging parts annotations
-                # Common for binary and parts, if type -- we should omit this operation
-                final_annotation_numpy = self.merge_types_numpy_annotations_dict_into_single_annotation(annotations_numpy_dict,
-                                                                                                       labels=self.parts_class_labels)
-
-                # Check if we need to change the mapping as specified by user
-                if self.dataset_type == 1:
-
-                    final_annotation_numpy = self.change_parts_annotation(final_annotation_numpy)
-
-                # Now you need to binarize the parts annotation numpy
-                if self.dataset_type == 0:
-
-                    final_annotation_numpy = self.merge_parts_annotation_numpy_into_binary_tool_annotation(final_annotation_numpy)
+            final_annotation_numpy = self.read_and_merge_annotations(annotations_filenames_dict)
             
             _img = Image.open(image_filename).convert('RGB')
             
@@ -735,6 +755,27 @@ class Endovis_Instrument_2017_fast(data.Dataset):
 
         return annotations_numpy_dict
     
+    def read_and_merge_annotations(self, annotations_dict):
+        """Computes the final annotation for the dataset type in one pass -- same as
+        the sequence of read_annotations_and_merge_left_right_pairs(),
+        merge_parts_annotations_into_separate_type_annotations(),
+        merge_types_numpy_annotations_dict_into_single_annotation(),
+        change_parts_annotation() and merge_parts_annotation_numpy_into_binary_tool_annotation().
+        """
+        
+        instrument_names, instruments_annotations = read_endovis_instrument_2017_instruments_annotations(annotations_dict,
+                                                                                                       self.parts_class_labels)
+        
+        instruments_types_labels = [self.instrument_type_to_label_mapping[instrument_name] for instrument_name in instrument_names]
+        
+        return convert_endovis_instrument_2017_instruments_annotations(instruments_annotations,
+                                                                       self.dataset_type,
+                                                                       self.parts_class_labels,
+                                                                       instruments_types_labels,
+                                                                       self.instrument_types_class_labels,
+                                                                       self.parts_class_to_label_mapping,
+                                                                       self.new_parts_class_to_label_mapping)
+    
     def __len__(self):
         
         return len(self.img_annotations_filenames_tuples)
@@ -756,4 +797,158 @@ class Endovis_Instrument_2017_fast(data.Dataset):
             _img, _target = self.joint_transform([_img, _target])
         
         return _img, _target
+
+
+# Names of the annotation fields in the packed store for each dataset type
+packed_store_annotation_field_names = ['binary', 'parts', 'types']
+
+
+def compile_endovis_instrument_2017_packed_store(root, store_path):
+    """One-time compilation of all of the sequences of the dataset into a packed store
+    (see utils.packed_store) that is used by Endovis_Instrument_2017_packed.
+    
+    For each frame the image and the final annotations of all of the dataset types
+    (left/right and per type annotations are already merged) are stored, so that
+    no merging or decoding is needed during the training. The keys of the samples are
+    '<dataset_number>/<frame_filename>'. Parts annotations are stored with the original
+    labels -- new_parts_class_to_label_mapping is applied during loading.
+    """
+    
+    dataset = Endovis_Instrument_2017(root, validation_dataset_number_list=[])
+    
+    with PackedArrayStoreWriter(store_path) as writer:
+        
+        for dataset_number in range(dataset.number_of_datasets):
+            
+            for image_filename, annotations_filenames_dict in dataset.get_single_dataset_filenames(dataset_number):
+                
+                instrument_names, instruments_annotations = read_endovis_instrument_2017_instruments_annotations(annotations_filenames_dict,
+                                                                                                               dataset.parts_class_labels)
+                
+                instruments_types_labels = [dataset.instrument_type_to_label_mapping[instrument_name] for instrument_name in instrument_names]
+                
+                # Parts annotations are stored with the original labels
+                annotations = [convert_endovis_instrument_2017_instruments_annotations(instruments_annotations,
+                                                                                      dataset_type,
+                                                                                      dataset.parts_class_labels,
+                                                                                      instruments_types_labels,
+                                                                                      dataset.instrument_types_class_labels)
+                               for dataset_type in range(len(packed_store_annotation_field_names))]
+                
+                image = np.asarray(Image.open(image_filename).convert('RGB'))
+                
+                arrays_dict = {'image': image}
+                
+                for field_name, annotation in zip(packed_store_annotation_field_names, annotations):
+                    
+                    arrays_dict[field_name] = annotation
+                
+                key = '{}/{}'.format(dataset_number, os.path.basename(image_filename))
+                
+                writer.add(key, arrays_dict)
+
+
+class Endovis_Instrument_2017_packed(data.Dataset):
+    """Endovis 2017 dataset loaded from the packed store created with
+    compile_endovis_instrument_2017_packed_store().
+    
+    Startup only reads the index of the store and the samples are memory-mapped
+    views of it, so nothing is preloaded and the memory is shared between DataLoader
+    workers. Produces the same samples as Endovis_Instrument_2017.
+    """
+    
+    number_of_datasets = Endovis_Instrument_2017.number_of_datasets
+    
+    number_of_classes_list = Endovis_Instrument_2017.number_of_classes_list
+    
+    parts_class_to_label_mapping = Endovis_Instrument_2017.parts_class_to_label_mapping
+    
+    def __init__(self,
+                 store_path,
+                 dataset_type=0,
+                 train=True,
+                 joint_transform=None,
+                 validation_dataset_number_list=[2],
+                 new_parts_class_to_label_mapping=None,
+                 numpy_output=False):
+        """
+        Parameters
+        ----------
+        numpy_output : bool
+            Return samples as read-only numpy views of the store instead of PIL images.
+            Intended for the joint transforms of the NumPy backend in transforms.py.
+        """
+        
+        ## Dataset type:
+        # 0 -- binary
+        # 1 -- parts
+        # 2 -- types
+        
+        self.number_of_classes = self.number_of_classes_list[dataset_type]
+        
+        self.dataset_type = dataset_type
+        
+        self.joint_transform = joint_transform
+        
+        self.numpy_output = numpy_output
+        
+        self.annotation_field_name = packed_store_annotation_field_names[dataset_type]
+        
+        self.store = PackedArrayStore(store_path)
+        
+        # Change of the parts labels is performed with a lookup table,
+        # labels that are not in the mapping stay the same
+        self.parts_labels_lookup_table = None
+        
+        if dataset_type == 1 and new_parts_class_to_label_mapping is not None:
+            
+            self.parts_labels_lookup_table = np.arange(256, dtype=np.uint8)
+            
+            for tool_part_name, tool_part_old_index in self.parts_class_to_label_mapping.items():
+                
+                self.parts_labels_lookup_table[tool_part_old_index] = new_parts_class_to_label_mapping[tool_part_name]
+        
+        if train:
+            
+            dataset_number_list = [dataset_number for dataset_number in range(self.number_of_datasets)
+                                   if dataset_number not in validation_dataset_number_list]
+        else:
+            
+            dataset_number_list = validation_dataset_number_list
+        
+        keys_by_dataset_number = {}
+        
+        for key in self.store.keys:
+            
+            keys_by_dataset_number.setdefault(int(key.split('/')[0]), []).append(key)
+        
+        self.keys = []
+        
+        for dataset_number in dataset_number_list:
+            
+            self.keys.extend(keys_by_dataset_number.get(dataset_number, []))
+    
+    def __len__(self):
+        
+        return len(self.keys)
     
+    def __getitem__(self, index):
+        
+        key = self.keys[index]
+        
+        _img = self.store.get_array(key, 'image')
+        _target = self.store.get_array(key, self.annotation_field_name)
+        
+        if self.parts_labels_lookup_table is not None:
+            
+            _target = self.parts_labels_lookup_table[_target]
+        
+        if not self.numpy_output:
+            
+            _img = Image.fromarray(_img)
+            _target = Image.fromarray(_target)
+        
+        if self.joint_transform is not None:
+            _img, _target = self.joint_transform([_img, _target])
+        
+        return _img, _target
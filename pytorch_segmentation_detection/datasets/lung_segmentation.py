@@ -7,7 +7,8 @@ from PIL import Image
 import torch.utils.data as data
 import random
 
-from ..utils.rle_mask_encoding import rle2mask
+from ..utils.rle_mask_encoding import rle2mask, mask2rle
+from ..utils.packed_store import PackedArrayStore, PackedArrayStoreWriter
 
 
 
@@ -42,6 +43,45 @@ def merge_masks_of_duplicated_images(annotation_df):
     return annotation_df_without_duplicates
 
 
+def prepare_lung_segmentation_store(train_images_folder_path, annotation_csv_file_path, store_path):
+    """One-time preprocessing that decodes all of the annotated dicom images
+    and rle masks and writes them into a packed store (see utils.packed_store)
+    which can be used by LungSegmentation with store_path argument.
+    
+    Each sample is stored with the ImageId key and has 'image' (grayscale pixel array)
+    and 'annotation' (uint8 0/1 mask) fields -- same data as LungSegmentation
+    produces from the dicom file and the first annotation of the image.
+    Use merge_masks_of_duplicated_images() on the annotation dataframe beforehand
+    and save it to a csv file to get the merged masks of the duplicated images.
+    """
+    
+    annotation_df = pd.read_csv(annotation_csv_file_path)
+    
+    images_filenames = glob.glob(train_images_folder_path + "/*/*/*.dcm")
+    
+    truncated_name_to_full_name = {images_filename.split('/')[-1][:-4]: images_filename for images_filename in images_filenames}
+    
+    image_id_to_rle = {}
+    
+    for image_id, rle in zip(annotation_df['ImageId'], annotation_df[' EncodedPixels']):
+        
+        image_id_to_rle.setdefault(image_id, rle)
+    
+    with PackedArrayStoreWriter(store_path) as writer:
+        
+        for image_id, rle in image_id_to_rle.items():
+            
+            image = pydicom.dcmread(truncated_name_to_full_name[image_id]).pixel_array
+            
+            if rle != ' -1':
+                
+                annotation = (rle2mask(rle, width=1024, height=1024).transpose() != 0).astype(np.uint8)
+            else:
+                
+                annotation = np.zeros((1024, 1024), dtype=np.uint8)
+            
+            writer.add(image_id, {'image': image, 'annotation': annotation})
+
 
 class LungSegmentation(data.Dataset):
     
@@ -50,23 +90,43 @@ class LungSegmentation(data.Dataset):
                  train_images_folder_path=None,
                  annotation_csv_file_path=None,
                  train=True,
-                 joint_transform=None):
+                 joint_transform=None,
+                 store_path=None,
+                 numpy_output=False):
+        """
+        Parameters
+        ----------
+        store_path : string or None
+            Path of the store created with prepare_lung_segmentation_store().
+            If specified, decoded images and masks are read from it instead of
+            dicom files and rle strings and train_images_folder_path is not used.
+            
+        numpy_output : bool
+            Return samples as read-only numpy views of the store (the image is expanded
+            to three channels with a broadcasted view) instead of PIL images. Intended
+            for the joint transforms of the NumPy backend in transforms.py.
+            Works only together with store_path.
+        """
         
         self.joint_transform = joint_transform
         
+        self.numpy_output = numpy_output
+        
+        self.store = PackedArrayStore(store_path) if store_path is not None else None
+        
         self.train = train
                 
         self.train_images_folder_path = train_images_folder_path
         
         self.annotation_df = pd.read_csv(annotation_csv_file_path)
         
-        images_filenames = sorted(glob.glob(train_images_folder_path + "/*/*/*.dcm"))
+        # Replaces the scan of the whole dataframe for each sample -- first
+        # annotation of each image is used, same as with the scan
+        self.image_id_to_rle = {}
         
-        trancuted_name_and_full_names_lookup_dict = {}
-
-        for images_filename in images_filenames:
-
-            trancuted_name_and_full_names_lookup_dict.update({images_filename.split('/')[-1][:-4]: images_filename})
+        for image_id, rle in zip(self.annotation_df['ImageId'], self.annotation_df[' EncodedPixels']):
+            
+            self.image_id_to_rle.setdefault(image_id, rle)
         
         if train:
         
@@ -85,11 +145,23 @@ class LungSegmentation(data.Dataset):
 
         all_data = list(negative_examples) + list(posititve_examples)
         
+        self.image_ids = all_data
+        
         final = []
+        
+        if self.store is None:
+            
+            images_filenames = sorted(glob.glob(train_images_folder_path + "/*/*/*.dcm"))
+
+            trancuted_name_and_full_names_lookup_dict = {}
+
+            for images_filename in images_filenames:
 
-        for truncated_name in all_data:
+                trancuted_name_and_full_names_lookup_dict.update({images_filename.split('/')[-1][:-4]: images_filename})
 
-            final.append(trancuted_name_and_full_names_lookup_dict[truncated_name])
+            for truncated_name in all_data:
+
+                final.append(trancuted_name_and_full_names_lookup_dict[truncated_name])
             
 #         if train:
             
@@ -114,10 +186,35 @@ class LungSegmentation(data.Dataset):
             
     def __len__(self):
         
-        return len(self.images_filenames)
+        return len(self.image_ids)
+    
+    def get_item_from_store(self, index):
+        
+        sample = self.store.get(self.image_ids[index])
+        
+        image, annotation = sample['image'], sample['annotation']
+        
+        if self.numpy_output:
+            
+            # Three channels view without copying the data
+            image = np.broadcast_to(image[:, :, None], image.shape + (3,))
+        else:
+            
+            image = Image.fromarray(image).convert('RGB')
+            annotation = Image.fromarray(annotation)
+        
+        if self.joint_transform is not None:
+
+            image, annotation = self.joint_transform([image, annotation])
+            
+        return image, annotation
     
     def __getitem__(self, index):
         
+        if self.store is not None:
+            
+            return self.get_item_from_store(index)
+        
         image_filename = self.images_filenames[index]
         
 #         if self.train:
@@ -137,7 +234,7 @@ class LungSegmentation(data.Dataset):
 
         image_filename_stripped = image_filename.split('/')[-1][:-4]
 
-        annotation_rle = self.annotation_df.loc[self.annotation_df['ImageId'] == image_filename_stripped][' EncodedPixels'].values[0]
+        annotation_rle = self.image_id_to_rle[image_filename_stripped]
 
         if annotation_rle != ' -1':
 
@@ -145,7 +242,7 @@ class LungSegmentation(data.Dataset):
             annotation[annotation != 0] = 1
         else:
 
-            annotation = np.zeros((1024, 1024))
+            annotation = np.zeros((1024, 1024), dtype=np.uint8)
         
         
         
@@ -0,0 +1,140 @@
+import multiprocessing
+
+import torch
+
+from .metrics import RunningConfusionMatrix
+
+
+# Dataset and prediction function of the current worker process -- they are set
+# by the pool initializer once, instead of being sent along with each shard
+_worker_dataset = None
+_worker_prediction_function = None
+
+
+def _initialize_worker(dataset, prediction_function, number_of_threads):
+
+    global _worker_dataset, _worker_prediction_function
+    
+    _worker_dataset = dataset
+    _worker_prediction_function = prediction_function
+    
+    # Each of the processes uses its own cores -- prevents oversubscription
+    if number_of_threads is not None:
+        
+        torch.set_num_threads(number_of_threads)
+
+
+def evaluate_shard(dataset, prediction_function, indexes, labels, ignore_label=255):
+    """Evaluates samples of the dataset with the given indexes.
+    
+    Returns
+    -------
+    confusion_matrix : numpy array of shape (len(labels), len(labels))
+        Snapshot of the RunningConfusionMatrix accumulated over the shard
+    """
+    
+    running_confusion_matrix = RunningConfusionMatrix(labels, ignore_label=ignore_label)
+    
+    for index in indexes:
+        
+        sample = dataset[index]
+        
+        image, ground_truth = sample[0], sample[1]
+        
+        prediction = prediction_function(image)
+        
+        running_confusion_matrix.update_matrix(ground_truth, prediction)
+    
+    return running_confusion_matrix.snapshot()
+
+
+def _evaluate_worker_shard(shard):
+
+    indexes, labels, ignore_label = shard
+    
+    return evaluate_shard(_worker_dataset, _worker_prediction_function, indexes, labels, ignore_label)
+
+
+def evaluate_segmentation_dataset(dataset,
+                                  prediction_function,
+                                  labels,
+                                  ignore_label=255,
+                                  number_of_processes=None,
+                                  shards_per_process=4,
+                                  number_of_threads_per_process=1):
+    """Evaluates the dataset sharded across a pool of processes.
+    
+    Each worker accumulates its own RunningConfusionMatrix over a shard of the
+    dataset and sends back only the pickled confusion matrix, which are merged
+    at the end. Several shards per process are used to balance the load.
+    
+    Parameters
+    ----------
+    dataset : torch.utils.data.Dataset
+        Dataset returning (image, ground_truth, ...) samples
+    
+    prediction_function : callable
+        Function that takes the image and returns predicted labels of the same
+        size as the groundtruth. Has to be picklable (for example, defined on the
+        module level) if processes are started with 'spawn' method.
+    
+    labels : list[int]
+        List that contains int values that represent classes.
+    
+    ignore_label : int
+        A label representing parts that should be ignored during
+        computation of metrics
+    
+    number_of_processes : int or None
+        Number of worker processes, number of cpus if None.
+        Evaluation runs in the current process if equal to 1.
+    
+    shards_per_process : int
+        Number of shards the dataset is split into for each of the processes
+    
+    number_of_threads_per_process : int or None
+        Number of threads torch uses in each of the workers
+    
+    Returns
+    -------
+    running_confusion_matrix : RunningConfusionMatrix
+        Confusion matrix merged from all of the shards -- the metrics can be
+        computed with its compute_current_*() methods
+    """
+    
+    if number_of_processes is None:
+        
+        number_of_processes = multiprocessing.cpu_count()
+    
+    running_confusion_matrix = RunningConfusionMatrix(labels, ignore_label=ignore_label)
+    
+    dataset_indexes = list(range(len(dataset)))
+    
+    if number_of_processes == 1:
+        
+        running_confusion_matrix.merge(evaluate_shard(dataset, prediction_function, dataset_indexes, labels, ignore_label))
+        
+        return running_confusion_matrix
+    
+    number_of_shards = min(number_of_processes * shards_per_process, max(len(dataset), 1))
+    
+    # Strided shards -- neighbouring samples, which often have similar cost,
+    # end up in the different shards
+    shards = [(dataset_indexes[shard_number::number_of_shards], labels, ignore_label)
+              for shard_number in range(number_of_shards)]
+    
+    pool = multiprocessing.Pool(processes=number_of_processes,
+                                initializer=_initialize_worker,
+                                initargs=(dataset, prediction_function, number_of_threads_per_process))
+    
+    try:
+        
+        for shard_confusion_matrix in pool.imap_unordered(_evaluate_worker_shard, shards):
+            
+            running_confusion_matrix.merge(shard_confusion_matrix)
+    finally:
+        
+        pool.close()
+        pool.join()
+    
+    return running_confusion_matrix
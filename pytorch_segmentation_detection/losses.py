@@ -1,7 +1,6 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from .transforms import convert_labels_to_one_hot_encoding
 
 # TODO: version of pytorch for cuda 7.5 doesn't have the latest features like
 # reduce=False argument -- update cuda on the machine and update the code
@@ -10,25 +9,341 @@ from .transforms import convert_labels_to_one_hot_encoding
 # arguments
 
 class FocalLoss(nn.Module):
-    """Focal loss puts more weight on more complicated examples."""
+    """Focal loss puts more weight on more complicated examples.
+    
+    Log-probabilities of the target classes are computed directly from the logits
+    as logit[target] - logsumexp(logits) which is numerically stable and doesn't
+    require one-hot encoding of the targets or a softmax over all of the classes
+    to be stored for the backward pass.
+    
+    Parameters
+    ----------
+    gamma : float
+        Focusing parameter -- the loss of an example is scaled by (1 - p_target) ** gamma
+    alpha : sequence of floats or torch.FloatTensor of shape (C,) or None
+        Weight of each class
+    ignore_index : int
+        Targets equal to this value don't contribute to the loss
+    reduction : string
+        'sum', 'mean' (weighted by alpha, same as nn.CrossEntropyLoss) or 'none'
+    """
    
-    def __init__(self, gamma=1):
+    def __init__(self, gamma=1, alpha=None, ignore_index=255, reduction='sum'):
         
         super(FocalLoss, self).__init__()
+        
+        if reduction not in ('sum', 'mean', 'none'):
+            
+            raise ValueError("reduction must be one of 'sum', 'mean' or 'none'")
+        
         self.gamma = gamma
+        self.ignore_index = ignore_index
+        self.reduction = reduction
+        
+        if alpha is not None:
+            
+            alpha = torch.as_tensor(alpha, dtype=torch.float32)
+        
+        self.register_buffer('alpha', alpha)
 
-    def forward(self, flatten_logits, flatten_targets):
+    def forward(self, logits, targets):
+        """
+        Parameters
+        ----------
+        logits : torch.FloatTensor of shape (N, C) or (B, C, H, W)
+        targets : torch.LongTensor of shape (N,) or (B, H, W)
+        
+        Returns
+        -------
+        loss : torch.FloatTensor
+            Scalar or tensor of the same shape as targets if reduction is 'none'
+        """
+        
+        targets = targets.detach()
+        
+        valid_targets_mask = targets != self.ignore_index
+        
+        # Ignored targets are replaced with a valid class index to be able to gather
+        # and their loss is zeroed afterwards
+        safe_targets = targets.masked_fill(~valid_targets_mask, 0).unsqueeze(1)
+        
+        log_probabilities_of_target_classes = (logits.gather(1, safe_targets) - torch.logsumexp(logits, dim=1, keepdim=True)).squeeze(1)
         
-        flatten_targets = flatten_targets.data
+        probabilities_of_target_classes = log_probabilities_of_target_classes.exp()
         
-        number_of_classes = flatten_logits.size(1)
+        elementwise_loss = - (1 - probabilities_of_target_classes).pow(self.gamma) * log_probabilities_of_target_classes
         
-        flatten_targets_one_hot = convert_labels_to_one_hot_encoding(flatten_targets, number_of_classes)
+        weights = valid_targets_mask.to(elementwise_loss.dtype)
+        
+        if self.alpha is not None:
+            
+            weights = weights * self.alpha.to(elementwise_loss.dtype)[safe_targets.squeeze(1)]
+        
+        elementwise_loss = elementwise_loss * weights
+        
+        if self.reduction == 'none':
+            
+            return elementwise_loss
+        
+        if self.reduction == 'mean':
+            
+            return elementwise_loss.sum() / weights.sum()
+        
+        return elementwise_loss.sum()
+
 
-        all_class_probabilities = F.softmax(flatten_logits)
+class TverskyLoss(nn.Module):
+    """Soft Tversky loss -- generalization of the soft Dice loss with different
+    penalties for false positives (alpha) and false negatives (beta).
+    
+    Soft true positives, false positives and false negatives are accumulated
+    for each class over all of the pixels of the batch without one-hot encoding
+    of the targets and the loss is averaged over the classes.
+    
+    Parameters
+    ----------
+    alpha : float
+        Weight of the false positives
+    beta : float
+        Weight of the false negatives
+    smooth : float
+        Smoothing term added to the numerator and the denominator
+    class_weights : sequence of floats or torch.FloatTensor of shape (C,) or None
+        Weights of the classes in the average
+    ignore_index : int
+        Pixels with targets equal to this value don't contribute to the loss
+    """
+    
+    def __init__(self, alpha=0.5, beta=0.5, smooth=1.0, class_weights=None, ignore_index=255):
+        
+        super(TverskyLoss, self).__init__()
+        
+        self.alpha = alpha
+        self.beta = beta
+        self.smooth = smooth
+        self.ignore_index = ignore_index
+        
+        if class_weights is not None:
+            
+            class_weights = torch.as_tensor(class_weights, dtype=torch.float32)
+        
+        self.register_buffer('class_weights', class_weights)
+    
+    def forward(self, logits, targets):
+        """
+        Parameters
+        ----------
+        logits : torch.FloatTensor of shape (B, C, H, W)
+        targets : torch.LongTensor of shape (B, H, W)
+        """
+        
+        number_of_classes = logits.size(1)
+        
+        targets = targets.detach()
+        
+        valid_targets_mask = targets != self.ignore_index
+        
+        probabilities = F.softmax(logits, dim=1)
+        
+        valid_targets = targets[valid_targets_mask]
+        
+        # Probabilities of the target classes of valid pixels: (P,)
+        probabilities_of_target_classes = probabilities.permute(0, 2, 3, 1)[valid_targets_mask].gather(1, valid_targets.unsqueeze(1)).squeeze(1)
+        
+        true_positives = probabilities.new_zeros(number_of_classes).scatter_add(0, valid_targets, probabilities_of_target_classes)
+        
+        predicted_sums = (probabilities * valid_targets_mask.unsqueeze(1).to(probabilities.dtype)).sum(dim=(0, 2, 3))
+        
+        ground_truth_sums = torch.bincount(valid_targets, minlength=number_of_classes).to(probabilities.dtype)
+        
+        false_positives = predicted_sums - true_positives
+        false_negatives = ground_truth_sums - true_positives
+        
+        tversky_index = (true_positives + self.smooth) / (true_positives + self.alpha * false_positives + self.beta * false_negatives + self.smooth)
+        
+        if self.class_weights is None:
+            
+            return 1 - tversky_index.mean()
+        
+        class_weights = self.class_weights.to(tversky_index.dtype)
+        
+        return 1 - (tversky_index * class_weights).sum() / class_weights.sum()
 
-        probabilities_of_target_classes = all_class_probabilities[flatten_targets_one_hot]
 
-        elementwise_loss =  - (1 - probabilities_of_target_classes).pow(self.gamma) * torch.log(probabilities_of_target_classes)
+class SoftDiceLoss(TverskyLoss):
+    """Soft Dice loss -- Tversky loss with equal weights of false positives
+    and false negatives."""
+    
+    def __init__(self, smooth=1.0, class_weights=None, ignore_index=255):
+        
+        super(SoftDiceLoss, self).__init__(alpha=0.5,
+                                           beta=0.5,
+                                           smooth=smooth,
+                                           class_weights=class_weights,
+                                           ignore_index=ignore_index)
+
+
+def compute_lovasz_gradient(sorted_ground_truth):
+    """Gradient of the Lovasz extension of the Jaccard loss with respect to
+    sorted errors. Computed for all of the classes at once.
+    
+    Parameters
+    ----------
+    sorted_ground_truth : torch.FloatTensor of shape (C, P)
+        Foreground indicators of each class sorted by the decreasing errors
+    """
+    
+    ground_truth_sums = sorted_ground_truth.sum(dim=1, keepdim=True)
+    
+    intersection = ground_truth_sums - sorted_ground_truth.cumsum(dim=1)
+    union = ground_truth_sums + (1 - sorted_ground_truth).cumsum(dim=1)
+    
+    jaccard = 1 - intersection / union
+    
+    jaccard[:, 1:] = jaccard[:, 1:] - jaccard[:, :-1]
+    
+    return jaccard
+
+
+class LovaszSoftmaxLoss(nn.Module):
+    """Lovasz-Softmax loss -- direct optimization of the mean intersection over union
+    (Berman et al., "The Lovasz-Softmax loss", CVPR 2018).
+    
+    Errors of all of the classes are sorted at once, so the loss is computed
+    with a single sort of a (C, P) tensor instead of a loop over the classes.
+    
+    Parameters
+    ----------
+    only_present_classes : bool
+        Average only over the classes present in the targets
+    per_image : bool
+        Compute the loss for each image separately and average it
+    ignore_index : int
+        Pixels with targets equal to this value don't contribute to the loss
+    """
+    
+    def __init__(self, only_present_classes=True, per_image=False, ignore_index=255):
+        
+        super(LovaszSoftmaxLoss, self).__init__()
+        
+        self.only_present_classes = only_present_classes
+        self.per_image = per_image
+        self.ignore_index = ignore_index
+    
+    def compute_flat_loss(self, probabilities, targets):
+        """
+        Parameters
+        ----------
+        probabilities : torch.FloatTensor of shape (P, C)
+        targets : torch.LongTensor of shape (P,)
+        """
+        
+        valid_targets_mask = targets != self.ignore_index
+        
+        probabilities = probabilities[valid_targets_mask].t()
+        targets = targets[valid_targets_mask]
+        
+        number_of_classes = probabilities.size(0)
+        
+        if targets.numel() == 0:
+            
+            return probabilities.sum() * 0
+        
+        # ground_truth: (C, P)
+        ground_truth = (targets.unsqueeze(0) == torch.arange(number_of_classes, device=targets.device).unsqueeze(1)).to(probabilities.dtype)
+        
+        errors = (ground_truth - probabilities).abs()
+        
+        sorted_errors, sort_indexes = errors.sort(dim=1, descending=True)
+        
+        sorted_ground_truth = ground_truth.gather(1, sort_indexes)
+        
+        losses = (sorted_errors * compute_lovasz_gradient(sorted_ground_truth)).sum(dim=1)
+        
+        if self.only_present_classes:
+            
+            losses = losses[ground_truth.sum(dim=1) > 0]
+        
+        return losses.mean()
+    
+    def forward(self, logits, targets):
+        """
+        Parameters
+        ----------
+        logits : torch.FloatTensor of shape (B, C, H, W)
+        targets : torch.LongTensor of shape (B, H, W)
+        """
+        
+        number_of_classes = logits.size(1)
+        
+        probabilities = F.softmax(logits, dim=1).permute(0, 2, 3, 1)
+        
+        targets = targets.detach()
+        
+        if self.per_image:
+            
+            losses = [self.compute_flat_loss(image_probabilities.reshape(-1, number_of_classes), image_targets.reshape(-1))
+                      for image_probabilities, image_targets in zip(probabilities, targets)]
+            
+            return torch.stack(losses).mean()
+        
+        return self.compute_flat_loss(probabilities.reshape(-1, number_of_classes), targets.reshape(-1))
+
+
+class OhemCrossEntropyLoss(nn.Module):
+    """Cross-entropy with online hard example mining -- only the top-k pixels
+    with the biggest loss contribute to the loss and are backpropagated.
+    
+    Parameters
+    ----------
+    top_k_ratio : float
+        Fraction of the valid pixels of the batch that are kept
+    min_kept : int
+        Minimum number of kept pixels
+    weight : sequence of floats or torch.FloatTensor of shape (C,) or None
+        Weight of each class, same as in nn.CrossEntropyLoss
+    ignore_index : int
+        Pixels with targets equal to this value don't contribute to the loss
+    """
+    
+    def __init__(self, top_k_ratio=0.25, min_kept=0, weight=None, ignore_index=255):
+        
+        super(OhemCrossEntropyLoss, self).__init__()
+        
+        self.top_k_ratio = top_k_ratio
+        self.min_kept = min_kept
+        self.ignore_index = ignore_index
+        
+        if weight is not None:
+            
+            weight = torch.as_tensor(weight, dtype=torch.float32)
+        
+        self.register_buffer('weight', weight)
+    
+    def forward(self, logits, targets):
+        """
+        Parameters
+        ----------
+        logits : torch.FloatTensor of shape (N, C) or (B, C, H, W)
+        targets : torch.LongTensor of shape (N,) or (B, H, W)
+        """
+        
+        pixels_losses = F.cross_entropy(logits,
+                                        targets,
+                                        weight=self.weight,
+                                        ignore_index=self.ignore_index,
+                                        reduction='none').reshape(-1)
+        
+        number_of_valid_pixels = int((targets != self.ignore_index).sum())
+        
+        number_of_kept_pixels = min(max(int(self.top_k_ratio * number_of_valid_pixels), self.min_kept), number_of_valid_pixels)
+        
+        if number_of_kept_pixels == 0:
+            
+            return pixels_losses.sum() * 0
+        
+        # Ignored pixels have zero loss, so they are selected only if there are
+        # not enough valid pixels with bigger losses -- which is prevented above
+        hard_pixels_losses = pixels_losses.topk(number_of_kept_pixels, sorted=False)[0]
         
-        return elementwise_loss.sum()
\ No newline at end of file
+        return hard_pixels_losses.mean()
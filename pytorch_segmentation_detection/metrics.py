@@ -1,5 +1,67 @@
 import numpy as np
-from sklearn.metrics import confusion_matrix
+import torch
+
+from scipy.ndimage import distance_transform_edt
+
+
+def convert_to_flat_numpy_array(input):
+    """Converts numpy array or torch tensor (on any device) of any shape
+    to a flat numpy array, without copying the data if possible"""
+    
+    if hasattr(input, 'detach'):
+        
+        input = input.detach().cpu().numpy()
+    
+    return np.asarray(input).ravel()
+
+
+def convert_to_numpy_array(input):
+    """Converts numpy array or torch tensor (on any device) to a numpy array"""
+    
+    if hasattr(input, 'detach'):
+        
+        input = input.detach().cpu().numpy()
+    
+    return np.asarray(input)
+
+
+def compute_label_boundaries(labels):
+    """Computes boundaries of the segments of a label map using shifts of the map.
+    
+    A pixel belongs to a boundary if one of its 4-neighbours has a different label,
+    so boundaries of the neighbouring segments are on both sides of the transition
+    and boundary of class c is (labels == c) & boundaries.
+    
+    Parameters
+    ----------
+    labels : numpy array of shape ([B,] H, W)
+    
+    Returns
+    -------
+    boundaries : numpy bool array of shape ([B,] H, W)
+    """
+    
+    boundaries = np.zeros(labels.shape, dtype=np.bool_)
+    
+    vertical_transitions = labels[..., 1:, :] != labels[..., :-1, :]
+    
+    boundaries[..., 1:, :] |= vertical_transitions
+    boundaries[..., :-1, :] |= vertical_transitions
+    
+    horizontal_transitions = labels[..., :, 1:] != labels[..., :, :-1]
+    
+    boundaries[..., :, 1:] |= horizontal_transitions
+    boundaries[..., :, :-1] |= horizontal_transitions
+    
+    return boundaries
+
+
+def nanmean(values):
+    """Mean of the non-NaN values, NaN if there are none (without the numpy warning)"""
+    
+    values = values[~np.isnan(values)]
+    
+    return values.mean() if values.size else np.float32(np.nan)
 
 
 class RunningConfusionMatrix():
@@ -11,7 +73,7 @@ class RunningConfusionMatrix():
     ----------
     labels : list[int]
         List that contains int values that represent classes.
-    overall_confusion_matrix : sklean.confusion_matrix object
+    overall_confusion_matrix : numpy array of shape (len(labels), len(labels))
         Container of the sum of all confusion matrices. Used to compute MIOU at the end.
     ignore_label : int
         A label representing parts that should be ignored during
@@ -25,47 +87,667 @@ class RunningConfusionMatrix():
         self.ignore_label = ignore_label
         self.overall_confusion_matrix = None
         
+        self.number_of_classes = len(labels)
+        
+        # If labels are 0, 1, ..., n - 1 they are used as indexes directly,
+        # otherwise they are looked up in the sorted array of labels
+        self.labels_are_contiguous = list(labels) == list(range(self.number_of_classes))
+        
+        labels_array = np.asarray(labels, dtype=np.int64)
+        
+        self.labels_sort_order = np.argsort(labels_array, kind='mergesort')
+        self.sorted_labels = labels_array[self.labels_sort_order]
+    
+    def convert_labels_to_indexes(self, values):
+        """Returns positions of the values in the self.labels list and
+        a mask of values that are present in the list"""
+        
+        if self.labels_are_contiguous:
+            
+            values = values.astype(np.int64, copy=False)
+            
+            valid_mask = (values >= 0) & (values < self.number_of_classes)
+            
+            return values, valid_mask
+        
+        positions = np.searchsorted(self.sorted_labels, values)
+        positions = np.minimum(positions, self.number_of_classes - 1)
+        
+        valid_mask = self.sorted_labels[positions] == values
+        
+        return self.labels_sort_order[positions], valid_mask
+    
+    def compute_confusion_matrix(self, ground_truth, prediction):
+        """Computes confusion matrix with a single bincount -- same as
+        sklearn.metrics.confusion_matrix(ground_truth, prediction, labels=self.labels).
+        Elements with the groundtruth or prediction not in self.labels are ignored."""
+        
+        ground_truth_indexes, ground_truth_valid_mask = self.convert_labels_to_indexes(ground_truth)
+        prediction_indexes, prediction_valid_mask = self.convert_labels_to_indexes(prediction)
+        
+        valid_mask = ground_truth_valid_mask & prediction_valid_mask
+        
+        flat_indexes = self.number_of_classes * ground_truth_indexes[valid_mask] + prediction_indexes[valid_mask]
+        
+        current_confusion_matrix = np.bincount(flat_indexes, minlength=self.number_of_classes ** 2)
+        
+        return current_confusion_matrix.reshape(self.number_of_classes, self.number_of_classes)
+        
     def update_matrix(self, ground_truth, prediction):
         """Updates overall confusion matrix statistics.
-        If you are working with 2D data, just .flatten() it before running this
-        function.
+        Inputs of any shape are flattened, so whole batches can be used.
 
         Parameters
         ----------
-        groundtruth : array, shape = [n_samples]
+        groundtruth : numpy array or torch tensor
             An array with groundtruth values
-        prediction : array, shape = [n_samples]
+        prediction : numpy array or torch tensor of the same size
             An array with predictions
         """
         
-        # Mask-out value is ignored by default in the sklearn
-        # read sources to see how that was handled
-        # But sometimes all the elements in the groundtruth can
-        # be equal to ignore value which will cause the crush
-        # of scikit_learn.confusion_matrix(), this is why we check it here
+        ground_truth = convert_to_flat_numpy_array(ground_truth)
+        prediction = convert_to_flat_numpy_array(prediction)
+        
+        # Sometimes all the elements in the groundtruth can
+        # be equal to ignore value -- nothing to update in this case
         if (ground_truth == self.ignore_label).all():
             
             return
         
-        current_confusion_matrix = confusion_matrix(y_true=ground_truth,
-                                                    y_pred=prediction,
-                                                    labels=self.labels)
+        current_confusion_matrix = self.compute_confusion_matrix(ground_truth, prediction)
+        
+        self.add_confusion_matrix(current_confusion_matrix)
+    
+    def add_confusion_matrix(self, confusion_matrix):
         
         if self.overall_confusion_matrix is not None:
             
-            self.overall_confusion_matrix += current_confusion_matrix
+            self.overall_confusion_matrix += confusion_matrix
         else:
             
-            self.overall_confusion_matrix = current_confusion_matrix
+            self.overall_confusion_matrix = confusion_matrix
     
-    def compute_current_mean_intersection_over_union(self):
+    def get_overall_confusion_matrix(self):
+        """Returns overall confusion matrix as a numpy array"""
         
-        intersection = np.diag(self.overall_confusion_matrix)
-        ground_truth_set = self.overall_confusion_matrix.sum(axis=1)
-        predicted_set = self.overall_confusion_matrix.sum(axis=0)
+        if self.overall_confusion_matrix is None:
+            
+            return np.zeros((self.number_of_classes, self.number_of_classes), dtype=np.int64)
+        
+        return self.overall_confusion_matrix
+    
+    def snapshot(self):
+        """Returns a copy of the current overall confusion matrix as a numpy array.
+        Can be stored, pickled or sent to another process and merged later on."""
+        
+        return np.array(self.get_overall_confusion_matrix(), dtype=np.int64, copy=True)
+    
+    def merge(self, other):
+        """Adds statistics of another RunningConfusionMatrix with the same labels
+        or a confusion matrix returned by snapshot() to the overall confusion matrix"""
+        
+        if isinstance(other, RunningConfusionMatrix):
+            
+            other = other.snapshot()
+        
+        self.add_confusion_matrix(np.array(other, dtype=np.int64, copy=True))
+    
+    def reset(self):
+        
+        self.overall_confusion_matrix = None
+    
+    # All of the metrics below are computed from the overall confusion matrix.
+    # Classes that are absent both from the groundtruth and from the predictions
+    # get NaN values and are excluded from the means.
+    
+    def compute_current_intersection_over_union_per_class(self):
+        
+        overall_confusion_matrix = self.get_overall_confusion_matrix()
+        
+        intersection = np.diag(overall_confusion_matrix)
+        ground_truth_set = overall_confusion_matrix.sum(axis=1)
+        predicted_set = overall_confusion_matrix.sum(axis=0)
         union =  ground_truth_set + predicted_set - intersection
+        
+        with np.errstate(divide='ignore', invalid='ignore'):
+            
+            intersection_over_union = intersection / union.astype(np.float32)
+        
+        return intersection_over_union
+    
+    def compute_current_mean_intersection_over_union(self):
+        
+        intersection_over_union = self.compute_current_intersection_over_union_per_class()
+        
+        mean_intersection_over_union = nanmean(intersection_over_union)
+        
+        return mean_intersection_over_union
+    
+    def compute_current_frequency_weighted_intersection_over_union(self):
+        
+        overall_confusion_matrix = self.get_overall_confusion_matrix()
+        
+        intersection_over_union = self.compute_current_intersection_over_union_per_class()
+        
+        ground_truth_set = overall_confusion_matrix.sum(axis=1)
+        
+        classes_frequencies = ground_truth_set / float(max(ground_truth_set.sum(), 1))
+        
+        present_classes = ground_truth_set > 0
+        
+        return (classes_frequencies[present_classes] * intersection_over_union[present_classes]).sum()
+    
+    def compute_current_pixel_accuracy(self):
+        
+        overall_confusion_matrix = self.get_overall_confusion_matrix()
+        
+        return np.diag(overall_confusion_matrix).sum() / float(max(overall_confusion_matrix.sum(), 1))
+    
+    def compute_current_accuracy_per_class(self):
+        
+        overall_confusion_matrix = self.get_overall_confusion_matrix()
+        
+        with np.errstate(divide='ignore', invalid='ignore'):
+            
+            accuracy = np.diag(overall_confusion_matrix) / overall_confusion_matrix.sum(axis=1).astype(np.float32)
+        
+        return accuracy
+    
+    def compute_current_mean_accuracy(self):
+        
+        return nanmean(self.compute_current_accuracy_per_class())
+    
+    def compute_current_dice_per_class(self):
+        
+        overall_confusion_matrix = self.get_overall_confusion_matrix()
+        
+        intersection = np.diag(overall_confusion_matrix)
+        ground_truth_set = overall_confusion_matrix.sum(axis=1)
+        predicted_set = overall_confusion_matrix.sum(axis=0)
+        
+        with np.errstate(divide='ignore', invalid='ignore'):
+            
+            dice = 2 * intersection / (ground_truth_set + predicted_set).astype(np.float32)
+        
+        return dice
+    
+    def compute_current_mean_dice(self):
+        
+        return nanmean(self.compute_current_dice_per_class())
+    
+    def compute_current_metrics(self):
+        """Returns dict with all of the metrics computed from the current overall confusion matrix"""
+        
+        return {'mean_intersection_over_union': self.compute_current_mean_intersection_over_union(),
+                'intersection_over_union_per_class': self.compute_current_intersection_over_union_per_class(),
+                'frequency_weighted_intersection_over_union': self.compute_current_frequency_weighted_intersection_over_union(),
+                'pixel_accuracy': self.compute_current_pixel_accuracy(),
+                'mean_accuracy': self.compute_current_mean_accuracy(),
+                'accuracy_per_class': self.compute_current_accuracy_per_class(),
+                'mean_dice': self.compute_current_mean_dice(),
+                'dice_per_class': self.compute_current_dice_per_class()}
+
+
+class TorchRunningConfusionMatrix(RunningConfusionMatrix):
+    """Running Confusion Matrix that is accumulated with torch on the device
+    of the inputs -- predictions and groundtruth don't have to be copied to the host
+    after each batch. The overall confusion matrix is kept as a LongTensor on that device
+    and is synchronized only when the metrics are computed.
+    
+    Attributes
+    ----------
+    overall_confusion_matrix : torch.LongTensor of shape (len(labels), len(labels))
+        Container of the sum of all confusion matrices. Used to compute MIOU at the end.
+    """
+    
+    def __init__(self, labels, ignore_label=255):
+        
+        super(TorchRunningConfusionMatrix, self).__init__(labels, ignore_label)
+        
+        self.sorted_labels_tensor = torch.from_numpy(self.sorted_labels)
+        self.labels_sort_order_tensor = torch.from_numpy(self.labels_sort_order)
+    
+    def convert_labels_to_indexes(self, values):
+        
+        if self.labels_are_contiguous:
+            
+            values = values.long()
+            
+            valid_mask = (values >= 0) & (values < self.number_of_classes)
+            
+            return values, valid_mask
+        
+        sorted_labels = self.sorted_labels_tensor.to(values.device)
+        
+        values = values.long()
+        
+        positions = torch.searchsorted(sorted_labels, values).clamp_(max=self.number_of_classes - 1)
+        
+        valid_mask = sorted_labels[positions] == values
+        
+        return self.labels_sort_order_tensor.to(values.device)[positions], valid_mask
+    
+    def update_matrix(self, ground_truth, prediction):
+        """Updates overall confusion matrix statistics without synchronization
+        with the host.
+
+        Parameters
+        ----------
+        groundtruth : torch.LongTensor of shape (B, H, W)
+            Tensor with groundtruth values
+        prediction : torch.Tensor of shape (B, C, H, W) or (B, H, W)
+            Tensor with logits (argmax over classes dimension is taken)
+            or with predicted labels
+        """
+        
+        if prediction.dim() == ground_truth.dim() + 1:
+            
+            prediction = prediction.argmax(dim=1)
+        
+        ground_truth = ground_truth.detach().reshape(-1)
+        prediction = prediction.detach().reshape(-1)
+        
+        # Elements equal to ignore_label are not in the labels and contribute nothing,
+        # so there is no need to check if all of them are ignored
+        current_confusion_matrix = self.compute_confusion_matrix(ground_truth, prediction)
+        
+        self.add_confusion_matrix(current_confusion_matrix)
+    
+    def compute_confusion_matrix(self, ground_truth, prediction):
+        
+        ground_truth_indexes, ground_truth_valid_mask = self.convert_labels_to_indexes(ground_truth)
+        prediction_indexes, prediction_valid_mask = self.convert_labels_to_indexes(prediction)
+        
+        valid_mask = ground_truth_valid_mask & prediction_valid_mask
+        
+        flat_indexes = self.number_of_classes * ground_truth_indexes[valid_mask] + prediction_indexes[valid_mask]
+        
+        current_confusion_matrix = torch.bincount(flat_indexes, minlength=self.number_of_classes ** 2)
+        
+        return current_confusion_matrix.view(self.number_of_classes, self.number_of_classes)
+    
+    def add_confusion_matrix(self, confusion_matrix):
+        
+        if not isinstance(confusion_matrix, torch.Tensor):
+            
+            # Snapshots (for example, merged before the first update) are added
+            # on the device of the accumulator, if there is one
+            device = self.overall_confusion_matrix.device if self.overall_confusion_matrix is not None else 'cpu'
+            
+            confusion_matrix = torch.from_numpy(confusion_matrix).to(device)
+        
+        elif self.overall_confusion_matrix is not None and self.overall_confusion_matrix.device != confusion_matrix.device:
+            
+            # Accumulator follows the device of the updates -- it could have been
+            # created on the host by merging snapshots before the first update
+            self.overall_confusion_matrix = self.overall_confusion_matrix.to(confusion_matrix.device)
+        
+        super(TorchRunningConfusionMatrix, self).add_confusion_matrix(confusion_matrix)
+    
+    def get_overall_confusion_matrix(self):
+        
+        if self.overall_confusion_matrix is None:
+            
+            return super(TorchRunningConfusionMatrix, self).get_overall_confusion_matrix()
+        
+        return self.overall_confusion_matrix.cpu().numpy()
+
 
-        intersection_over_union = intersection / union.astype(np.float32)
-        mean_intersection_over_union = np.mean(intersection_over_union)
+class TrimapRunningConfusionMatrix(RunningConfusionMatrix):
+    """Running Confusion Matrix computed only inside of a band (trimap) of the
+    given width around the boundaries of the groundtruth segments -- metrics
+    computed from it measure the quality of the segmentation near the boundaries.
+    
+    Attributes
+    ----------
+    trimap_width : float
+        Pixels with the euclidean distance to the closest groundtruth boundary
+        bigger than that are ignored.
+    """
+    
+    def __init__(self, labels, ignore_label=255, trimap_width=5):
+        
+        super(TrimapRunningConfusionMatrix, self).__init__(labels, ignore_label)
+        
+        self.trimap_width = trimap_width
+    
+    def update_matrix(self, ground_truth, prediction):
+        """Updates overall confusion matrix statistics.
+
+        Parameters
+        ----------
+        groundtruth : numpy array or torch tensor of shape ([B,] H, W)
+            An array with groundtruth values
+        prediction : numpy array or torch tensor of the same shape
+            An array with predictions
+        """
+        
+        ground_truth = convert_to_numpy_array(ground_truth)
+        prediction = convert_to_numpy_array(prediction)
+        
+        boundaries = compute_label_boundaries(ground_truth)
+        
+        # Distance to the closest boundary is computed separately for each image of the batch
+        trimap = np.empty(boundaries.shape, dtype=np.bool_)
+        
+        for trimap_2d, boundaries_2d in zip(trimap.reshape((-1,) + boundaries.shape[-2:]),
+                                            boundaries.reshape((-1,) + boundaries.shape[-2:])):
+            
+            if boundaries_2d.any():
+                
+                trimap_2d[:] = distance_transform_edt(~boundaries_2d) <= self.trimap_width
+            else:
+                
+                trimap_2d[:] = False
+        
+        ground_truth = np.where(trimap, ground_truth, self.ignore_label)
+        
+        super(TrimapRunningConfusionMatrix, self).update_matrix(ground_truth, prediction)
+
+
+class RunningBoundaryF1Score():
+    """Running Boundary F1 score (BF score) class that accumulates the statistics
+    of the boundaries matches over a dataset.
+    
+    Boundary pixel of the prediction is considered to be matched if it is within the
+    tolerance distance to the groundtruth boundary of the same class and vice versa.
+    Precision and recall for each class are computed from the numbers of matched
+    pixels accumulated over all of the images. Boundary pixels lying on the
+    ignore_label groundtruth pixels are not taken into account.
+    
+    Attributes
+    ----------
+    labels : list[int]
+        List that contains int values that represent classes.
+    ignore_label : int
+        A label representing parts that should be ignored during
+        computation of metrics
+    tolerance : float
+        Maximum distance in pixels between the matched boundary pixels
+    """
+    
+    def __init__(self, labels, ignore_label=255, tolerance=2):
+        
+        self.labels = labels
+        self.ignore_label = ignore_label
+        self.tolerance = tolerance
+        
+        # Statistics for each class: matched prediction boundary pixels,
+        # all prediction boundary pixels, matched groundtruth boundary pixels
+        # and all groundtruth boundary pixels
+        self.boundary_statistics = np.zeros((4, len(labels)), dtype=np.int64)
+    
+    def get_tolerance_offsets(self):
+        """Offsets of the disk of radius tolerance -- offsets with the euclidean
+        distance to the center not bigger than tolerance"""
+        
+        radius = int(np.floor(self.tolerance))
+        
+        offsets = np.arange(-radius, radius + 1)
+        
+        disk = offsets[:, np.newaxis] ** 2 + offsets[np.newaxis, :] ** 2 <= self.tolerance ** 2
+        
+        rows_offsets, cols_offsets = np.nonzero(disk)
+        
+        return list(zip(rows_offsets - radius, cols_offsets - radius))
+    
+    def count_matched_boundary_pixels(self, boundaries, reference_boundaries, tolerance_offsets):
+        """Counts pixels of the boundaries within the tolerance distance to the reference
+        boundaries of the same class for all of the classes at once.
+        
+        Parameters
+        ----------
+        boundaries : numpy bool array of shape (C, H, W)
+            Boundaries of each of the classes
+        reference_boundaries : numpy bool array of shape (C, H, W)
+            Reference boundaries of each of the classes
+        tolerance_offsets : list of (int, int)
+            Offsets returned by get_tolerance_offsets()
+        
+        Returns
+        -------
+        number_of_matched_pixels : numpy array of shape (C,)
+        """
+        
+        height, width = reference_boundaries.shape[-2:]
+        
+        # Dilation of the whole stack by the disk with shifts of the reference boundaries.
+        # Equal to thresholding of the distance transform of each of the reference
+        # boundaries at the tolerance
+        reference_boundaries_neighbourhood = np.zeros_like(reference_boundaries)
+        
+        for row_offset, col_offset in tolerance_offsets:
+            
+            # Shifted boundaries are completely outside of the image
+            if abs(row_offset) >= height or abs(col_offset) >= width:
+                
+                continue
+            
+            reference_boundaries_neighbourhood[:, max(row_offset, 0):height + min(row_offset, 0),
+                                                  max(col_offset, 0):width + min(col_offset, 0)] |= \
+                reference_boundaries[:, max(-row_offset, 0):height + min(-row_offset, 0),
+                                        max(-col_offset, 0):width + min(-col_offset, 0)]
+        
+        return (boundaries & reference_boundaries_neighbourhood).sum(axis=(1, 2))
+    
+    def update(self, ground_truth, prediction):
+        """Updates boundaries statistics.
+
+        Parameters
+        ----------
+        groundtruth : numpy array or torch tensor of shape ([B,] H, W)
+            An array with groundtruth values
+        prediction : numpy array or torch tensor of the same shape
+            An array with predictions
+        """
+        
+        ground_truth = convert_to_numpy_array(ground_truth)
+        prediction = convert_to_numpy_array(prediction)
+        
+        spatial_shape = ground_truth.shape[-2:]
+        
+        labels = np.asarray(self.labels)
+        
+        tolerance_offsets = self.get_tolerance_offsets()
+        
+        # Boundaries are computed for the whole batch at once, stacks of the
+        # boundaries of all the classes -- for each image to limit the memory usage
+        ground_truth = ground_truth.reshape((-1,) + spatial_shape)
+        prediction = prediction.reshape((-1,) + spatial_shape)
+        
+        not_ignored = ground_truth != self.ignore_label
+        
+        ground_truth_boundaries = compute_label_boundaries(ground_truth) & not_ignored
+        prediction_boundaries = compute_label_boundaries(prediction) & not_ignored
+        
+        for ground_truth_2d, prediction_2d, ground_truth_boundaries_2d, prediction_boundaries_2d in zip(
+                ground_truth, prediction, ground_truth_boundaries, prediction_boundaries):
+            
+            # Only the classes that have boundaries in this image
+            present_labels_mask = np.isin(labels, ground_truth_2d[ground_truth_boundaries_2d]) | \
+                                  np.isin(labels, prediction_2d[prediction_boundaries_2d])
+            
+            if not present_labels_mask.any():
+                
+                continue
+            
+            present_labels = labels[present_labels_mask][:, np.newaxis, np.newaxis]
+            
+            # (C, H, W) stacks of boundaries of each of the present classes
+            ground_truth_classes_boundaries = ground_truth_boundaries_2d & (ground_truth_2d == present_labels)
+            prediction_classes_boundaries = prediction_boundaries_2d & (prediction_2d == present_labels)
+            
+            self.boundary_statistics[:, present_labels_mask] += [
+                self.count_matched_boundary_pixels(prediction_classes_boundaries, ground_truth_classes_boundaries, tolerance_offsets),
+                prediction_classes_boundaries.sum(axis=(1, 2)),
+                self.count_matched_boundary_pixels(ground_truth_classes_boundaries, prediction_classes_boundaries, tolerance_offsets),
+                ground_truth_classes_boundaries.sum(axis=(1, 2))]
+    
+    def snapshot(self):
+        
+        return self.boundary_statistics.copy()
+    
+    def merge(self, other):
+        
+        if isinstance(other, RunningBoundaryF1Score):
+            
+            other = other.snapshot()
+        
+        self.boundary_statistics += other
+    
+    def reset(self):
+        
+        self.boundary_statistics[:] = 0
+    
+    def compute_current_boundary_f1_score_per_class(self):
+        """Boundary F1 score for each class, NaN for classes that have no boundaries
+        both in the groundtruth and in the predictions"""
+        
+        matched_prediction, prediction, matched_ground_truth, ground_truth = self.boundary_statistics.astype(np.float64)
+        
+        with np.errstate(divide='ignore', invalid='ignore'):
+            
+            precision = np.where(prediction > 0, matched_prediction / prediction, 0)
+            recall = np.where(ground_truth > 0, matched_ground_truth / ground_truth, 0)
+            
+            f1_score = np.where(precision + recall > 0, 2 * precision * recall / (precision + recall), 0)
+        
+        f1_score[(prediction == 0) & (ground_truth == 0)] = np.nan
+        
+        return f1_score
+    
+    def compute_current_mean_boundary_f1_score(self):
+        
+        return nanmean(self.compute_current_boundary_f1_score_per_class())
+
+
+class RunningInstanceIntersectionOverUnion():
+    """Running per-instance IoU class that accumulates the statistics of the
+    groundtruth instances over a dataset.
+    
+    Each groundtruth instance is matched to the predicted instance with the biggest
+    IoU with it (0 if it doesn't intersect any), the IoUs are averaged over all of the
+    groundtruth instances of the dataset. Number of instances with IoU above the
+    match_threshold is counted as well.
+    
+    Attributes
+    ----------
+    background_label : int
+        Label of the pixels that don't belong to any instance, both in the
+        groundtruth and in the predictions
+    ignore_label : int
+        A label of the groundtruth representing parts that should be ignored during
+        computation of metrics
+    match_threshold : float
+        Instance is considered to be detected if its IoU is bigger than that
+    """
+    
+    def __init__(self, background_label=0, ignore_label=255, match_threshold=0.5):
+        
+        self.background_label = background_label
+        self.ignore_label = ignore_label
+        self.match_threshold = match_threshold
+        
+        # Sum of IoUs of all of the groundtruth instances, number of the groundtruth
+        # instances and number of the instances with IoU above the match_threshold
+        self.instance_statistics = np.zeros(3, dtype=np.float64)
+    
+    def compute_instances_intersection_over_union(self, ground_truth, prediction):
+        """Computes best IoU of each groundtruth instance of a single image.
+        
+        Intersections of all pairs of the groundtruth and predicted instances are
+        counted with a single bincount over the pairs of their indexes.
+        
+        Parameters
+        ----------
+        ground_truth : numpy array of shape (H, W)
+            Map of the groundtruth instances ids
+        prediction : numpy array of shape (H, W)
+            Map of the predicted instances ids
+        
+        Returns
+        -------
+        intersection_over_union : numpy array of shape (number of groundtruth instances,)
+        """
+        
+        not_ignored = ground_truth != self.ignore_label
+        
+        ground_truth_ids, ground_truth_indexes = np.unique(ground_truth[not_ignored], return_inverse=True)
+        prediction_ids, prediction_indexes = np.unique(prediction[not_ignored], return_inverse=True)
+        
+        number_of_predicted_instances = prediction_ids.size
+        
+        intersections = np.bincount(ground_truth_indexes.ravel() * number_of_predicted_instances + prediction_indexes.ravel(),
+                                    minlength=ground_truth_ids.size * number_of_predicted_instances)
+        
+        intersections = intersections.reshape(ground_truth_ids.size, number_of_predicted_instances)
+        
+        unions = intersections.sum(axis=1, keepdims=True) + intersections.sum(axis=0, keepdims=True) - intersections
+        
+        intersection_over_union = intersections / np.maximum(unions, 1)
+        
+        # Background is neither a groundtruth nor a predicted instance
+        intersection_over_union[:, prediction_ids == self.background_label] = 0
+        
+        intersection_over_union = intersection_over_union[ground_truth_ids != self.background_label]
+        
+        if number_of_predicted_instances == 0:
+            
+            return np.zeros(intersection_over_union.shape[0])
+        
+        return intersection_over_union.max(axis=1)
+    
+    def update(self, ground_truth, prediction):
+        """Updates instances statistics.
+
+        Parameters
+        ----------
+        groundtruth : numpy array or torch tensor of shape ([B,] H, W)
+            An array with groundtruth instances ids
+        prediction : numpy array or torch tensor of the same shape
+            An array with predicted instances ids
+        """
+        
+        ground_truth = convert_to_numpy_array(ground_truth)
+        prediction = convert_to_numpy_array(prediction)
+        
+        spatial_shape = ground_truth.shape[-2:]
+        
+        for ground_truth_2d, prediction_2d in zip(ground_truth.reshape((-1,) + spatial_shape),
+                                                  prediction.reshape((-1,) + spatial_shape)):
+            
+            intersection_over_union = self.compute_instances_intersection_over_union(ground_truth_2d, prediction_2d)
+            
+            self.instance_statistics += [intersection_over_union.sum(),
+                                         intersection_over_union.size,
+                                         (intersection_over_union > self.match_threshold).sum()]
+    
+    def snapshot(self):
+        
+        return self.instance_statistics.copy()
+    
+    def merge(self, other):
+        
+        if isinstance(other, RunningInstanceIntersectionOverUnion):
+            
+            other = other.snapshot()
+        
+        self.instance_statistics += other
+    
+    def reset(self):
+        
+        self.instance_statistics[:] = 0
+    
+    def compute_current_mean_instance_intersection_over_union(self):
+        """Mean IoU over all of the groundtruth instances, NaN if there were none"""
+        
+        iou_sum, number_of_instances, _ = self.instance_statistics
+        
+        return iou_sum / number_of_instances if number_of_instances > 0 else np.nan
+    
+    def compute_current_instance_detection_rate(self):
+        """Fraction of the groundtruth instances with IoU above the match_threshold"""
+        
+        _, number_of_instances, number_of_matched_instances = self.instance_statistics
         
-        return mean_intersection_over_union
\ No newline at end of file
+        return number_of_matched_instances / number_of_instances if number_of_instances > 0 else np.nan
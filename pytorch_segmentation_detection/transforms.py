@@ -1,3 +1,4 @@
+import math
 import random
 import numbers
 import collections
@@ -123,22 +124,77 @@ def pad_to_fit_tiles_pil(image, tile_size):
     return adjusted_img, adjusted_size_in_pixels, adjusted_size_in_tiles
 
 
-def convert_labels_to_one_hot_encoding(labels, number_of_classes):
-
+def convert_labels_to_one_hot_encoding(labels,
+                                       number_of_classes,
+                                       dtype=torch.uint8,
+                                       class_dim=-1,
+                                       ignore_label=None,
+                                       out=None):
+    """Converts tensor with labels to one-hot encoding.
+    
+    The output is allocated directly with the requested dtype, so that
+    bool/uint8 output takes 1 byte per class per element.
+    
+    Parameters
+    ----------
+    labels : torch.LongTensor of any shape, for example (B, H, W)
+    
+    number_of_classes : int
+    
+    dtype : torch.dtype
+        Dtype of the output, for example torch.bool, torch.uint8 or torch.float16
+        
+    class_dim : int
+        Position of the classes dimension in the output -- last one by default,
+        1 gives (B, C, H, W) output for (B, H, W) labels.
+        
+    ignore_label : int or None
+        Elements with this label get all-zero encoding. Otherwise, all of
+        the labels have to be in [0, number_of_classes) range.
+        
+    out : torch.Tensor or None
+        Preallocated output tensor of the right shape
+        
+    Returns
+    -------
+    one_hot_encoding : torch.Tensor
+    """
+    
     labels_dims_number = labels.dim()
-
+    
+    if class_dim < 0:
+        
+        class_dim += labels_dims_number + 1
+    
     # Add a singleton dim -- we need this for scatter
-    labels_ = labels.unsqueeze(labels_dims_number)
+    labels_ = labels.unsqueeze(class_dim)
     
-    # We add one more dim to the end of tensor with the size of 'number_of_classes'
+    # We add one more dim to the tensor with the size of 'number_of_classes'
     one_hot_shape = list(labels.size())
-    one_hot_shape.append(number_of_classes)
-    one_hot_encoding = torch.zeros(one_hot_shape).type(labels.type())
+    one_hot_shape.insert(class_dim, number_of_classes)
     
-    # Filling out the tensor with ones
-    one_hot_encoding.scatter_(dim=labels_dims_number, index=labels_, value=1)
+    if out is None:
+        
+        one_hot_encoding = torch.zeros(one_hot_shape, dtype=dtype, device=labels.device)
+    else:
+        
+        one_hot_encoding = out.zero_()
     
-    return one_hot_encoding.byte()
+    if ignore_label is None:
+        
+        # Filling out the tensor with ones
+        one_hot_encoding.scatter_(dim=class_dim, index=labels_, value=1)
+        
+        return one_hot_encoding
+    
+    # Ignored elements scatter zeros into the class 0 which keeps them all-zero
+    valid_labels_mask = labels_ != ignore_label
+    
+    one_hot_encoding.scatter_(dim=class_dim,
+                              index=labels_.masked_fill(~valid_labels_mask, 0),
+                              src=valid_labels_mask.to(one_hot_encoding.dtype))
+    
+    return one_hot_encoding
 
 
 class ComposeJoint(object):
@@ -468,4 +524,616 @@ class RandomRotation(object):
         result = F.rotate(inputs[-1], angle, Image.NEAREST, self.expand, self.center)
         results.append(result)
         
-        return results
\ No newline at end of file
+        return results
+
+
+def transform_bboxes_center_xywh(bboxes_center_xywh, affine_matrix):
+    """Applies affine transformation to bounding boxes in center_xywh format.
+    
+    The four corners of each box are transformed with a single matrix product
+    and the axis-aligned box enclosing them is returned. This way a chain
+    of flips, scales, crops, pads and rotations costs one pass over the boxes.
+    
+    Parameters
+    ----------
+    bboxes_center_xywh : torch.FloatTensor of size (N, 4)
+        Tensor containing bounding boxes defined in center_xywh format
+        
+    affine_matrix : numpy array of size (3, 3)
+        Affine transformation matrix operating on homogeneous (x, y, 1) coordinates
+        
+    Returns
+    -------
+    transformed_bboxes_center_xywh : torch.FloatTensor of size (N, 4)
+    """
+    
+    affine_matrix = torch.from_numpy(np.asarray(affine_matrix, dtype=np.float64)).to(bboxes_center_xywh.dtype)
+    
+    centers = bboxes_center_xywh[:, None, :2]
+    half_sizes = bboxes_center_xywh[:, None, 2:] / 2
+    
+    # corners: (N, 4, 2) -- top left, top right, bottom right, bottom left
+    corners_signs = bboxes_center_xywh.new_tensor([[-1, -1], [1, -1], [1, 1], [-1, 1]])
+    corners = centers + corners_signs * half_sizes
+    
+    transformed_corners = torch.matmul(corners, affine_matrix[:2, :2].t()) + affine_matrix[:2, 2]
+    
+    top_left = transformed_corners.min(dim=1)[0]
+    bottom_right = transformed_corners.max(dim=1)[0]
+    
+    return torch.cat(((top_left + bottom_right) / 2, bottom_right - top_left), dim=1)
+
+
+def get_translation_matrix(x, y):
+    
+    return np.array([[1, 0, x],
+                     [0, 1, y],
+                     [0, 0, 1]], dtype=np.float64)
+
+
+def get_scale_matrix(x_scale, y_scale):
+    
+    return np.array([[x_scale, 0, 0],
+                     [0, y_scale, 0],
+                     [0, 0, 1]], dtype=np.float64)
+
+
+def get_rotation_matrix(angle, center):
+    """Matrix of the counter-clockwise rotation by angle (in degrees)
+    around the center in image coordinates (y axis pointing down),
+    same as PIL.Image.rotate()"""
+    
+    angle_radians = np.deg2rad(angle)
+    cos, sin = np.cos(angle_radians), np.sin(angle_radians)
+    
+    rotation = np.array([[cos, sin, 0],
+                         [-sin, cos, 0],
+                         [0, 0, 1]], dtype=np.float64)
+    
+    return get_translation_matrix(*center).dot(rotation).dot(get_translation_matrix(-center[0], -center[1]))
+
+
+# Box-aware joint transforms -- all of them accept a list of PIL images
+# followed by a torch.FloatTensor of size (N, 4) with bounding boxes
+# in center_xywh format as the last element, for example [image, bboxes_center_xywh]
+# or [image, annotation, bboxes_center_xywh]. The same transformation is applied
+# to all of the images and the boxes coordinates are updated accordingly.
+
+class RandomHorizontalFlipJointWithBoxes(object):
+    
+    def __call__(self, inputs):
+        
+        if random.random() < 0.5:
+            
+            images, bboxes_center_xywh = inputs[:-1], inputs[-1]
+            
+            width = images[0].size[0]
+            
+            flip_matrix = get_translation_matrix(width, 0).dot(get_scale_matrix(-1, 1))
+            
+            outputs = list(map(lambda single_input:  ImageOps.mirror(single_input), images) )
+            outputs.append(transform_bboxes_center_xywh(bboxes_center_xywh, flip_matrix))
+            
+            return outputs
+        
+        return inputs
+
+
+class RandomScaleJointWithBoxes(RandomScaleJoint):
+    
+    def __call__(self, inputs):
+        
+        images, bboxes_center_xywh = inputs[:-1], inputs[-1]
+        
+        width, height = images[0].size
+        
+        outputs = super(RandomScaleJointWithBoxes, self).__call__(images)
+        
+        new_width, new_height = outputs[0].size
+        
+        scale_matrix = get_scale_matrix(new_width / float(width), new_height / float(height))
+        
+        outputs.append(transform_bboxes_center_xywh(bboxes_center_xywh, scale_matrix))
+        
+        return outputs
+
+
+class RandomCropJointWithBoxes(RandomCropJoint):
+    
+    def __call__(self, inputs):
+        
+        images, bboxes_center_xywh = inputs[:-1], inputs[-1]
+        
+        # Same offsets as in pad_to_size()
+        input_size = np.asarray(images[0].size)
+        
+        pad_offset = np.maximum(np.asarray(self.crop_size) - input_size, 0) // 2
+        
+        padded_inputs = list( map(lambda pair: pad_to_size(pair[0], self.crop_size, pair[1]), zip(images, self.pad_values)) )
+        
+        w, h = padded_inputs[0].size
+        
+        th, tw = self.crop_size
+        
+        x1, y1 = 0, 0
+        
+        if w != tw or h != th:
+            
+            x1 = random.randint(0, w - tw)
+            y1 = random.randint(0, h - th)
+            
+            padded_inputs = list( map(lambda single_input: single_input.crop((x1, y1, x1 + tw, y1 + th)), padded_inputs) )
+        
+        # Padding and cropping are merged into a single translation
+        crop_matrix = get_translation_matrix(pad_offset[0] - x1, pad_offset[1] - y1)
+        
+        padded_inputs.append(transform_bboxes_center_xywh(bboxes_center_xywh, crop_matrix))
+        
+        return padded_inputs
+
+
+class CropOrPadJointWithBoxes(object):
+    
+    def __init__(self, output_size, fills=[0, 255]):
+        
+        self.output_size = output_size
+        self.fills = fills
+        
+    def __call__(self, inputs):
+        
+        images, bboxes_center_xywh = inputs[:-1], inputs[-1]
+        
+        # Same position as in CropOrPad
+        input_position = (np.asarray(self.output_size) // 2) - (np.asarray(images[0].size) // 2)
+        
+        outputs = list( map(lambda pair: CropOrPad(self.output_size, pair[1])(pair[0]), zip(images, self.fills)) )
+        
+        outputs.append(transform_bboxes_center_xywh(bboxes_center_xywh, get_translation_matrix(*input_position)))
+        
+        return outputs
+
+
+class RandomRotationJointWithBoxes(RandomRotation):
+    """Rotates all of the images by the same random angle and updates
+    the bounding boxes -- the boxes enclosing the rotated boxes are returned.
+    Bilinear interpolation is used for the first image and nearest for the rest.
+    """
+    
+    def __call__(self, inputs):
+        
+        images, bboxes_center_xywh = inputs[:-1], inputs[-1]
+        
+        width, height = images[0].size
+        
+        angle = self.get_params(self.degrees)
+        
+        outputs = []
+        
+        for index, input in enumerate(images):
+            
+            resample = Image.BILINEAR if index == 0 else Image.NEAREST
+            
+            outputs.append(F.rotate(input, angle, resample, self.expand, self.center))
+        
+        center = self.center if self.center is not None else (width / 2.0, height / 2.0)
+        
+        rotation_matrix = get_rotation_matrix(angle, center)
+        
+        if self.expand:
+            
+            # Expanded image is centered around the rotated one
+            new_width, new_height = outputs[0].size
+            
+            rotation_matrix = get_translation_matrix((new_width - width) / 2.0, (new_height - height) / 2.0).dot(rotation_matrix)
+        
+        outputs.append(transform_bboxes_center_xywh(bboxes_center_xywh, rotation_matrix))
+        
+        return outputs
+
+
+# NumPy backend for joint transforms -- inputs are uint8 numpy arrays of size (H, W)
+# or (H, W, C), uint8 torch tensors of size (H, W) or (C, H, W) or PIL images.
+# Flips and crops return views of the inputs without copying the data and
+# scale, rotation and crop are folded into a single affine warp per input.
+# Outputs are numpy arrays that can be converted to tensors with NumpyToTensor.
+
+def convert_to_numpy_array(input):
+    """Returns numpy view of the input of size (H, W) or (H, W, C)
+    without copying the data, if possible"""
+    
+    if isinstance(input, torch.Tensor):
+        
+        if input.dim() == 3:
+            
+            return input.permute(1, 2, 0).numpy()
+        
+        return input.numpy()
+    
+    return np.asarray(input)
+
+
+def crop_or_pad_numpy(input_array, x, y, width, height, fill=0):
+    """Crops the (width, height) window with the top left corner at (x, y).
+    
+    The window can be partially or fully outside of the input array -- the
+    outside area is filled with the fill value. If the window is inside
+    of the input array, view of the input is returned.
+    """
+    
+    input_height, input_width = input_array.shape[:2]
+    
+    if x >= 0 and y >= 0 and x + width <= input_width and y + height <= input_height:
+        
+        return input_array[y:y + height, x:x + width]
+    
+    output = np.full((height, width) + input_array.shape[2:], fill, dtype=input_array.dtype)
+    
+    # Overlap of the window and the input in the input coordinates
+    overlap_x_start, overlap_y_start = max(x, 0), max(y, 0)
+    overlap_x_end, overlap_y_end = min(x + width, input_width), min(y + height, input_height)
+    
+    if overlap_x_start < overlap_x_end and overlap_y_start < overlap_y_end:
+        
+        output[overlap_y_start - y:overlap_y_end - y,
+               overlap_x_start - x:overlap_x_end - x] = input_array[overlap_y_start:overlap_y_end,
+                                                                    overlap_x_start:overlap_x_end]
+    
+    return output
+
+
+def warp_affine_numpy(input_array, affine_matrix, output_size, resample=Image.BILINEAR, fill=0):
+    """Warps the input array with the affine matrix in a single resampling call.
+    
+    Parameters
+    ----------
+    input_array : uint8 numpy array of size (H, W) or (H, W, C)
+    
+    affine_matrix : numpy array of size (3, 3)
+        Matrix mapping the input (x, y, 1) coordinates to the output ones
+        
+    output_size : tuple of ints
+        Width and height of the output
+        
+    Returns
+    -------
+    output_array : uint8 numpy array of size (height, width[, C])
+    """
+    
+    # PIL expects the inverse mapping -- from output to input coordinates
+    inverse_affine_matrix = np.linalg.inv(affine_matrix)
+    
+    number_of_channels = input_array.shape[2] if input_array.ndim == 3 else 1
+    
+    fill_color = fill if number_of_channels == 1 else (fill,) * number_of_channels
+    
+    output = Image.fromarray(input_array).transform(tuple(output_size),
+                                                    Image.AFFINE,
+                                                    data=tuple(inverse_affine_matrix[:2].ravel()),
+                                                    resample=resample,
+                                                    fillcolor=fill_color)
+    
+    return np.asarray(output)
+
+
+class RandomHorizontalFlipJointNumpy(object):
+    
+    def __call__(self, inputs):
+        
+        inputs = list(map(convert_to_numpy_array, inputs))
+        
+        if random.random() < 0.5:
+            
+            return list(map(lambda single_input: single_input[:, ::-1], inputs))
+        
+        return inputs
+
+
+class RandomCropJointNumpy(RandomCropJoint):
+    
+    def __call__(self, inputs):
+        
+        inputs = list(map(convert_to_numpy_array, inputs))
+        
+        h, w = inputs[0].shape[:2]
+        
+        th, tw = self.crop_size
+        
+        # Inputs smaller than the crop are centered same as in pad_to_size()
+        x1 = random.randint(0, w - tw) if w > tw else (w - tw) // 2
+        y1 = random.randint(0, h - th) if h > th else (h - th) // 2
+        
+        return list( map(lambda pair: crop_or_pad_numpy(pair[0], x1, y1, tw, th, pair[1]), zip(inputs, self.pad_values)) )
+
+
+class CropOrPadNumpy(CropOrPad):
+    
+    def __call__(self, input):
+        
+        input = convert_to_numpy_array(input)
+        
+        input_size = np.asarray(input.shape[1::-1])
+        
+        # Same position as in CropOrPad
+        input_position = (np.asarray(self.output_size) // 2) - (input_size // 2)
+        
+        return crop_or_pad_numpy(input, -input_position[0], -input_position[1],
+                                 self.output_size[0], self.output_size[1], self.fill)
+
+
+class RandomAffineJointNumpy(object):
+    """Random horizontal flip, scale, rotation and crop folded into a single affine warp.
+    
+    Equivalent to the sequence of RandomHorizontalFlipJoint, RandomScaleJoint,
+    RandomRotation and RandomCropJoint, but each input is resampled only once.
+    If no scaling or rotation is performed, only views of the inputs are returned.
+    """
+    
+    def __init__(self,
+                 crop_size,
+                 scale_range=(1.0, 1.0),
+                 degrees=0,
+                 horizontal_flip=True,
+                 interpolations=[Image.BILINEAR, Image.NEAREST],
+                 fill_values=[0, 255]):
+        
+        if isinstance(crop_size, numbers.Number):
+            
+            self.crop_size = (int(crop_size), int(crop_size))
+        else:
+            
+            self.crop_size = crop_size
+        
+        if isinstance(degrees, numbers.Number):
+            
+            degrees = (-degrees, degrees)
+            
+        self.scale_range = scale_range
+        self.degrees = degrees
+        self.horizontal_flip = horizontal_flip
+        self.interpolations = interpolations
+        self.fill_values = fill_values
+    
+    
+    def get_affine_matrix(self, input_size):
+        """Returns random affine matrix for the input of (width, height) size"""
+        
+        width, height = input_size
+        
+        th, tw = self.crop_size
+        
+        affine_matrix = np.eye(3)
+        
+        if self.horizontal_flip and random.random() < 0.5:
+            
+            affine_matrix = get_translation_matrix(width, 0).dot(get_scale_matrix(-1, 1))
+        
+        ratio = random.uniform(*self.scale_range)
+        
+        # Same size as in RandomScaleJoint
+        scaled_width, scaled_height = int(ratio * width), int(ratio * height)
+        
+        affine_matrix = get_scale_matrix(scaled_width / float(width), scaled_height / float(height)).dot(affine_matrix)
+        
+        angle = random.uniform(*self.degrees)
+        
+        if angle != 0:
+            
+            affine_matrix = get_rotation_matrix(angle, (scaled_width / 2.0, scaled_height / 2.0)).dot(affine_matrix)
+        
+        x1 = random.randint(0, scaled_width - tw) if scaled_width > tw else (scaled_width - tw) // 2
+        y1 = random.randint(0, scaled_height - th) if scaled_height > th else (scaled_height - th) // 2
+        
+        return get_translation_matrix(-x1, -y1).dot(affine_matrix)
+    
+    
+    def __call__(self, inputs):
+        
+        inputs = list(map(convert_to_numpy_array, inputs))
+        
+        height, width = inputs[0].shape[:2]
+        
+        th, tw = self.crop_size
+        
+        affine_matrix = self.get_affine_matrix((width, height))
+        
+        linear_part = affine_matrix[:2, :2]
+        
+        # Flip and integer translation only -- no resampling is needed
+        if np.abs(linear_part[0, 1]) + np.abs(linear_part[1, 0]) == 0 and linear_part[1, 1] == 1 and np.abs(linear_part[0, 0]) == 1:
+            
+            flipped = linear_part[0, 0] < 0
+            
+            x1 = int(round(-affine_matrix[0, 2])) if not flipped else int(round(width - affine_matrix[0, 2]))
+            y1 = int(round(-affine_matrix[1, 2]))
+            
+            def crop_input(pair):
+                
+                input, fill = pair
+                
+                if flipped:
+                    
+                    input = input[:, ::-1]
+                
+                return crop_or_pad_numpy(input, x1, y1, tw, th, fill)
+            
+            return list(map(crop_input, zip(inputs, self.fill_values)))
+        
+        return list( map(lambda triple: warp_affine_numpy(triple[0], affine_matrix, (tw, th), triple[1], triple[2]),
+                         zip(inputs, self.interpolations, self.fill_values)) )
+    
+
+class NumpyToTensor(object):
+    """Converts numpy array of size (H, W, C) or (H, W) to a tensor
+    with a single copy. Images are converted to float tensors of size (C, H, W)
+    in [0, 1] range same as torchvision.transforms.ToTensor and annotations
+    (normalize=False) to LongTensor of size (H, W).
+    """
+    
+    def __init__(self, normalize=True):
+        
+        self.normalize = normalize
+        
+    def __call__(self, input):
+        
+        input = convert_to_numpy_array(input)
+        
+        if not self.normalize:
+            
+            return torch.from_numpy(input.astype(np.int64))
+        
+        if input.ndim == 2:
+            
+            input = input[:, :, None]
+        
+        # Negative strides of the flipped views are resolved here
+        tensor = torch.from_numpy(np.ascontiguousarray(input.transpose(2, 0, 1)))
+        
+        return tensor.float().div_(255)
+
+
+class BatchRandomAffineJoint(object):
+    """Random horizontal flip, scale, rotation and crop of a whole batch.
+    
+    Runs after collation on (B, C, H, W) images and (B, H, W) annotations,
+    on the GPU or on the CPU, so that DataLoader workers only have to decode
+    the samples. Each sample of the batch gets its own random parameters, which
+    are sampled the same way as in RandomAffineJointNumpy, and all of the warps
+    are performed with one affine_grid/grid_sample call per batch.
+    Images are sampled bilinearly and annotations with the nearest neighbour,
+    areas outside of the input are filled with image_fill and ignore_label.
+    """
+    
+    def __init__(self,
+                 crop_size,
+                 scale_range=(1.0, 1.0),
+                 degrees=0,
+                 horizontal_flip=True,
+                 image_fill=0,
+                 ignore_label=255):
+        
+        if isinstance(crop_size, numbers.Number):
+            
+            self.crop_size = (int(crop_size), int(crop_size))
+        else:
+            
+            self.crop_size = crop_size
+        
+        if isinstance(degrees, numbers.Number):
+            
+            degrees = (-degrees, degrees)
+            
+        self.scale_range = scale_range
+        self.degrees = degrees
+        self.horizontal_flip = horizontal_flip
+        self.image_fill = image_fill
+        self.ignore_label = ignore_label
+    
+    
+    def get_affine_matrices(self, batch_size, input_size):
+        """Returns random affine matrices of size (B, 3, 3) mapping
+        input pixel coordinates to the output ones"""
+        
+        width, height = input_size
+        
+        th, tw = self.crop_size
+        
+        flip = torch.rand(batch_size) < 0.5 if self.horizontal_flip else torch.zeros(batch_size, dtype=torch.bool)
+        
+        ratio = torch.empty(batch_size, dtype=torch.float64).uniform_(*self.scale_range)
+        
+        # Same size as in RandomScaleJoint
+        scaled_width = (ratio * width).floor()
+        scaled_height = (ratio * height).floor()
+        
+        angle = torch.empty(batch_size, dtype=torch.float64).uniform_(*self.degrees) * (math.pi / 180)
+        
+        # Random crop offsets, outputs bigger than the scaled input are centered
+        x1 = torch.where(scaled_width > tw,
+                         (torch.rand(batch_size, dtype=torch.float64) * (scaled_width - tw + 1)).floor(),
+                         ((scaled_width - tw) / 2).floor())
+        
+        y1 = torch.where(scaled_height > th,
+                         (torch.rand(batch_size, dtype=torch.float64) * (scaled_height - th + 1)).floor(),
+                         ((scaled_height - th) / 2).floor())
+        
+        x_scale = (scaled_width / width) * (1 - 2 * flip.double())
+        y_scale = scaled_height / height
+        
+        x_translation = torch.where(flip, scaled_width, torch.zeros_like(scaled_width))
+        
+        # Flip and scale followed by the rotation around the center of the scaled input
+        cos, sin = torch.cos(angle), torch.sin(angle)
+        
+        center_x, center_y = scaled_width / 2, scaled_height / 2
+        
+        affine_matrices = torch.zeros(batch_size, 3, 3, dtype=torch.float64)
+        
+        affine_matrices[:, 0, 0] = cos * x_scale
+        affine_matrices[:, 0, 1] = sin * y_scale
+        affine_matrices[:, 1, 0] = -sin * x_scale
+        affine_matrices[:, 1, 1] = cos * y_scale
+        
+        affine_matrices[:, 0, 2] = cos * (x_translation - center_x) + sin * (-center_y) + center_x - x1
+        affine_matrices[:, 1, 2] = -sin * (x_translation - center_x) + cos * (-center_y) + center_y - y1
+        affine_matrices[:, 2, 2] = 1
+        
+        return affine_matrices
+    
+    
+    def get_sampling_grid(self, affine_matrices, input_size, device):
+        
+        width, height = input_size
+        
+        th, tw = self.crop_size
+        
+        batch_size = affine_matrices.size(0)
+        
+        # affine_grid() works with the mapping from the normalized output coordinates
+        # to the normalized input coordinates (align_corners=False convention)
+        output_denormalization = affine_matrices.new_tensor([[tw / 2.0, 0, tw / 2.0],
+                                                             [0, th / 2.0, th / 2.0],
+                                                             [0, 0, 1]])
+        
+        input_normalization = affine_matrices.new_tensor([[2.0 / width, 0, -1],
+                                                          [0, 2.0 / height, -1],
+                                                          [0, 0, 1]])
+        
+        theta = torch.matmul(input_normalization, torch.matmul(torch.inverse(affine_matrices), output_denormalization))
+        
+        theta = theta[:, :2].float().to(device)
+        
+        return torch.nn.functional.affine_grid(theta, (batch_size, 1, th, tw), align_corners=False)
+    
+    
+    def __call__(self, images, annotations):
+        """
+        Parameters
+        ----------
+        images : torch.FloatTensor of size (B, C, H, W)
+        
+        annotations : torch.LongTensor of size (B, H, W)
+        
+        Returns
+        -------
+        images : torch.FloatTensor of size (B, C, crop_height, crop_width)
+        
+        annotations : torch.LongTensor of size (B, crop_height, crop_width)
+        """
+        
+        batch_size, _, height, width = images.size()
+        
+        affine_matrices = self.get_affine_matrices(batch_size, (width, height))
+        
+        grid = self.get_sampling_grid(affine_matrices, (width, height), images.device)
+        
+        # Out of input samples are zero-filled, so fill values are subtracted
+        # before the sampling and added back afterwards
+        images = torch.nn.functional.grid_sample(images - self.image_fill, grid.to(images.dtype),
+                                                 mode='bilinear', padding_mode='zeros', align_corners=False)
+        images += self.image_fill
+        
+        annotations = torch.nn.functional.grid_sample((annotations - self.ignore_label).unsqueeze(1).float(), grid,
+                                                      mode='nearest', padding_mode='zeros', align_corners=False)
+        annotations = annotations.squeeze(1).long() + self.ignore_label
+        
+        return images, annotations
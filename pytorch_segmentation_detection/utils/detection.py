@@ -1,6 +1,7 @@
 import torch
 import math
 import random
+import collections
 import numpy as np
 
 from matplotlib import pyplot as plt
@@ -52,45 +53,282 @@ def random_crop_with_bounding_boxes(input_img, crop_size, bboxes_center_xywh, fi
 
     res_img_pil = padded_img_pil.crop((x1, y1, x1 + tw, y1 + th))
 
-    padded_bboxes_center_xyxy = convert_bbox_center_xywh_tensor_to_xyxy(padded_bboxes_center_xywh)
-
-    padded_bboxes_center_xyxy_cropped = padded_bboxes_center_xyxy - torch.Tensor([x1,y1,x1,y1])
+    # Cropping only shifts the centers of the boxes, so there is no need to convert
+    # them into other formats. The padded boxes are a fresh copy and can be updated in-place.
+    padded_bboxes_center_xywh_cropped = BoundingBoxes(padded_bboxes_center_xywh, 'center_xywh').translate_(-x1, -y1).tensor
     #padded_bboxes_center_xyxy_cropped[:,0::2].clamp_(min=0, max=tw-1)
     #padded_bboxes_center_xyxy_cropped[:,1::2].clamp_(min=0, max=th-1)
-
-    padded_bboxes_center_xywh_cropped = convert_bbox_xyxy_tensor_to_center_xywh(padded_bboxes_center_xyxy_cropped)
     
     return res_img_pil, padded_bboxes_center_xywh_cropped
 
 
-def convert_bbox_xyxy_tensor_to_center_xywh(bbox_xyxy_tensor):
-    """Function to convert bounding boxes in format (x_center, y_center, width, height)
-    to a format of (x_min, y_min, x_max, y_max).
+def convert_bbox_xyxy_tensor_to_center_xywh(bbox_xyxy_tensor, out=None):
+    """Function to convert bounding boxes in format (x_min, y_min, x_max, y_max)
+    to a format of (x_center, y_center, width, height).
     
     Works with a tensors of a (N, 4) shape.
     
     Parameters
     ----------
-    bbox_xywh_tensor : FloatTensor of shape (N, 4)
-        Tensor with bounding boxes in center_xywh format
+    bbox_xyxy_tensor : FloatTensor of shape (N, 4)
+        Tensor with bounding boxes in xyxy format
+        
+    out : FloatTensor of shape (N, 4) or None
+        Preallocated tensor to write the result into
         
     Returns
     -------
-    bbox_xyxy_tensor : FloatTensor of shape (N, 4)
+    bbox_center_xywh_tensor : FloatTensor of shape (N, 4)
+        Tensor with bounding boxes in center_xywh format
+    """
+    
+    return convert_bbox_format(bbox_xyxy_tensor, 'xyxy', 'center_xywh', out=out)
+
+
+def compute_bboxes_overlaps(bboxes_xyxy_group_1, bboxes_xyxy_group_2, mode='union'):
+    """Function to compute the overlap metric for each pair of rectangles
+    from bboxes_group_1 and bboxes_group_2.
+    
+    Parameters
+    ----------
+    bboxes_xyxy_group_1 : FloatTensor of shape (N, 4)
         Tensor with bounding boxes in xyxy format
+        
+    bboxes_xyxy_group_2 : FloatTensor of shape (M, 4)
+        Tensor with bounding boxes in xyxy format
+        
+    mode : string
+        'union' computes intersection over union, 'min' computes intersection
+        over the area of the smaller box of each pair.
+        
+    Returns
+    -------
+    overlaps : FloatTensor of shape (N, M)
+        Tensor with overlap metric computed between all possible pairs
+        from group 1 and 2
     """
     
-    bbox_center_xywh_tensor = bbox_xyxy_tensor.clone()
+    if mode == 'union':
+        
+        return compute_bboxes_ious(bboxes_xyxy_group_1, bboxes_xyxy_group_2)
     
-    # Getting top left corner
-    bbox_center_xywh_tensor[:, 0] = (bbox_xyxy_tensor[:, 0] + bbox_xyxy_tensor[:, 2]) * 0.5
-    bbox_center_xywh_tensor[:, 1] = (bbox_xyxy_tensor[:, 1] + bbox_xyxy_tensor[:, 3]) * 0.5
+    if mode != 'min':
+        
+        raise TypeError('Unknown nms mode: %s.' % mode)
+    
+    top_left = torch.max(bboxes_xyxy_group_1[:, None, :2], bboxes_xyxy_group_2[:, :2])
+    bottom_right = torch.min(bboxes_xyxy_group_1[:, None, 2:], bboxes_xyxy_group_2[:, 2:])
+    
+    intersections_bboxes_width_height = torch.clamp(bottom_right - top_left, min=0)
+    intersections_bboxes_areas = intersections_bboxes_width_height[:, :, 0] * intersections_bboxes_width_height[:, :, 1]
     
-    # Getting bottom right corner
-    bbox_center_xywh_tensor[:, 2] = bbox_xyxy_tensor[:, 2] - bbox_xyxy_tensor[:, 0]
-    bbox_center_xywh_tensor[:, 3] = bbox_xyxy_tensor[:, 3] - bbox_xyxy_tensor[:, 1]
+    bboxes_group_1_areas = (bboxes_xyxy_group_1[:,2]-bboxes_xyxy_group_1[:,0]) * (bboxes_xyxy_group_1[:,3]-bboxes_xyxy_group_1[:,1])
+    bboxes_group_2_areas = (bboxes_xyxy_group_2[:,2]-bboxes_xyxy_group_2[:,0]) * (bboxes_xyxy_group_2[:,3]-bboxes_xyxy_group_2[:,1])
     
-    return bbox_center_xywh_tensor
+    return intersections_bboxes_areas / torch.min(bboxes_group_1_areas[:, None], bboxes_group_2_areas)
+
+
+def select_top_k_per_group(scores, group_ids=None, k=None):
+    """Function that selects at most k highest scoring elements within each group.
+    
+    Parameters
+    ----------
+    scores : torch.FloatTensor of size (N,)
+        Tensor containing scores of elements.
+        
+    group_ids : torch.LongTensor of size (N,) or None
+        Non-negative ids of groups (images, classes) that elements belong to.
+        If None, all elements are treated as a single group.
+        
+    k : int or None
+        Maximum number of elements kept in each group. If None, all elements are kept.
+        
+    Returns
+    -------
+    indexes : torch.LongTensor of size (#selected,)
+        Indexes of selected elements sorted by descending score.
+    """
+    
+    _, order = scores.sort(0, descending=True)
+    
+    if k is None:
+        
+        return order
+    
+    if group_ids is None:
+        
+        return order[:k]
+    
+    # Sorting the score-ordered groups in a stable way keeps the elements of each
+    # group in descending score order, so the position of an element inside its
+    # group is its rank within the group
+    order_group_ids = group_ids[order]
+    order_group_ids_sorted, group_order = order_group_ids.sort(dim=0, stable=True)
+    
+    group_counts = torch.bincount(order_group_ids_sorted)
+    group_starts = group_counts.cumsum(0) - group_counts
+    
+    ranks = torch.empty_like(order)
+    ranks[group_order] = torch.arange(order.numel(), device=order.device) - group_starts[order_group_ids_sorted]
+    
+    return order[ranks < k]
+
+
+def batched_box_nms(bboxes,
+                    scores,
+                    class_ids=None,
+                    image_ids=None,
+                    threshold=0.5,
+                    mode='union',
+                    pre_nms_top_k=None,
+                    post_nms_top_k=None,
+                    block_size=256):
+    """Function that performes non-maximum suppression of predicted bounding
+    boxes of many images and classes at once.
+    
+    Boxes are only suppressed by boxes of the same image and, if ```class_ids```
+    are given, of the same class. Instead of offsetting the coordinates of boxes
+    of each category, the overlap matrix between boxes of different categories
+    is zeroed out, which gives exactly the same result without loss of precision.
+    
+    The suppression is computed on precomputed overlap matrices of score-sorted
+    boxes following Cluster-NMS: a box is kept if its overlap with every kept box
+    of a higher score is below threshold. Starting from all boxes being kept, the
+    rule is applied until the kept set doesn't change, which gives exactly the same
+    result as the sequential greedy algorithm in just a few matrix passes. Boxes are
+    processed in blocks of ```block_size``` to bound the memory and the number of passes.
+    
+    Reference:
+    https://arxiv.org/abs/2005.03572
+    
+    Parameters
+    ----------
+    bboxes : torch.FloatTensor of size (#boxes, 4)
+        Tensor containing bounding boxes in a xyxy format
+        
+    scores : torch.FloatTensor of size (#boxes,)
+        Tensor containing confidence scores for each of the bounding
+        boxes (probabilities).
+        
+    class_ids : torch.LongTensor of size (#boxes,) or None
+        Classes of boxes. If given, suppression is performed for each class separately.
+        
+    image_ids : torch.LongTensor of size (#boxes,) or None
+        Ids of images in the batch that boxes belong to.
+        
+    threshold : float
+        Boxes that overlap more than threshold with a higher scoring box are prunned.
+        
+    mode : string
+        'union' or 'min' -- see compute_bboxes_overlaps().
+        
+    pre_nms_top_k : int or None
+        Number of highest scoring boxes of each image that are considered for suppression.
+        Bounds the size of the overlap matrix.
+        
+    post_nms_top_k : int or None
+        Maximum number of boxes of each image that are kept after suppression.
+        
+    block_size : int
+        Number of score-sorted boxes that are processed at once.
+        
+    Returns
+    -------
+    boxes : torch.LongTensor of size (#selected_boxes,)
+        Indexes of boxes that were not prunned sorted by descending score.
+    """
+    
+    # (K,) -- indexes of candidate boxes sorted by descending score
+    candidates_indexes = select_top_k_per_group(scores, image_ids, pre_nms_top_k)
+    
+    if candidates_indexes.numel() == 0:
+        
+        return candidates_indexes
+    
+    candidates_bboxes = bboxes[candidates_indexes]
+    
+    # Boxes of different images and classes should never suppress each other
+    candidates_group_ids = None
+    
+    for group_ids in (class_ids, image_ids):
+        
+        if group_ids is not None:
+            
+            group_ids = group_ids[candidates_indexes]
+            
+            if candidates_group_ids is None:
+                
+                candidates_group_ids = group_ids
+            else:
+                
+                candidates_group_ids = candidates_group_ids * (group_ids.max() + 1) + group_ids
+    
+    number_of_candidates = candidates_indexes.numel()
+    
+    keep = torch.zeros(number_of_candidates, dtype=torch.bool, device=candidates_indexes.device)
+    
+    # The score-sorted boxes are processed in blocks: the boxes of a block are first
+    # suppressed by all the boxes that were kept in the previous blocks and after
+    # that the suppression inside of the block is resolved. This bounds the memory
+    # by (#boxes, block_size) and the number of iterations by the size of a block.
+    for block_start in range(0, number_of_candidates, block_size):
+        
+        block_end = min(block_start + block_size, number_of_candidates)
+        
+        block_bboxes = candidates_bboxes[block_start:block_end]
+        
+        # (block_size, block_size) -- each box can only be suppressed by boxes with higher score
+        block_overlaps = compute_bboxes_overlaps(block_bboxes, block_bboxes, mode=mode).triu_(diagonal=1)
+        
+        if candidates_group_ids is not None:
+            
+            block_group_ids = candidates_group_ids[block_start:block_end]
+            block_overlaps.masked_fill_(block_group_ids[:, None] != block_group_ids, 0)
+        
+        block_keep = torch.ones(block_end - block_start, dtype=torch.bool, device=keep.device)
+        
+        previous_kept_indexes = keep[:block_start].nonzero().view(-1)
+        
+        if previous_kept_indexes.numel() > 0:
+            
+            previous_overlaps = compute_bboxes_overlaps(candidates_bboxes[previous_kept_indexes], block_bboxes, mode=mode)
+            
+            if candidates_group_ids is not None:
+                
+                previous_group_ids = candidates_group_ids[previous_kept_indexes]
+                previous_overlaps.masked_fill_(previous_group_ids[:, None] != block_group_ids, 0)
+            
+            block_keep, _ = previous_overlaps.max(0)
+            block_keep = block_keep <= threshold
+        
+        # Boxes suppressed by the previous blocks can't suppress anything
+        suppressing_keep = block_keep
+        
+        while suppressing_keep.any():
+            
+            # The biggest overlap of each box with the currently kept boxes of the block
+            max_overlaps, _ = block_overlaps[suppressing_keep].max(0)
+            
+            updated_keep = block_keep & (max_overlaps <= threshold)
+            
+            if torch.equal(updated_keep, suppressing_keep):
+                
+                break
+            
+            suppressing_keep = updated_keep
+        
+        keep[block_start:block_end] = suppressing_keep
+    
+    kept_indexes = candidates_indexes[keep]
+    
+    if post_nms_top_k is not None:
+        
+        kept_image_ids = image_ids[kept_indexes] if image_ids is not None else None
+        
+        kept_indexes = kept_indexes[select_top_k_per_group(scores[kept_indexes], kept_image_ids, post_nms_top_k)]
+    
+    return kept_indexes
+
 
 def box_nms(bboxes, scores, threshold=0.5, mode='union'):
     """Function that performes non-maximum suppression of predicted
@@ -101,6 +339,9 @@ def box_nms(bboxes, scores, threshold=0.5, mode='union'):
 
     Reference:
     https://github.com/rbgirshick/py-faster-rcnn/blob/master/lib/nms/py_cpu_nms.py
+    
+    The suppression itself is performed by batched_box_nms() treating
+    all the boxes as a single group.
 
     Parameters
     ----------
@@ -116,45 +357,8 @@ def box_nms(bboxes, scores, threshold=0.5, mode='union'):
     boxes : torch.LongTensor of size (#selected_boxes,)
      Indexes of boxes that were not prunned
     """
-        
-    x1 = bboxes[:,0]
-    y1 = bboxes[:,1]
-    x2 = bboxes[:,2]
-    y2 = bboxes[:,3]
-
-    areas = (x2-x1) * (y2-y1)
-    _, order = scores.sort(0, descending=True)
-
-    keep = []
-    while order.numel() > 0:
-        i = order[0]
-        keep.append(i)
-
-        if order.numel() == 1:
-            break
-
-        xx1 = x1[order[1:]].clamp(min=x1[i])
-        yy1 = y1[order[1:]].clamp(min=y1[i])
-        xx2 = x2[order[1:]].clamp(max=x2[i])
-        yy2 = y2[order[1:]].clamp(max=y2[i])
-
-        w = (xx2-xx1).clamp(min=0)
-        h = (yy2-yy1).clamp(min=0)
-        inter = w*h
-
-        if mode == 'union':
-            ovr = inter / (areas[i] + areas[order[1:]] - inter)
-        elif mode == 'min':
-            ovr = inter / areas[order[1:]].clamp(max=areas[i])
-        else:
-            raise TypeError('Unknown nms mode: %s.' % mode)
-
-        ids = (ovr<=threshold).nonzero().squeeze()
-        if ids.numel() == 0:
-            break
-        order = order[ids+1]
-
-    return torch.LongTensor(keep)
+    
+    return batched_box_nms(bboxes, scores, threshold=threshold, mode=mode)
 
 
 def pad_to_size_with_bounding_boxes(input_img, size, bboxes_center_xywh, fill_label=0):
@@ -218,9 +422,8 @@ def pad_to_size_with_bounding_boxes(input_img, size, bboxes_center_xywh, fill_la
     # should be probably swapped -- needs more inspecting. The function was checked to 
     # work correctly though.
     
-    bboxes_center_xywhh_padded = bboxes_center_xywh.clone()
-    bboxes_center_xywhh_padded[:, 0] = bboxes_center_xywh[:, 0] + expand_difference_top_and_left[0]
-    bboxes_center_xywhh_padded[:, 1] = bboxes_center_xywh[:, 1] + expand_difference_top_and_left[1]
+    bboxes_center_xywhh_padded = BoundingBoxes(bboxes_center_xywh.clone(), 'center_xywh')
+    bboxes_center_xywhh_padded = bboxes_center_xywhh_padded.translate_(*expand_difference_top_and_left.tolist()).tensor
     
     
     return processed_img, bboxes_center_xywhh_padded
@@ -251,7 +454,9 @@ class AnchorBoxesManager():
                  input_image_size=(600, 600),
                  anchor_areas=[128*128, 256*256, 512*512],
                  aspect_ratios=[1/2., 1/1., 2/1.],
-                 stride=32
+                 stride=32,
+                 anchor_boxes_cache_size=8,
+                 matching_chunk_size=None
                 ):
         """Constructor function for the anchor box manager class.
         
@@ -264,6 +469,9 @@ class AnchorBoxesManager():
         be shifted in order to reach the closest groundtruth bounding box. These
         values are used as target values during training.
         
+        Anchor boxes for other input sizes are computed on demand and kept in a
+        cache of the ```anchor_boxes_cache_size``` most recently used sizes.
+        
         Parameters
         ----------
         input_img_size : tuple of ints
@@ -277,6 +485,14 @@ class AnchorBoxesManager():
             
         stride : int
             Output stride of the network
+            
+        anchor_boxes_cache_size : int
+            Maximum number of input sizes for which anchor boxes are cached
+            
+        matching_chunk_size : int or None
+            If specified, anchor boxes are matched with groundtruth boxes in chunks
+            of this size, which bounds the memory needed for a big number of
+            anchor boxes. The targets are exactly the same as without chunking.
 
         """
         
@@ -290,6 +506,11 @@ class AnchorBoxesManager():
         
         self.number_of_anchors_per_cell = len(anchor_areas) * len(aspect_ratios)
         
+        self.anchor_boxes_cache_size = anchor_boxes_cache_size
+        self.anchor_boxes_cache = collections.OrderedDict()
+        
+        self.matching_chunk_size = matching_chunk_size
+        
         # Precomputing anchor boxes positions
         
         self.precompute_anchor_boxes(input_image_size)
@@ -311,26 +532,23 @@ class AnchorBoxesManager():
             the coordinates of all possible anchor boxes.
         """
         
-        anchor_boxes_sizes = []
+        # Given:
+        # aspect_ratio = w / h
+        # anchor_area = w * h
+        # To find:
+        # w and h
+        # w = sqrt( aspect_ratio * anchor_area ) = sqrt( (w*w*h) / h ) = sqrt(w*w) = w
         
-        for current_anchor_area in self.anchor_areas:
-            
-            for current_aspect_ratio in self.aspect_ratios:
-                
-                # Given:
-                # aspect_ratio = w / h
-                # anchor_area = w * h
-                # To find:
-                # w and h
-                # w = sqrt( aspect_ratio * anchor_area ) = sqrt( (w*w*h) / h ) = sqrt(w*w) = w
-                
-                w = math.sqrt( current_aspect_ratio * current_anchor_area )
-                h = current_anchor_area / w
-                
-                anchor_boxes_sizes.append((w, h))
+        anchor_areas = np.asarray(self.anchor_areas, dtype=np.float64)[:, None]
+        aspect_ratios = np.asarray(self.aspect_ratios, dtype=np.float64)[None, :]
+        
+        w = np.sqrt( aspect_ratios * anchor_areas )
+        h = anchor_areas / w
+        
+        anchor_boxes_sizes = np.stack((w.ravel(), h.ravel()), axis=1)
         
-        # Adding a dummy dimension here in order to easily use .repeat() later
-        return np.expand_dims( np.asarray(anchor_boxes_sizes), axis=0 )
+        # Adding a dummy dimension here in order to easily broadcast later
+        return np.expand_dims( anchor_boxes_sizes, axis=0 )
     
     
     def get_anchor_boxes_center_coordinates(self, input_size):
@@ -354,20 +572,21 @@ class AnchorBoxesManager():
         
         
         feature_map_height, feature_map_width = compute_network_output_feature_map_size(input_size, stride=self.stride)
-
-        meshgrid_width, meshgrid_height = np.meshgrid(range(feature_map_width), range(feature_map_height))
-
+        
         # Getting coordinates of centers of all the grid cells of the feature map
-        anchor_coordinates_feature_map = zip(meshgrid_height.flatten(), meshgrid_width.flatten())
-        anchor_coordinates_feature_map = np.asarray( anchor_coordinates_feature_map )
-        anchor_coordinates_feature_map = anchor_coordinates_feature_map + 0.5
+        # in the row-major order of the feature map
+        meshgrid_height, meshgrid_width = np.meshgrid(np.arange(feature_map_height) + 0.5,
+                                                      np.arange(feature_map_width) + 0.5,
+                                                      indexing='ij')
+        
+        anchor_coordinates_feature_map = np.stack((meshgrid_height.ravel(), meshgrid_width.ravel()), axis=1)
 
         anchor_coordinates_input = anchor_coordinates_feature_map * self.stride
         
         return np.expand_dims( anchor_coordinates_input, axis=1 )
         
     
-    def precompute_anchor_boxes(self, input_size):
+    def compute_anchor_boxes(self, input_size):
         """Function that combines all the previous functions to compute all anchor boxes
         with their coordinates with respect to the input image's coordinate system.
         
@@ -389,19 +608,96 @@ class AnchorBoxesManager():
         anchor_boxes_sizes = self.get_anchor_boxes_sizes()
         anchor_boxes_center_coordinates = self.get_anchor_boxes_center_coordinates(input_size)
         
-        anchor_boxes_sizes_number = anchor_boxes_sizes.shape[1]
-        anchor_boxes_center_coordinates_number = anchor_boxes_center_coordinates.shape[0]
-        
-        anchor_boxes_center_coordinates_repeated = anchor_boxes_center_coordinates.repeat(anchor_boxes_sizes_number, axis=1)
-        anchor_boxes_sizes_repeated =  anchor_boxes_sizes.repeat(anchor_boxes_center_coordinates_number, axis=0)
+        anchor_boxes_shape = (anchor_boxes_center_coordinates.shape[0], anchor_boxes_sizes.shape[1], 2)
         
-        anchor_boxes = np.dstack((anchor_boxes_center_coordinates_repeated, anchor_boxes_sizes_repeated))
+        anchor_boxes = np.concatenate((np.broadcast_to(anchor_boxes_center_coordinates, anchor_boxes_shape),
+                                       np.broadcast_to(anchor_boxes_sizes, anchor_boxes_shape)), axis=2)
         
         anchor_boxes = anchor_boxes.reshape((-1, 4))
         
-        self.anchor_boxes = torch.FloatTensor( anchor_boxes ).clone()
+        return torch.FloatTensor( anchor_boxes )
+    
     
-    def encode(self, ground_truth_boxes_center_xywh, ground_truth_labels):
+    def get_anchor_boxes(self, input_size=None):
+        """Function that returns anchor boxes for the given input size.
+        
+        Anchor boxes are taken from the cache which is keyed by the input size,
+        stride, anchor areas and aspect ratios. If they are absent, they are computed
+        and the least recently used entry is evicted when the cache is full.
+        
+        Parameters
+        ----------
+        input_size : tuple of ints or None
+            Tuple with height and width sizes of the image. If None, the
+            precomputed anchor boxes of the input size specified in the
+            constructor are returned.
+            
+        Returns
+        -------
+        anchor_boxes : torch.FloatTensor of size (#anchors, 4)
+            Array all anchor boxes in center_xywh format.
+        """
+        
+        return self.get_anchor_bboxes(input_size).tensor
+    
+    
+    def get_anchor_bboxes(self, input_size=None):
+        """Same as get_anchor_boxes() but returns anchor boxes wrapped into
+        BoundingBoxes object, so that their conversions into other formats are cached too.
+        """
+        
+        if input_size is None:
+            
+            return self.anchor_bboxes
+        
+        cache_key = (int(input_size[0]),
+                     int(input_size[1]),
+                     self.stride,
+                     tuple(self.anchor_areas),
+                     tuple(self.aspect_ratios))
+        
+        anchor_boxes = self.anchor_boxes_cache.pop(cache_key, None)
+        
+        if anchor_boxes is None:
+            
+            anchor_boxes = BoundingBoxes(self.compute_anchor_boxes(input_size), 'center_xywh')
+            
+            while len(self.anchor_boxes_cache) >= max(self.anchor_boxes_cache_size, 1):
+                
+                self.anchor_boxes_cache.popitem(last=False)
+        
+        # Reinserting the entry marks it as the most recently used one
+        self.anchor_boxes_cache[cache_key] = anchor_boxes
+        
+        return anchor_boxes
+    
+    
+    def get_feature_map_size(self, input_size=None):
+        """Function that returns the size of the output feature map
+        of the network for the given input size.
+        """
+        
+        if input_size is None:
+            
+            return self.feature_map_height, self.feature_map_width
+        
+        return tuple(compute_network_output_feature_map_size(input_size, stride=self.stride))
+    
+    
+    def precompute_anchor_boxes(self, input_size):
+        """Function that computes anchor boxes for the given input size
+        and stores them in ```anchor_boxes``` attribute.
+                
+        Parameters
+        ----------
+        input_size : tuple of ints
+            Tuple with height and width sizes of the image
+        """
+        
+        self.anchor_bboxes = self.get_anchor_bboxes(input_size)
+        self.anchor_boxes = self.anchor_bboxes.tensor
+    
+    def encode(self, ground_truth_boxes_center_xywh, ground_truth_labels, input_image_size=None):
         """Function that computes the parametrized in a certain way ground truth
         value for each anchor box given the groundtruth bounding boxes and their
         classes.
@@ -413,6 +709,10 @@ class AnchorBoxesManager():
         
         ground_truth_labels:  torch.LongTensor of size (N,)
             Tensor containing 
+            
+        input_image_size : tuple of ints or None
+            Height and width of the image. If None, the input size specified
+            in the constructor is used.
 
         Returns
         -------
@@ -426,44 +726,95 @@ class AnchorBoxesManager():
             box and the closest groundtruth bounding box.
         """
         
-                
+        ground_truth_mask = torch.ones(1, ground_truth_labels.size(0), dtype=torch.bool, device=ground_truth_labels.device)
+        
+        target_deltas, target_labels = self.encode_batch(ground_truth_boxes_center_xywh.unsqueeze(0),
+                                                         ground_truth_labels.unsqueeze(0),
+                                                         ground_truth_mask,
+                                                         input_image_size=input_image_size)
+        
+        return target_deltas[0], target_labels[0]
+    
+    def encode_batch(self, ground_truth_boxes_center_xywh, ground_truth_labels, ground_truth_mask, input_image_size=None):
+        """Function that computes the parametrized in a certain way ground truth
+        value for each anchor box for a whole batch of images at once.
+        
+        Images have different number of groundtruth boxes, so the boxes are
+        padded to the same number Nmax and the mask indicates which of them are valid.
+        See pad_ground_truth_boxes().
+        
+        Parameters
+        ----------
+        ground_truth_boxes_center_xywh : torch.FloatTensor of size (B, Nmax, 4)
+            Tensor contains padded groundtruth bounding boxes in a center_xywh format
+        
+        ground_truth_labels:  torch.LongTensor of size (B, Nmax)
+            Tensor containing padded groundtruth labels
+            
+        ground_truth_mask:  torch.BoolTensor of size (B, Nmax)
+            Tensor indicating which of the groundtruth boxes are valid
+            
+        input_image_size : tuple of ints or None
+            Height and width of the images. If None, the input size specified
+            in the constructor is used.
+
+        Returns
+        -------
+        target_deltas : torch.FloatTensor of size (B, ANCHOR_BOXES_PER_CELL, 4, H, W)
+            Contains parametrized in a certain way differences between
+            anchor boxes coordinates and sizes and closest ground truth box.
+            
+        target_labels : torch.LongTensor of size (B, ANCHOR_BOXES_PER_CELL, H, W)
+            Contains groundtruth class labels for each anchor box. Anchor boxes
+            of images without groundtruth boxes are assigned to background.
+        """
+        
+        anchor_bboxes = self.get_anchor_bboxes(input_image_size)
+        
         # (N, 4)
-        anchor_boxes_center_xywh = self.anchor_boxes
+        anchor_boxes_center_xywh = anchor_bboxes.to_format('center_xywh').type_as(ground_truth_boxes_center_xywh)
 
         # --- Conversion stage
         # Converting anchor boxes and groudtruth boxes into xyxy format
-        # in order to compute the intersection over union later on
+        # in order to compute the intersection over union later on.
+        # Anchor boxes are converted only once for each input size.
 
-        anchor_boxes_xyxy = convert_bbox_center_xywh_tensor_to_xyxy(anchor_boxes_center_xywh)
+        anchor_boxes_xyxy = anchor_bboxes.to_format('xyxy').type_as(ground_truth_boxes_center_xywh)
         ground_truth_boxes_xyxy = convert_bbox_center_xywh_tensor_to_xyxy(ground_truth_boxes_center_xywh)
 
         # --- Matching stage
         # Computing intersection over union between all pairs of anchor boxes
-        # and groundtruth boxes
+        # and groundtruth boxes of each image and getting ground truth box with
+        # the biggest intersection for each anchor box. -- we get ids here
+        # Padded groundtruth boxes are never matched
         
-        # (N, M)
-        ious = compute_bboxes_ious(anchor_boxes_xyxy, ground_truth_boxes_xyxy)
-
-        # Getting ground truth box with the biggest intersection for
-        # each anchor box. -- we get ids here
-        # (N,)
-        anchor_boxes_best_groundtruth_match_ious, anchor_boxes_best_groundtruth_match_ids = ious.max(1)
+        # (B, N)
+        anchor_boxes_best_groundtruth_match_ious, anchor_boxes_best_groundtruth_match_ids = compute_bboxes_best_matches(anchor_boxes_xyxy,
+                                                                                                                         ground_truth_boxes_xyxy,
+                                                                                                                         bboxes_xyxy_group_2_mask=ground_truth_mask,
+                                                                                                                         chunk_size=self.matching_chunk_size)
 
         # Here we actually extract the relevant groundtruth for each anchor box
-        groundtruth_boxes_center_xywh_best_match_anchorwise = ground_truth_boxes_center_xywh[anchor_boxes_best_groundtruth_match_ids]
+        # (B, N, 4)
+        groundtruth_boxes_center_xywh_best_match_anchorwise = torch.gather(ground_truth_boxes_center_xywh,
+                                                                          1,
+                                                                          anchor_boxes_best_groundtruth_match_ids[:, :, None].expand(-1, -1, 4))
 
         # --- Regressing stage
 
-        delta_xy = (groundtruth_boxes_center_xywh_best_match_anchorwise[:,:2]-anchor_boxes_center_xywh[:,:2]) / anchor_boxes_center_xywh[:,2:]
-        delta_wh = torch.log(groundtruth_boxes_center_xywh_best_match_anchorwise[:,2:]/anchor_boxes_center_xywh[:,2:])
+        delta_xy = (groundtruth_boxes_center_xywh_best_match_anchorwise[:, :, :2]-anchor_boxes_center_xywh[:,:2]) / anchor_boxes_center_xywh[:,2:]
+        delta_wh = torch.log(groundtruth_boxes_center_xywh_best_match_anchorwise[:, :, 2:]/anchor_boxes_center_xywh[:,2:])
 
-        target_deltas = torch.cat((delta_xy, delta_wh), dim=1)
+        target_deltas = torch.cat((delta_xy, delta_wh), dim=2)
+        
+        # Images without groundtruth boxes were matched with padding
+        target_deltas[~ground_truth_mask.any(1)] = 0
 
         # Accounting for the background here
         # TODO: add special handeling of +1 shifting classes -- we dont' need that 
         # for pascal as all classes ids don't have 0 there but there might be other
         # datasets where it is not the case
-        target_labels = ground_truth_labels[anchor_boxes_best_groundtruth_match_ids] #+ 1
+        target_labels = torch.gather(ground_truth_labels, 1, anchor_boxes_best_groundtruth_match_ids) #+ 1
         
         # TODO: during testing the threshold of 0.5 seemed to be too strict,
         # some groundtruth boxes didn't have any matched anchor boxes
@@ -474,12 +825,37 @@ class AnchorBoxesManager():
 
         target_labels[ignore] = -1
         
+        return self.reshape_targets_to_feature_map(target_deltas, target_labels, input_image_size=input_image_size)
+    
+    def reshape_targets_to_feature_map(self, target_deltas, target_labels, input_image_size=None):
+        """Function that reshapes the anchor-wise targets of a batch of images
+        so that they are aligned with the output feature map of a model.
+        
+        Parameters
+        ----------
+        target_deltas : torch.FloatTensor of size (B, H*W*ANCHOR_BOXES_PER_CELL, 4)
+            Anchor-wise target deltas
+            
+        target_labels : torch.LongTensor of size (B, H*W*ANCHOR_BOXES_PER_CELL)
+            Anchor-wise target labels
+            
+        input_image_size : tuple of ints or None
+            Height and width of the images.
+            
+        Returns
+        -------
+        target_deltas : torch.FloatTensor of size (B, ANCHOR_BOXES_PER_CELL, 4, H, W)
+        
+        target_labels : torch.LongTensor of size (B, ANCHOR_BOXES_PER_CELL, H, W)
+        """
+        
         # Resizing so that it's easier to use with some models
-        # TODO: the following piece of code can be probably
-        # placed in a separate function.
         
-        original_shape = [self.feature_map_height,
-                          self.feature_map_width,
+        feature_map_height, feature_map_width = self.get_feature_map_size(input_image_size)
+        
+        original_shape = [target_labels.size(0),
+                          feature_map_height,
+                          feature_map_width,
                           self.number_of_anchors_per_cell]
         
         target_labels_reshaped_back = target_labels.view(original_shape)
@@ -492,73 +868,208 @@ class AnchorBoxesManager():
         
         target_deltas_reshaped_back = target_deltas.view(original_shape)
         
-        target_deltas_reshaped_back = target_deltas_reshaped_back.permute(2, 3, 0, 1).contiguous()
+        target_deltas_reshaped_back = target_deltas_reshaped_back.permute(0, 3, 4, 1, 2).contiguous()
         
-        target_labels_reshaped_back = target_labels_reshaped_back.permute(2, 0, 1).contiguous()
+        target_labels_reshaped_back = target_labels_reshaped_back.permute(0, 3, 1, 2).contiguous()
         
         return target_deltas_reshaped_back, target_labels_reshaped_back
     
-    def decode(self, anchors_deltas, anchors_logits):
+    def decode(self,
+               anchors_deltas,
+               anchors_logits,
+               nms_threshold=0.5,
+               per_class_nms=False,
+               input_image_size=None,
+               score_threshold=None,
+               pre_nms_top_k=None,
+               max_detections=None):
         """Function that converts the predicted delta values for anchor boxes
         into final prediction bounding boxes with associated classes.
+        
+        Accepts predictions for a single image or for a whole batch of images,
+        in the later case non-maximum suppression is performed for all of them at once.
+        
+        The decoding is performed in stages: anchor boxes classified as background
+        or with a score below ```score_threshold``` are discarded, only ```pre_nms_top_k```
+        highest scoring anchor boxes of each class of each image are kept, boxes are
+        decoded only for the remaining anchor boxes, non-maximum suppression is applied
+        and at most ```max_detections``` boxes are returned for each image.
 
         Parameters
         ----------
-        anchors_deltas : torch.FloatTensor of size (H*W*ANCHOR_BOXES_PER_CELL, 4)
+        anchors_deltas : torch.FloatTensor of size ([B,] H*W*ANCHOR_BOXES_PER_CELL, 4)
             Tensor containing delta values for each anchor predicted by some model.
             Make sure that values are aligned in the same way (H, W, anchor_boxes_per_cell, 4)
 
-        anchors_logits:  torch.LongTensor of size (H*W*ANCHOR_BOXES_PER_CELL, NUMBER_OF_CLASSES)
+        anchors_logits:  torch.LongTensor of size ([B,] H*W*ANCHOR_BOXES_PER_CELL, NUMBER_OF_CLASSES)
             Tensor containing logits predicted for each anchor box by the model.
             Make sure that the input values are properly aligned similar to previous argument.
+            
+        nms_threshold : float
+            Overlap threshold used by non-maximum suppression.
+            
+        per_class_nms : bool
+            If True, boxes are only suppressed by boxes of the same class.
+            
+        input_image_size : tuple of ints or None
+            Height and width of the images. If None, the input size specified
+            in the constructor is used.
+            
+        score_threshold : float or None
+            Anchor boxes with probability of the predicted class not bigger
+            than threshold are discarded before decoding.
+            
+        pre_nms_top_k : int or None
+            Maximum number of anchor boxes of each class of each image that
+            are decoded and passed to non-maximum suppression.
+            
+        max_detections : int or None
+            Maximum number of boxes returned for each image.
 
         Returns
         -------
-        boxes : torch.FloatTensor of size (#boxes, 4)
+        boxes : torch.FloatTensor of size (#boxes, 4) or list of them
             Returns predicted boxes in the center_xywh format.
 
-        classes : torch.LongTensor of size (#boxes,)
+        classes : torch.LongTensor of size (#boxes,) or list of them
             Returns predicted classes for each of the returned boxes
         """
+        
+        is_batch = anchors_deltas.dim() == 3
+        
+        if not is_batch:
+            
+            anchors_deltas = anchors_deltas.unsqueeze(0)
+            anchors_logits = anchors_logits.unsqueeze(0)
+        
+        batch_size, number_of_anchors = anchors_deltas.size(0), anchors_deltas.size(1)
 
-
-        anchor_boxes = self.anchor_boxes.type_as(anchors_deltas)
-
-        # (H*W*anchors_per_cell, number_of_classes)
-        # Variable() because softmax work only with them and not Tensors
-        anchors_probabilities = torch.nn.functional.softmax(Variable(anchors_logits), dim=1).data
+        anchor_boxes = self.get_anchor_boxes(input_image_size).type_as(anchors_deltas)
+        
+        # --- Filtering stage
+        
+        # (B*H*W*anchors_per_cell, number_of_classes)
+        anchors_logits = anchors_logits.reshape(batch_size * number_of_anchors, -1)
+        anchors_probabilities = torch.nn.functional.softmax(anchors_logits.detach(), dim=1)
+        
+        number_of_classes = anchors_probabilities.size(1)
 
         anchors_probabilities_argmaxed_score, anchors_probabilities_argmaxed_class = anchors_probabilities.max(1)
 
         # anchor boxes that were classified as a non-background -- meaning that
         # they have an intersection of at least 0.5 IOU with 
-        active_anchor_boxes_indexes = torch.nonzero(anchors_probabilities_argmaxed_class > 0).squeeze()
+        active_anchor_boxes_mask = anchors_probabilities_argmaxed_class > 0
+        
+        if score_threshold is not None:
+            
+            active_anchor_boxes_mask &= anchors_probabilities_argmaxed_score > score_threshold
+        
+        active_anchor_boxes_indexes = torch.nonzero(active_anchor_boxes_mask).view(-1)
+        
+        activated_anchor_scores = anchors_probabilities_argmaxed_score[active_anchor_boxes_indexes]
+        activated_anchor_classes = anchors_probabilities_argmaxed_class[active_anchor_boxes_indexes]
+        activated_anchor_image_ids = active_anchor_boxes_indexes // number_of_anchors
+        
+        if pre_nms_top_k is not None:
+            
+            top_k_indexes = select_top_k_per_group(activated_anchor_scores,
+                                                   activated_anchor_image_ids * number_of_classes + activated_anchor_classes,
+                                                   pre_nms_top_k)
+            
+            active_anchor_boxes_indexes = active_anchor_boxes_indexes[top_k_indexes]
+            activated_anchor_scores = activated_anchor_scores[top_k_indexes]
+            activated_anchor_classes = activated_anchor_classes[top_k_indexes]
+            activated_anchor_image_ids = activated_anchor_image_ids[top_k_indexes]
+        
+        # --- Decoding stage
+        # Only the boxes of the remaining anchor boxes are decoded
+        
+        activated_anchor_boxes = anchor_boxes[active_anchor_boxes_indexes % number_of_anchors]
+        activated_anchors_deltas = anchors_deltas.reshape(-1, 4)[active_anchor_boxes_indexes]
 
-        loc_xy = anchors_deltas[:,:2]
-        loc_wh = anchors_deltas[:,2:]
+        loc_xy = activated_anchors_deltas[:, :2]
+        loc_wh = activated_anchors_deltas[:, 2:]
 
-        xy = loc_xy * anchor_boxes[:,2:] + anchor_boxes[:,:2]
-        wh = loc_wh.exp() * anchor_boxes[:,2:]
+        xy = loc_xy * activated_anchor_boxes[:,2:] + activated_anchor_boxes[:,:2]
+        wh = loc_wh.exp() * activated_anchor_boxes[:,2:]
 
-        boxes_center_xywh = torch.cat([xy, wh], 1)
+        active_boxes_center_xywh = torch.cat([xy, wh], 1)
 
         # Convert to xyxy to perform non maximum suppression
-        boxes_xyxy = torch.cat([xy-wh/2, xy+wh/2], 1)
-
-        # Getting the coordinates of only active anchor boxes
-        active_boxes_center_xywh = boxes_center_xywh[active_anchor_boxes_indexes, :]
-        activated_anchor_boxes_xyxy = boxes_xyxy[active_anchor_boxes_indexes, :]
-        activated_anchor_scores = anchors_probabilities_argmaxed_score[active_anchor_boxes_indexes]
-        activated_anchor_classes = anchors_probabilities_argmaxed_class[active_anchor_boxes_indexes]
+        activated_anchor_boxes_xyxy = torch.cat([xy-wh/2, xy+wh/2], 1)
+        
+        # --- Suppression stage
 
-        suppressed_indexes = box_nms(activated_anchor_boxes_xyxy, activated_anchor_scores).type_as(anchors_probabilities_argmaxed_class)
+        suppressed_indexes = batched_box_nms(activated_anchor_boxes_xyxy,
+                                             activated_anchor_scores,
+                                             class_ids=activated_anchor_classes if per_class_nms else None,
+                                             image_ids=activated_anchor_image_ids,
+                                             threshold=nms_threshold,
+                                             post_nms_top_k=max_detections)
 
         final_boxes_center_xywh = active_boxes_center_xywh[suppressed_indexes]
         final_boxes_classes = activated_anchor_classes[suppressed_indexes]
+        
+        if not is_batch:
+            
+            return final_boxes_center_xywh, final_boxes_classes
+        
+        # Splitting the results back into separate images
+        final_boxes_image_ids = activated_anchor_image_ids[suppressed_indexes]
+        
+        final_boxes_image_ids, image_order = final_boxes_image_ids.sort(dim=0, stable=True)
+        final_boxes_per_image_counts = torch.bincount(final_boxes_image_ids, minlength=batch_size).tolist()
+        
+        final_boxes_center_xywh = list(final_boxes_center_xywh[image_order].split(final_boxes_per_image_counts))
+        final_boxes_classes = list(final_boxes_classes[image_order].split(final_boxes_per_image_counts))
 
         return final_boxes_center_xywh, final_boxes_classes
 
     
+def pad_ground_truth_boxes(ground_truth_boxes_center_xywh_list, ground_truth_labels_list):
+    """Function to pad groundtruth boxes of a batch of images to the same
+    number of boxes, so that they can be stacked and encoded at once.
+    
+    Parameters
+    ----------
+    ground_truth_boxes_center_xywh_list : list of torch.FloatTensor of size (N_i, 4)
+        Groundtruth bounding boxes of each image in a center_xywh format
+        
+    ground_truth_labels_list : list of torch.LongTensor of size (N_i,)
+        Groundtruth labels of each image
+        
+    Returns
+    -------
+    ground_truth_boxes_center_xywh : torch.FloatTensor of size (B, Nmax, 4)
+        Padded groundtruth bounding boxes
+        
+    ground_truth_labels : torch.LongTensor of size (B, Nmax)
+        Padded groundtruth labels
+        
+    ground_truth_mask : torch.BoolTensor of size (B, Nmax)
+        Mask indicating which of the boxes are valid
+    """
+    
+    batch_size = len(ground_truth_boxes_center_xywh_list)
+    
+    number_of_boxes = [boxes.size(0) for boxes in ground_truth_boxes_center_xywh_list]
+    max_number_of_boxes = max(number_of_boxes + [1])
+    
+    ground_truth_boxes_center_xywh = torch.zeros(batch_size, max_number_of_boxes, 4)
+    ground_truth_labels = torch.zeros(batch_size, max_number_of_boxes, dtype=torch.long)
+    ground_truth_mask = torch.zeros(batch_size, max_number_of_boxes, dtype=torch.bool)
+    
+    for image_number, (boxes, labels) in enumerate(zip(ground_truth_boxes_center_xywh_list, ground_truth_labels_list)):
+        
+        current_number_of_boxes = number_of_boxes[image_number]
+        
+        ground_truth_boxes_center_xywh[image_number, :current_number_of_boxes] = boxes.view(-1, 4)
+        ground_truth_labels[image_number, :current_number_of_boxes] = labels
+        ground_truth_mask[image_number, :current_number_of_boxes] = True
+    
+    return ground_truth_boxes_center_xywh, ground_truth_labels, ground_truth_mask
+
+    
 def compute_network_output_feature_map_size(input_img_size, stride):
     """Function to compute the size of the output feature map of the network.
     
@@ -580,11 +1091,11 @@ def compute_network_output_feature_map_size(input_img_size, stride):
     """
     
     
-    input_size = np.asarray(input_img_size).astype(np.float)
+    input_size = np.asarray(input_img_size).astype(np.float64)
 
     feature_map_size = input_size / stride
     
-    return np.ceil(feature_map_size).astype(np.int)
+    return np.ceil(feature_map_size).astype(np.int64)
 
 
 # Abbreviations:
@@ -610,8 +1121,190 @@ def compute_network_output_feature_map_size(input_img_size, stride):
 # in canonical center xywh representation to xyxy one in order to easily compute
 # intersection over using using compute_bboxes_ious() function
 
+# -- convert_bbox_format() and convert_bbox_format_() convert between all the formats
+# in one pass, either into a new tensor, into a preallocated ```out``` tensor or in-place.
+# All the other conversion functions are built on top of them.
+
+# -- BoundingBoxes keeps a tensor together with its format and converts it lazily.
+
+
+bbox_formats = ('center_xywh', 'topleft_xywh', 'xyxy')
+
+
+def convert_bbox_format_(bboxes_tensor, source_format, target_format):
+    """Function to convert bounding boxes between center_xywh, topleft_xywh
+    and xyxy formats in-place.
+    
+    Works with a tensors of a (..., 4) shape. The conversion modifies the input
+    tensor and allocates at most a temporary tensor of a (..., 2) shape.
+    
+    Parameters
+    ----------
+    bboxes_tensor : FloatTensor of shape (..., 4)
+        Tensor with bounding boxes in ```source_format```
+        
+    source_format : string
+        One of ```bbox_formats```
+        
+    target_format : string
+        One of ```bbox_formats```
+        
+    Returns
+    -------
+    bboxes_tensor : FloatTensor of shape (..., 4)
+        The same tensor with bounding boxes in ```target_format```
+    """
+    
+    for bbox_format in (source_format, target_format):
+        
+        if bbox_format not in bbox_formats:
+            
+            raise ValueError('Unknown bounding box format: %s.' % bbox_format)
+    
+    xy = bboxes_tensor[..., :2]
+    wh = bboxes_tensor[..., 2:]
+    
+    conversion = (source_format, target_format)
+    
+    if conversion == ('center_xywh', 'xyxy'):
+        
+        half_wh = wh * 0.5
+        torch.add(xy, half_wh, out=wh)
+        xy.sub_(half_wh)
+        
+    elif conversion == ('xyxy', 'center_xywh'):
+        
+        sum_xy = xy + wh
+        wh.sub_(xy)
+        torch.mul(sum_xy, 0.5, out=xy)
+        
+    elif conversion == ('center_xywh', 'topleft_xywh'):
+        
+        xy.add_(wh, alpha=-0.5)
+        
+    elif conversion == ('topleft_xywh', 'center_xywh'):
+        
+        xy.add_(wh, alpha=0.5)
+        
+    elif conversion == ('topleft_xywh', 'xyxy'):
+        
+        wh.add_(xy)
+        
+    elif conversion == ('xyxy', 'topleft_xywh'):
+        
+        wh.sub_(xy)
+    
+    return bboxes_tensor
+
 
-def convert_bbox_topleft_xywh_tensor_to_center_xywh(bbox_topleft_xywh_tensor):
+def convert_bbox_format(bboxes_tensor, source_format, target_format, out=None):
+    """Function to convert bounding boxes between center_xywh, topleft_xywh
+    and xyxy formats.
+    
+    Works with a tensors of a (..., 4) shape.
+    
+    Parameters
+    ----------
+    bboxes_tensor : FloatTensor of shape (..., 4)
+        Tensor with bounding boxes in ```source_format```
+        
+    source_format : string
+        One of ```bbox_formats```
+        
+    target_format : string
+        One of ```bbox_formats```
+        
+    out : FloatTensor of shape (..., 4) or None
+        Preallocated tensor to write the result into. Can be the input tensor itself.
+        
+    Returns
+    -------
+    bboxes_tensor : FloatTensor of shape (..., 4)
+        Tensor with bounding boxes in ```target_format```
+    """
+    
+    if out is None:
+        
+        out = bboxes_tensor.clone()
+        
+    elif out is not bboxes_tensor:
+        
+        out.copy_(bboxes_tensor)
+    
+    return convert_bbox_format_(out, source_format, target_format)
+
+
+class BoundingBoxes(object):
+    """
+    BoundingBoxes class keeps a tensor of bounding boxes together with its format.
+    
+    Conversions into other formats are performed lazily -- only when a tensor in
+    a particular format is requested for the first time -- and are cached, so that
+    boxes that are used in several formats (for example, anchor boxes) are converted
+    only once. Tensors returned by to_format() should be treated as read-only.
+    """
+    
+    def __init__(self, bboxes_tensor, bbox_format='center_xywh'):
+        
+        if bbox_format not in bbox_formats:
+            
+            raise ValueError('Unknown bounding box format: %s.' % bbox_format)
+        
+        self.tensor = bboxes_tensor
+        self.format = bbox_format
+        self.converted_tensors = {}
+    
+    
+    def __len__(self):
+        
+        return self.tensor.size(0)
+    
+    
+    def to_format(self, bbox_format):
+        """Returns a tensor with bounding boxes in the requested format."""
+        
+        if bbox_format == self.format:
+            
+            return self.tensor
+        
+        if bbox_format not in self.converted_tensors:
+            
+            self.converted_tensors[bbox_format] = convert_bbox_format(self.tensor, self.format, bbox_format)
+        
+        return self.converted_tensors[bbox_format]
+    
+    
+    def convert_(self, bbox_format):
+        """Converts the underlying tensor into the requested format in-place."""
+        
+        if bbox_format != self.format:
+            
+            convert_bbox_format_(self.tensor, self.format, bbox_format)
+            
+            self.format = bbox_format
+            self.converted_tensors = {}
+        
+        return self
+    
+    
+    def translate_(self, x_offset, y_offset):
+        """Shifts the bounding boxes in-place. Translation only changes the first two
+        coordinates in all the supported formats except of xyxy one."""
+        
+        offset = self.tensor.new_tensor([x_offset, y_offset])
+        
+        self.tensor[..., :2] += offset
+        
+        if self.format == 'xyxy':
+            
+            self.tensor[..., 2:] += offset
+        
+        self.converted_tensors = {}
+        
+        return self
+
+
+def convert_bbox_topleft_xywh_tensor_to_center_xywh(bbox_topleft_xywh_tensor, out=None):
     """Function to convert bounding boxes in format (x_topleft, y_topleft, width, height)
     to a format of (x_center, y_center, width, height).
     
@@ -622,20 +1315,18 @@ def convert_bbox_topleft_xywh_tensor_to_center_xywh(bbox_topleft_xywh_tensor):
     bbox_xywh_tensor : FloatTensor of shape (N, 4)
         Tensor with bounding boxes in topleft_xywh format
         
+    out : FloatTensor of shape (N, 4) or None
+        Preallocated tensor to write the result into
+        
     Returns
     -------
     bbox_xyxy_tensor : FloatTensor of shape (N, 4)
         Tensor with bounding boxes in center_xywh format
     """
     
-    bbox_center_xywh_tensor = bbox_topleft_xywh_tensor.clone()
-    
-    bbox_center_xywh_tensor[:, 0] = bbox_topleft_xywh_tensor[:, 0] + bbox_topleft_xywh_tensor[:, 2] * 0.5
-    bbox_center_xywh_tensor[:, 1] = bbox_topleft_xywh_tensor[:, 1] + bbox_topleft_xywh_tensor[:, 3] * 0.5
-    
-    return bbox_center_xywh_tensor
+    return convert_bbox_format(bbox_topleft_xywh_tensor, 'topleft_xywh', 'center_xywh', out=out)
 
-def convert_bbox_center_xywh_tensor_to_xyxy(bbox_center_xywh_tensor):
+def convert_bbox_center_xywh_tensor_to_xyxy(bbox_center_xywh_tensor, out=None):
     """Function to convert bounding boxes in format (x_center, y_center, width, height)
     to a format of (x_min, y_min, x_max, y_max).
     
@@ -646,26 +1337,19 @@ def convert_bbox_center_xywh_tensor_to_xyxy(bbox_center_xywh_tensor):
     bbox_xywh_tensor : FloatTensor of shape (N, 4)
         Tensor with bounding boxes in center_xywh format
         
+    out : FloatTensor of shape (N, 4) or None
+        Preallocated tensor to write the result into
+        
     Returns
     -------
     bbox_xyxy_tensor : FloatTensor of shape (N, 4)
         Tensor with bounding boxes in xyxy format
     """
     
-    bbox_xyxy_tensor = bbox_center_xywh_tensor.clone()
-    
-    # Getting top left corner
-    bbox_xyxy_tensor[:, 0] = bbox_center_xywh_tensor[:, 0] - bbox_center_xywh_tensor[:, 2] * 0.5
-    bbox_xyxy_tensor[:, 1] = bbox_center_xywh_tensor[:, 1] - bbox_center_xywh_tensor[:, 3] * 0.5
-    
-    # Getting bottom right corner
-    bbox_xyxy_tensor[:, 2] = bbox_center_xywh_tensor[:, 0] + bbox_center_xywh_tensor[:, 2] * 0.5
-    bbox_xyxy_tensor[:, 3] = bbox_center_xywh_tensor[:, 1] + bbox_center_xywh_tensor[:, 3] * 0.5
-    
-    return bbox_xyxy_tensor
+    return convert_bbox_format(bbox_center_xywh_tensor, 'center_xywh', 'xyxy', out=out)
 
 
-def convert_bbox_topleft_xywh_tensor_to_xyxy(bbox_topleft_xywh_tensor):
+def convert_bbox_topleft_xywh_tensor_to_xyxy(bbox_topleft_xywh_tensor, out=None):
     """Function to convert bounding boxes in format (x_topleft, y_topleft, width, height)
     to a format of (x_min, y_min, x_max, y_max).
     
@@ -676,21 +1360,19 @@ def convert_bbox_topleft_xywh_tensor_to_xyxy(bbox_topleft_xywh_tensor):
     bbox_xywh_tensor : FloatTensor of shape (N, 4)
         Tensor with bounding boxes in xywh format
         
+    out : FloatTensor of shape (N, 4) or None
+        Preallocated tensor to write the result into
+        
     Returns
     -------
     bbox_xyxy_tensor : FloatTensor of shape (N, 4)
         Tensor with bounding boxes in xyxy format
     """
     
-    bbox_xyxy_tensor = bbox_topleft_xywh_tensor.clone()
-    
-    bbox_xyxy_tensor[:, 2] = bbox_topleft_xywh_tensor[:, 0] + bbox_topleft_xywh_tensor[:, 2]
-    bbox_xyxy_tensor[:, 3] = bbox_topleft_xywh_tensor[:, 1] + bbox_topleft_xywh_tensor[:, 3]
-    
-    return bbox_xyxy_tensor
+    return convert_bbox_format(bbox_topleft_xywh_tensor, 'topleft_xywh', 'xyxy', out=out)
 
 
-def convert_bbox_center_xywh_tensor_to_topleft_xywh(bbox_center_xywh_tensor):
+def convert_bbox_center_xywh_tensor_to_topleft_xywh(bbox_center_xywh_tensor, out=None):
     """Function to convert bounding boxes in format (x_center, y_center, width, height)
     to a format of (x_topleft, y_topleft, width, height).
     
@@ -701,18 +1383,16 @@ def convert_bbox_center_xywh_tensor_to_topleft_xywh(bbox_center_xywh_tensor):
     bbox_center_xywh_tensor : FloatTensor of shape (N, 4)
         Tensor with bounding boxes in center_xywh format
         
+    out : FloatTensor of shape (N, 4) or None
+        Preallocated tensor to write the result into
+        
     Returns
     -------
     bbox_topleft_xywh_tensor : FloatTensor of shape (N, 4)
         Tensor with bounding boxes in topleft_xywh format
     """
     
-    bbox_topleft_xywh_tensor = bbox_center_xywh_tensor.clone()
-    
-    bbox_topleft_xywh_tensor[:, 0] = bbox_center_xywh_tensor[:, 0] - bbox_center_xywh_tensor[:, 2] * 0.5
-    bbox_topleft_xywh_tensor[:, 1] = bbox_center_xywh_tensor[:, 1] - bbox_center_xywh_tensor[:, 3] * 0.5
-    
-    return bbox_topleft_xywh_tensor
+    return convert_bbox_format(bbox_center_xywh_tensor, 'center_xywh', 'topleft_xywh', out=out)
 
 
 def display_bboxes_center_xywh(img, bboxes_center_xywh):
@@ -748,10 +1428,82 @@ def display_bboxes_center_xywh(img, bboxes_center_xywh):
     
     plt.show()
 
-def compute_bboxes_ious(bboxes_xyxy_group_1, bboxes_xyxy_group_2):
+def compute_bboxes_best_matches(bboxes_xyxy_group_1,
+                                bboxes_xyxy_group_2,
+                                bboxes_xyxy_group_2_mask=None,
+                                chunk_size=None):
+    """Function to find the box from bboxes_group_2 with the biggest intersection
+    over union for each box from bboxes_group_1.
+    
+    If ```chunk_size``` is specified, the boxes of group 1 are processed in chunks,
+    so that the full (N, M) matrix of intersection over union values is never
+    allocated. The result is exactly the same as without chunking.
+    
+    Parameters
+    ----------
+    bboxes_xyxy_group_1 : FloatTensor of shape (N, 4)
+        Tensor with bounding boxes in xyxy format
+        
+    bboxes_xyxy_group_2 : FloatTensor of shape ([B,] M, 4)
+        Tensor with bounding boxes in xyxy format
+        
+    bboxes_xyxy_group_2_mask : BoolTensor of shape ([B,] M) or None
+        Mask of valid boxes of group 2 -- other boxes are never matched.
+        
+    chunk_size : int or None
+        Number of boxes of group 1 processed at once
+        
+    Returns
+    -------
+    best_match_ious : FloatTensor of shape ([B,] N)
+        Biggest intersection over union for each box of group 1.
+        Is equal to -1 if there are no valid boxes in group 2.
+        
+    best_match_ids : LongTensor of shape ([B,] N)
+        Index of the best matching box of group 2 for each box of group 1.
+    """
+    
+    number_of_boxes = bboxes_xyxy_group_1.size(0)
+    
+    if chunk_size is None:
+        
+        chunk_size = max(number_of_boxes, 1)
+    
+    output_shape = bboxes_xyxy_group_2.shape[:-2] + (number_of_boxes,)
+    
+    best_match_ious = bboxes_xyxy_group_2.new_empty(output_shape)
+    best_match_ids = torch.empty(output_shape, dtype=torch.long, device=bboxes_xyxy_group_2.device)
+    
+    for chunk_start in range(0, number_of_boxes, chunk_size):
+        
+        chunk_end = min(chunk_start + chunk_size, number_of_boxes)
+        
+        # ([B,] chunk_size, M)
+        ious = compute_bboxes_ious(bboxes_xyxy_group_1[chunk_start:chunk_end], bboxes_xyxy_group_2)
+        
+        if bboxes_xyxy_group_2_mask is not None:
+            
+            ious.masked_fill_(~bboxes_xyxy_group_2_mask[..., None, :], -1)
+        
+        best_match_ious[..., chunk_start:chunk_end], best_match_ids[..., chunk_start:chunk_end] = ious.max(-1)
+    
+    return best_match_ious, best_match_ids
+
+
+def compute_bboxes_ious(bboxes_xyxy_group_1, bboxes_xyxy_group_2, out=None, block_size=None, compute_dtype=None):
     """Function to compute the intersection over union (IOU) metric
     for each pair of rectangles from bboxes_group_1 and bboxes_group_2
     
+    The computation is performed in blocks of block_size boxes of group 1
+    and the result of each block is written directly into the output tensor.
+    This way the (block_size, M, 2) intermediate tensors are allocated instead
+    of (N, M, 2) ones. The result is exactly the same as without blocking.
+    
+    Reduced precision (float16/bfloat16) can be used to halve the memory
+    of the intermediates and of the output. In this case the coordinates are
+    normalized to [-1, 1] range first, because the areas of boxes in pixel
+    coordinates overflow float16 -- iou is invariant to this scaling.
+    
     Parameters
     ----------
     bboxes_xyxy_group_1 : FloatTensor of shape (N, 4)
@@ -760,6 +1512,16 @@ def compute_bboxes_ious(bboxes_xyxy_group_1, bboxes_xyxy_group_2):
     bboxes_xyxy_group_2 : FloatTensor of shape (M, 4)
         Tensor with bounding boxes in xyxy format
         
+    out : Tensor of shape (N, M) or None
+        Preallocated tensor to write the ious into
+        
+    block_size : int or None
+        Number of boxes of group 1 processed at once. All at once if None.
+        
+    compute_dtype : torch.dtype or None
+        Dtype used for computation, for example torch.float16.
+        Dtype of the input is used if None.
+        
     Returns
     -------
     ious : FloatTensor of shape (N, M)
@@ -767,29 +1529,75 @@ def compute_bboxes_ious(bboxes_xyxy_group_1, bboxes_xyxy_group_2):
         from group 1 and 2
     """
     
-    # Computing the bboxes of the intersections between
-    # each pair of boxes from group 1 and 2
+    # Leading batch dimensions of the groups are broadcasted against each other,
+    # for example group 1 of shape (N, 4) and group 2 of shape (B, M, 4)
+    # result in ious of shape (B, N, M)
     
-    # top_left: (N, M, 2)
-    top_left = torch.max(bboxes_xyxy_group_1[:, None , :2],
-                         bboxes_xyxy_group_2[:, :2])
+    reduced_precision = compute_dtype is not None and compute_dtype != bboxes_xyxy_group_1.dtype
     
-    # bottom_right: (N, M, 2)
-    bottom_right = torch.min(bboxes_xyxy_group_1[:, None, 2:],
-                             bboxes_xyxy_group_2[:, 2:])
+    if reduced_precision:
+        
+        scale = max(bboxes_xyxy_group_1.abs().max().item() if bboxes_xyxy_group_1.numel() else 0,
+                    bboxes_xyxy_group_2.abs().max().item() if bboxes_xyxy_group_2.numel() else 0,
+                    1e-12)
+        
+        bboxes_xyxy_group_1 = (bboxes_xyxy_group_1 / scale).to(compute_dtype)
+        bboxes_xyxy_group_2 = (bboxes_xyxy_group_2 / scale).to(compute_dtype)
     
-    intersections_bboxes_width_height = torch.clamp( bottom_right - top_left, min=0)
+    number_of_boxes_group_1 = bboxes_xyxy_group_1.size(-2)
+    number_of_boxes_group_2 = bboxes_xyxy_group_2.size(-2)
     
-    # intersections_bboxes_areas: (N, M)
-    intersections_bboxes_areas = intersections_bboxes_width_height[:, :, 0] * intersections_bboxes_width_height[:, :, 1]
+    batch_shape = torch.broadcast_shapes(bboxes_xyxy_group_1.shape[:-2], bboxes_xyxy_group_2.shape[:-2])
+    
+    if out is None:
+        
+        out = bboxes_xyxy_group_1.new_empty(batch_shape + (number_of_boxes_group_1, number_of_boxes_group_2))
+    
+    if block_size is None:
+        
+        block_size = max(number_of_boxes_group_1, 1)
     
     # bboxes_group_1_areas: (N,)
-    bboxes_group_1_areas = (bboxes_xyxy_group_1[:,2]-bboxes_xyxy_group_1[:,0]) * (bboxes_xyxy_group_1[:,3]-bboxes_xyxy_group_1[:,1])
+    bboxes_group_1_areas = (bboxes_xyxy_group_1[...,2]-bboxes_xyxy_group_1[...,0]) * (bboxes_xyxy_group_1[...,3]-bboxes_xyxy_group_1[...,1])
     
     # bboses_group_2_areas: (M,)
-    bboxes_group_2_areas = (bboxes_xyxy_group_2[:,2]-bboxes_xyxy_group_2[:,0]) * (bboxes_xyxy_group_2[:,3]-bboxes_xyxy_group_2[:,1])
+    bboxes_group_2_areas = (bboxes_xyxy_group_2[...,2]-bboxes_xyxy_group_2[...,0]) * (bboxes_xyxy_group_2[...,3]-bboxes_xyxy_group_2[...,1])
     
-    # ious: (N, M)
-    ious = intersections_bboxes_areas / (bboxes_group_1_areas[:, None] + bboxes_group_2_areas - intersections_bboxes_areas)
+    for block_start in range(0, number_of_boxes_group_1, block_size):
+        
+        block_end = min(block_start + block_size, number_of_boxes_group_1)
+        
+        block = bboxes_xyxy_group_1[..., block_start:block_end, :]
+        
+        # Computing the bboxes of the intersections between
+        # each pair of boxes from the block of group 1 and group 2
+        
+        # top_left: (block_size, M, 2)
+        top_left = torch.max(block[..., :, None, :2],
+                             bboxes_xyxy_group_2[..., None, :, :2])
+        
+        # bottom_right: (block_size, M, 2) -- reused for the intersections sizes
+        intersections_bboxes_width_height = torch.min(block[..., :, None, 2:],
+                                                      bboxes_xyxy_group_2[..., None, :, 2:])
+        
+        intersections_bboxes_width_height.sub_(top_left).clamp_(min=0)
+        
+        del top_left
+        
+        # intersections_bboxes_areas: (block_size, M)
+        intersections_bboxes_areas = intersections_bboxes_width_height[..., 0] * intersections_bboxes_width_height[..., 1]
+        
+        del intersections_bboxes_width_height
+        
+        # unions: (block_size, M)
+        unions = bboxes_group_1_areas[..., block_start:block_end, None] + bboxes_group_2_areas[..., None, :]
+        unions.sub_(intersections_bboxes_areas)
+        
+        if reduced_precision:
+            
+            # Rounding of coordinates can collapse small boxes to zero area
+            unions.clamp_(min=torch.finfo(unions.dtype).tiny)
+        
+        out[..., block_start:block_end, :] = intersections_bboxes_areas.div_(unions)
     
-    return ious
\ No newline at end of file
+    return out
@@ -1,56 +1,121 @@
 import numpy as np
-import skimage.morphology
+import scipy.ndimage
 
 #TODO: write good docs for these functions
 
-def clean_up_annotation(annotation, labels=np.asarray([0, 70, 160]), ambigious_class_id=255):
-    """Cleans up the artifacts of the segmentation mask caused by codec.
-       In addition to that, relabels the annotations to be sequential
-       number starting from 0. For example, [0, 70, 160] will be
-       converted to [0, 1, 2]
+def compute_closest_labels_map(annotations, labels=np.asarray([0, 70, 160])):
+    """Returns the index of the channel c with the smallest |annotations[..., c] - labels[c]|
+    (the first one in case of ties) -- same as np.abs(annotations - labels).argmin(axis=-1).
+    
+    For uint8 annotations the distances are taken from 256-entry lookup tables,
+    one per channel, instead of computing an int64 distance map.
     """
-
-    # Nearest neighbour based on the distance to the class number
-    labels_matrix = labels.reshape((1, 1, 3))
-    distance_map = np.abs( annotation - labels_matrix )
-    closest_neighbour_map = distance_map.argmin(axis=2)
-
-
-    # morphology.label finds connected components.
-    # we have to do it separately for each channel, because if
-    # we run it on image with all labels, it will be hard to 
-    # get the mapping from old lables to new ones (at least we didn't found a way to do it)
+    
+    labels = np.asarray(labels)
+    
+    if annotations.dtype == np.uint8:
+        
+        pixel_values = np.arange(256)
+        
+        # Distances are in [0, 255] -- uint8 lookup tables are exact
+        distances_lookup_tables = [np.abs(pixel_values - label).astype(np.uint8) for label in labels]
+        
+        get_distances = lambda channel: distances_lookup_tables[channel][annotations[..., channel]]
+    else:
+        
+        get_distances = lambda channel: np.abs(annotations[..., channel] - labels[channel])
+    
+    closest_distances = get_distances(0)
+    closest_neighbour_map = np.zeros(annotations.shape[:-1], dtype=np.uint8)
+    
+    for channel in range(1, len(labels)):
+        
+        distances = get_distances(channel)
+        
+        # Strict comparison keeps the first channel in case of ties, as argmin() does
+        is_closer = distances < closest_distances
+        
+        closest_neighbour_map[is_closer] = channel
+        
+        np.minimum(closest_distances, distances, out=closest_distances)
+    
+    return closest_neighbour_map
 
 
+def clean_up_annotations_batch(annotations, labels=np.asarray([0, 70, 160]), ambigious_class_id=255):
+    """Cleans up the artifacts of the segmentation masks caused by codec.
+       Same as clean_up_annotation() applied to each of the frames of
+       the (N, H, W, 3) array, returns the stacked (N, H, W) result.
+       
+       Connected components of all the frames are found with a single call
+       to scipy.ndimage.label() with a structuring element that doesn't connect
+       neighbouring frames.
+    """
+    
+    closest_neighbour_map = compute_closest_labels_map(annotations, labels)
+    
+    number_of_frames = closest_neighbour_map.shape[0]
+    
+    # Full (8-)connectivity within each frame, as skimage.morphology.label() uses by default
+    structure = np.zeros((3, 3, 3), dtype=np.bool_)
+    structure[1] = True
+    
     # Do this for all classes except background.
     # Algorithm finds the biggest connected component, other components are
     # marked as ambigious (255). This is based on prior knowledge that shaft
     # and manipulator labels are single connected components in each training frame.
-    for current_class_number in xrange(1, len(labels)):
-
+    cleaned_up_map = closest_neighbour_map.astype(np.intp)
+    
+    for current_class_number in range(1, len(labels)):
+        
         current_class_binary_mask = (closest_neighbour_map == current_class_number)
-
+        
         # Find all connected components for current class
-        res = skimage.morphology.label(current_class_binary_mask)
-
-        # Get the number and number of elements in each connected component
-        unique_labels, inverse, unique_counts = np.unique(res, return_inverse=True, return_counts=True)
-
-        # unique_labels are sorted -- so the background label (represented by 0)
-        # is always at the beginning of the list
-        # but we are interested in connected component which is not a background
-        # so we don't consider background to be a connected component
-        not_background_classes = unique_labels[1:]
-        not_background_classes_element_counts = unique_counts[1:]
-
-        class_with_biggest_count = not_background_classes[not_background_classes_element_counts.argmax()]
-
+        components, number_of_components = scipy.ndimage.label(current_class_binary_mask, structure=structure)
+        
+        # Class is absent in all of the frames
+        if number_of_components == 0:
+            
+            continue
+        
+        components_sizes = np.bincount(components.ravel(), minlength=number_of_components + 1)
+        
+        # Components are numbered in the scan order -- components of each frame
+        # have consecutive numbers in the range (last number in the previous frames, last number in this frame]
+        frames_last_components = np.maximum.accumulate(components.reshape(number_of_frames, -1).max(axis=1))
+        frames_first_components = np.concatenate(([0], frames_last_components[:-1])) + 1
+        
+        is_biggest_component = np.zeros(number_of_components + 1, dtype=np.bool_)
+        
+        for first_component, last_component in zip(frames_first_components, frames_last_components):
+            
+            # Class is absent in this frame
+            if first_component > last_component:
+                
+                continue
+            
+            # argmax() picks the component with the smallest number among equal ones, as before
+            biggest_component = first_component + components_sizes[first_component:last_component + 1].argmax()
+            
+            is_biggest_component[biggest_component] = True
+        
         # Use the biggest component as ground truth mask
         # all other components will be marked as ambigious (255)
-        closest_neighbour_map[res == class_with_biggest_count] = current_class_number
-        closest_neighbour_map[(res != class_with_biggest_count) & (res != 0)] = ambigious_class_id
+        is_biggest_component[0] = True
+        
+        cleaned_up_map[~is_biggest_component[components]] = ambigious_class_id
     
-    return closest_neighbour_map
+    return cleaned_up_map
+
+
+def clean_up_annotation(annotation, labels=np.asarray([0, 70, 160]), ambigious_class_id=255):
+    """Cleans up the artifacts of the segmentation mask caused by codec.
+       In addition to that, relabels the annotations to be sequential
+       number starting from 0. For example, [0, 70, 160] will be
+       converted to [0, 1, 2]
+    """
+    
+    return clean_up_annotations_batch(annotation[np.newaxis], labels, ambigious_class_id)[0]
 
 
 def merge_left_and_right_annotations(left_annotation,
@@ -63,7 +128,7 @@ def merge_left_and_right_annotations(left_annotation,
     final_annotation = left_annotation.copy()
 
     # forgot the ambigious class 
-    for i in range(1, len(labels)) + [ambigious_class_id]:
+    for i in list(range(1, len(labels))) + [ambigious_class_id]:
 
         union_mask = (right_annotation == i) | (left_annotation == i)
 
@@ -89,4 +154,167 @@ def merge_left_and_right_annotations_v2(left_annotation,
 
         final_annotation[union_mask] = i
         
-    return final_annotation
\ No newline at end of file
+    return final_annotation
+
+
+def merge_annotations_by_priority(annotations,
+                                  labels,
+                                  ambigious_class_id=255,
+                                  groups_starts=None):
+    """Vectorized equivalent of reduce(merge_left_and_right_annotations_v2, annotations).
+    
+    merge_left_and_right_annotations_v2() assigns labels one after another,
+    so each pixel of the result gets the value with the biggest position in
+    labels + [ambigious_class_id] among the values of this pixel in all of the
+    annotations, or the value of the first annotation if none of them are in the list.
+    This is computed here with a lookup table of priorities and max over
+    the stacked annotations.
+    
+    Parameters
+    ----------
+    annotations : numpy array of shape (K, H, W)
+        Stacked annotations
+    labels : list of ints
+        Labels in the increasing order of priority
+    groups_starts : list of ints or None
+        If specified, annotations are merged separately within each group
+        of consecutive annotations starting at these indexes
+    
+    Returns
+    -------
+    merged_annotation : numpy array of shape (H, W) or (number of groups, H, W)
+    """
+    
+    priority_labels = list(labels) + [ambigious_class_id]
+    
+    lookup_table_size = 256 if annotations.dtype == np.uint8 else max(256, int(annotations.max()) + 1)
+    
+    priorities_lookup_table = np.full(lookup_table_size, -1, dtype=np.int8)
+    priorities_lookup_table[priority_labels] = np.arange(len(priority_labels))
+    
+    priority_labels = np.asarray(priority_labels, dtype=annotations.dtype)
+    
+    priorities_are_increasing = bool(np.all(np.diff(priority_labels.astype(np.int64)) > 0))
+    
+    def merge_by_priorities_lookup(group):
+        
+        highest_priorities = priorities_lookup_table[group].max(axis=0)
+        
+        # Priority -> label lookup table, -1 (no labels from the list) is handled separately
+        return np.where(highest_priorities >= 0,
+                        priority_labels[np.maximum(highest_priorities, 0)],
+                        group[0])
+    
+    def merge_group(group):
+        
+        if not priorities_are_increasing:
+            
+            return merge_by_priorities_lookup(group)
+        
+        # If labels priorities increase with their values, the biggest value
+        # is the result when it is in the list or when all of the values are equal
+        # (background). Only the rest of the pixels need the lookup of priorities
+        highest_values = group.max(axis=0)
+        
+        unresolved_mask = (priorities_lookup_table[highest_values] < 0) & (group.min(axis=0) != highest_values)
+        
+        if unresolved_mask.any():
+            
+            highest_values[unresolved_mask] = merge_by_priorities_lookup(group[:, unresolved_mask])
+        
+        return highest_values
+    
+    if groups_starts is None:
+        
+        return merge_group(annotations)
+    
+    groups_ends = list(groups_starts[1:]) + [len(annotations)]
+    
+    return np.stack([merge_group(annotations[start:end]) for start, end in zip(groups_starts, groups_ends)])
+
+
+def merge_endovis_instrument_2017_instruments_annotations(annotations, groups_starts, parts_class_labels):
+    """Merges left/right parts annotations of each of the instruments of an Endovis 2017 frame.
+    
+    Parameters
+    ----------
+    annotations : numpy array of shape (K, H, W)
+        Stacked parts annotation files of all of the instruments of the frame
+    groups_starts : list of ints
+        Index of the first annotation of each instrument in annotations
+    parts_class_labels : list of ints
+        Parts labels including the background
+    
+    Returns
+    -------
+    instruments_annotations : numpy array of shape (number of instruments, H, W)
+    """
+    
+    return merge_annotations_by_priority(annotations, parts_class_labels[1:], groups_starts=groups_starts)
+
+
+def convert_endovis_instrument_2017_instruments_annotations(instruments_annotations,
+                                                            dataset_type,
+                                                            parts_class_labels,
+                                                            instruments_types_labels,
+                                                            instrument_types_class_labels,
+                                                            parts_class_to_label_mapping=None,
+                                                            new_parts_class_to_label_mapping=None):
+    """Computes the final annotation of an Endovis 2017 frame for the dataset type in
+    one pass -- same as the chain of merge methods of Endovis_Instrument_2017.
+    
+    Instruments are merged with merge_annotations_by_priority() and label
+    changes are performed with lookup tables.
+    
+    Parameters
+    ----------
+    instruments_annotations : numpy array of shape (number of instruments, H, W)
+        Result of merge_endovis_instrument_2017_instruments_annotations()
+    dataset_type : int
+        0 -- binary, 1 -- parts, 2 -- types
+    instruments_types_labels : list of ints
+        Type label of each of the instruments, used only for the types dataset
+    new_parts_class_to_label_mapping : dict or None
+        Part name -> new label, applied to the labels of parts_class_to_label_mapping
+        for the parts dataset
+    
+    Returns
+    -------
+    final_annotation : numpy array of shape (H, W)
+    """
+    
+    if dataset_type == 2:
+        
+        # Each instrument is binarized with the label of its type
+        instruments_types_labels = np.asarray(instruments_types_labels, dtype=instruments_annotations.dtype)
+        
+        instruments_annotations = np.where(instruments_annotations > 0,
+                                           instruments_types_labels[:, np.newaxis, np.newaxis],
+                                           instruments_annotations)
+        
+        return merge_annotations_by_priority(instruments_annotations, instrument_types_class_labels)
+    
+    final_annotation = merge_annotations_by_priority(instruments_annotations, parts_class_labels)
+    
+    if dataset_type == 1 and new_parts_class_to_label_mapping is None:
+        
+        return final_annotation
+    
+    # Lookup tables cover all of the values of the annotation and of the labels,
+    # so that annotations of any integer dtype are supported
+    lookup_table_size = int(max(final_annotation.max(), max(parts_class_labels))) + 1
+    
+    if dataset_type == 0:
+        
+        binary_lookup_table = np.ones(lookup_table_size, dtype=final_annotation.dtype)
+        binary_lookup_table[0] = 0
+        
+        return binary_lookup_table[final_annotation]
+    
+    parts_lookup_table = np.arange(lookup_table_size, dtype=final_annotation.dtype)
+    
+    for tool_part_name, tool_part_old_index in parts_class_to_label_mapping.items():
+        
+        parts_lookup_table[tool_part_old_index] = new_parts_class_to_label_mapping[tool_part_name]
+    
+    return parts_lookup_table[final_annotation]
@@ -0,0 +1,175 @@
+import os
+import json
+
+import numpy as np
+
+
+# Packed store keeps arrays of many samples in a single binary file which
+# is memory-mapped on reading, so that the samples are accessed without
+# decoding or copying and the pages are shared between DataLoader workers.
+#
+# Store consists of two files:
+#   <store_path>.bin -- raw array data, each array aligned to 64 bytes
+#   <store_path>.index.json -- sample key -> field name -> (offset, shape, dtype)
+
+data_file_extension = '.bin'
+index_file_extension = '.index.json'
+
+alignment_in_bytes = 64
+
+
+class PackedArrayStoreWriter(object):
+    """Writes arrays of samples into a packed store one sample at a time.
+    
+    Example
+    -------
+    with PackedArrayStoreWriter('/data/store') as writer:
+        
+        writer.add('frame_000', {'image': image, 'annotation': annotation})
+    """
+    
+    def __init__(self, store_path):
+        
+        self.store_path = store_path
+        
+        self.data_file = open(store_path + data_file_extension, 'wb')
+        
+        self.keys = []
+        self.entries = {}
+        
+        self.current_offset = 0
+    
+    def add(self, key, arrays_dict):
+        """Appends arrays of the sample to the store.
+        
+        Parameters
+        ----------
+        key : string
+            Unique key of the sample
+        
+        arrays_dict : dict
+            Field name -> numpy array
+        """
+        
+        if key in self.entries:
+            
+            raise ValueError("Sample with key '{}' was already added to the store".format(key))
+        
+        entry = {}
+        
+        for field_name, array in arrays_dict.items():
+            
+            array = np.ascontiguousarray(array)
+            
+            padding = (-self.current_offset) % alignment_in_bytes
+            
+            if padding:
+                
+                self.data_file.write(b'\0' * padding)
+                self.current_offset += padding
+            
+            self.data_file.write(array.tobytes())
+            
+            entry[field_name] = [self.current_offset, list(array.shape), array.dtype.str]
+            
+            self.current_offset += array.nbytes
+        
+        self.keys.append(key)
+        self.entries[key] = entry
+    
+    def close(self):
+        
+        self.data_file.close()
+        
+        # Index is written last and atomically -- store without an index
+        # is considered incomplete
+        temporary_index_path = self.store_path + index_file_extension + '.tmp'
+        
+        with open(temporary_index_path, 'w') as index_file:
+            
+            json.dump({'keys': self.keys, 'entries': self.entries}, index_file)
+        
+        os.rename(temporary_index_path, self.store_path + index_file_extension)
+    
+    def __enter__(self):
+        
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        
+        if exc_type is None:
+            
+            self.close()
+        else:
+            
+            self.data_file.close()
+
+
+def packed_store_exists(store_path):
+
+    return os.path.isfile(store_path + index_file_extension) and os.path.isfile(store_path + data_file_extension)
+
+
+class PackedArrayStore(object):
+    """Read-only access to the packed store written by PackedArrayStoreWriter.
+    
+    Returned arrays are read-only views of the memory-mapped file. The file is
+    mapped lazily in each process, so the store can be safely passed to
+    DataLoader workers either with fork or with pickling.
+    """
+    
+    def __init__(self, store_path):
+        
+        self.store_path = store_path
+        
+        with open(store_path + index_file_extension, 'r') as index_file:
+            
+            index = json.load(index_file)
+        
+        self.keys = index['keys']
+        self.entries = index['entries']
+        
+        self.key_to_position = {key: position for position, key in enumerate(self.keys)}
+        
+        self.data = None
+    
+    def __len__(self):
+        
+        return len(self.keys)
+    
+    def __contains__(self, key):
+        
+        return key in self.entries
+    
+    def get_data(self):
+        
+        if self.data is None:
+            
+            self.data = np.memmap(self.store_path + data_file_extension, dtype=np.uint8, mode='r')
+        
+        return self.data
+    
+    def get_array(self, key, field_name):
+        """Returns read-only view of the field of the sample"""
+        
+        offset, shape, dtype = self.entries[key][field_name]
+        
+        dtype = np.dtype(dtype)
+        
+        number_of_bytes = int(np.prod(shape, dtype=np.int64)) * dtype.itemsize
+        
+        return self.get_data()[offset:offset + number_of_bytes].view(dtype).reshape(shape)
+    
+    def get(self, key):
+        """Returns dict field name -> read-only view for the sample"""
+        
+        return {field_name: self.get_array(key, field_name) for field_name in self.entries[key]}
+    
+    def __getstate__(self):
+        
+        state = self.__dict__.copy()
+        
+        # Mapping is recreated in the process the store is unpickled in
+        state['data'] = None
+        
+        return state
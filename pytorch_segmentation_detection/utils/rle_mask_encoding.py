@@ -2,45 +2,151 @@ import numpy as np
 
 # Borrowed from:
 # https://www.kaggle.com/c/siim-acr-pneumothorax-segmentation/data
+#
+# Encoding and decoding are vectorized, but produce exactly the same
+# strings and masks as the original pixel-by-pixel loops. The format is:
+# pairs of run start and run length of 255-valued pixels, where each start
+# is relative to the end of the previous run (column-major order of the image).
 
 def mask2rle(img, width, height):
-    rle = []
-    lastColor = 0;
-    currentPixel = 0;
-    runStart = -1;
-    runLength = 0;
-
-    for x in range(width):
-        for y in range(height):
-            currentColor = img[x][y]
-            if currentColor != lastColor:
-                if currentColor == 255:
-                    runStart = currentPixel;
-                    runLength = 1;
-                else:
-                    rle.append(str(runStart));
-                    rle.append(str(runLength));
-                    runStart = -1;
-                    runLength = 0;
-                    currentPixel = 0;
-            elif runStart > -1:
-                runLength += 1
-            lastColor = currentColor;
-            currentPixel+=1;
-
-    return " ".join(rle)
-
-
-def rle2mask(rle, width, height):
-    mask= np.zeros(width* height)
-    array = np.asarray([int(x) for x in rle.split()])
-    starts = array[0::2]
-    lengths = array[1::2]
-
-    current_position = 0
-    for index, start in enumerate(starts):
-        current_position += start
-        mask[current_position:current_position+lengths[index]] = 255
-        current_position += lengths[index]
-
-    return mask.reshape(width, height)
\ No newline at end of file
+
+    # Same traversal order as the original img[x][y] loops
+    pixels = np.asarray(img)[:width, :height].ravel()
+
+    previous_pixels = np.empty_like(pixels)
+    previous_pixels[0] = 0
+    previous_pixels[1:] = pixels[:-1]
+
+    # Positions where the color changes, either to 255 (start of a run)
+    # or to any other value (end of a run)
+    transitions_positions = np.flatnonzero(pixels != previous_pixels)
+    transitions_are_starts = pixels[transitions_positions] == 255
+
+    ends_indexes = np.flatnonzero(~transitions_are_starts)
+
+    if ends_indexes.size == 0:
+
+        return ""
+
+    # Transition preceding each end -- a run is emitted only if it was a start.
+    # Otherwise (change between two non-255 colors) the original emits "-1 0"
+    preceded_by_start = np.zeros(ends_indexes.size, dtype=np.bool_)
+    preceded_by_start[ends_indexes > 0] = transitions_are_starts[ends_indexes[ends_indexes > 0] - 1]
+
+    starts_indexes = ends_indexes[preceded_by_start] - 1
+
+    # Start of the run is counted from the end of the previous run (the transition
+    # before the start) or from the beginning of the image
+    previous_ends_positions = np.where(starts_indexes > 0, transitions_positions[np.maximum(starts_indexes - 1, 0)], 0)
+
+    runs_starts = np.full(ends_indexes.size, -1, dtype=np.int64)
+    runs_lengths = np.zeros(ends_indexes.size, dtype=np.int64)
+
+    runs_starts[preceded_by_start] = transitions_positions[starts_indexes] - previous_ends_positions
+    runs_lengths[preceded_by_start] = transitions_positions[ends_indexes[preceded_by_start]] - transitions_positions[starts_indexes]
+
+    rle = np.stack((runs_starts, runs_lengths), axis=1).ravel()
+
+    return " ".join(map(str, rle.tolist()))
+
+
+def parse_rle(rle):
+
+    array = np.asarray(rle.split(), dtype=np.int64)
+
+    return array[0::2], array[1::2]
+
+
+def compute_rle_runs_bounds(starts, lengths, mask_size):
+    """Returns begins and ends of the non-empty runs in the flat mask.
+    
+    Bounds are normalized the same way as the mask[begin:end] slices of the
+    original decoder: negative positions (the "-1 0" pairs emitted between two
+    non-255 colors move the position back) count from the end of the mask and
+    runs going past the end of the mask are cut off."""
+
+    # Absolute end of each run -- sum of all the previous starts and lengths
+    runs_ends = np.cumsum(starts + lengths)
+    runs_begins = runs_ends - lengths
+
+    runs_begins = np.clip(np.where(runs_begins < 0, runs_begins + mask_size, runs_begins), 0, mask_size)
+    runs_ends = np.clip(np.where(runs_ends < 0, runs_ends + mask_size, runs_ends), 0, mask_size)
+
+    non_empty_runs = runs_begins < runs_ends
+
+    return runs_begins[non_empty_runs], runs_ends[non_empty_runs]
+
+
+def convert_rle_runs_to_flat_mask(runs_begins, runs_ends, mask_size, dtype=np.uint8):
+    """Fills the runs with a single cumulative sum over the run boundaries.
+    Bounds have to be in [0, mask_size]."""
+
+    boundaries = np.bincount(runs_begins, minlength=mask_size + 1) - np.bincount(runs_ends, minlength=mask_size + 1)
+
+    inside_runs = np.cumsum(boundaries[:-1]) > 0
+
+    if dtype == np.bool_:
+
+        return inside_runs
+
+    return inside_runs.astype(dtype) * dtype(255)
+
+
+def rle2mask(rle, width, height, dtype=np.uint8):
+    """Decodes the rle string into a mask of (width, height) size with 255
+    values inside of the runs (True if dtype is np.bool_)"""
+
+    starts, lengths = parse_rle(rle)
+
+    runs_begins, runs_ends = compute_rle_runs_bounds(starts, lengths, width * height)
+
+    mask = convert_rle_runs_to_flat_mask(runs_begins, runs_ends, width * height, dtype)
+
+    return mask.reshape(width, height)
+
+
+def is_empty_rle(rle):
+
+    return rle.strip() in ('-1', '')
+
+
+def rle2mask_batch(rles, width, height, dtype=np.uint8):
+    """Decodes a sequence of rle strings (for example, a column of the annotation
+    csv file) into an array of (N, width, height) size in one pass.
+    Empty masks are encoded as ' -1'."""
+
+    mask_size = width * height
+
+    all_runs_begins = []
+    all_runs_ends = []
+
+    for index, rle in enumerate(rles):
+
+        if is_empty_rle(rle):
+
+            continue
+
+        starts, lengths = parse_rle(rle)
+
+        runs_begins, runs_ends = compute_rle_runs_bounds(starts, lengths, mask_size)
+
+        # Runs of each mask are moved to the position of the mask in the flat batch
+        all_runs_begins.append(runs_begins + index * mask_size)
+        all_runs_ends.append(runs_ends + index * mask_size)
+
+    if not all_runs_begins:
+
+        return np.zeros((len(rles), width, height), dtype=dtype)
+
+    masks = convert_rle_runs_to_flat_mask(np.concatenate(all_runs_begins),
+                                          np.concatenate(all_runs_ends),
+                                          len(rles) * mask_size,
+                                          dtype)
+
+    return masks.reshape(len(rles), width, height)
+
+
+def mask2rle_batch(masks, width, height):
+    """Encodes each of the (N, width, height) masks, returns list of rle strings"""
+
+    return [mask2rle(mask, width, height) for mask in masks]